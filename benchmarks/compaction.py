@@ -0,0 +1,216 @@
+# Checks and times history compaction (compactHistory() in stats.py). A
+# temporary database is seeded with made up history, most of it older than the
+# retention period, then compacted while another thread keeps making color
+# changes (on a different server) and times how long each takes to be
+# committed. The test checks that
+#     - the stats tables read exactly the same before and after
+#     - every compacted row is accounted for in colorHistoryArchive
+#     - only closed rows older than the cutoff were removed
+# and reports the database's size and row counts before and after, and the
+# color change latencies during compaction, as JSON. Exits with 1 if any check
+# failed.
+#
+# Run from the repo root:
+#     python benchmarks/compaction.py [--users 2000] [--changes 200]
+#         [--retention-days 90] [--batch-size 2000] [--old-database]
+#         [--output results.json]
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+# The bot's modules live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import config
+import dbMigrations
+import metrics
+import stats
+
+seededServerID = 1000
+paletteSize = 10
+liveServerID = 2000
+statsTables = ["userColorStats", "userColorTotals", "guildColorStats",
+               "guildHueStats", "guildSummary"]
+
+# Fills the database with changes per user, spread over the last two years.
+# People tend to go back to the same few colors, so each user picks from a
+# palette of their own. With oldDatabase, the database is made the way it was
+# before incremental vacuum, so the writer has to switch it over first.
+# Returns how many rows were written.
+def seedHistory(users, changes, oldDatabase, randomizer):
+    if oldDatabase:
+        conn = sqlite3.connect(stats.dbPath)
+        dbMigrations.migrate(conn)
+        conn.close()
+    conn = stats.openConnection()
+    curs = conn.cursor()
+    now = int(time.time())
+    for user in range(users):
+        userID = 10 ** 17 + user
+        timestamp = now - 2 * 365 * 24 * 60 * 60
+        palette = ["#{:06X}".format(randomizer.randrange(1 << 24)) for color in
+                   range(paletteSize)]
+        for change in range(changes):
+            timestamp += randomizer.randint(60, 2 * 365 * 24 * 60 * 60 // changes)
+            color = randomizer.choice(palette)
+            stats.writeStats(curs, userID, seededServerID, color,
+                             min(timestamp, now))
+    conn.commit()
+    conn.close()
+    return users * changes
+
+def readTables(conn):
+    return {table: sorted(conn.execute(f"SELECT * FROM {table} WHERE serverID=?",
+                                       (seededServerID,)).fetchall(),
+                          key = repr)
+            for table in statsTables}
+
+# Makes color changes on liveServerID until stopping is set, timing each from
+# being queued to being committed. Returns the latencies in milliseconds.
+def makeChanges(stopping, randomizer, latencies):
+    userID = 0
+    while not stopping.is_set():
+        userID = (userID + 1) % 100
+        color = "#{:06X}".format(randomizer.randrange(1 << 24))
+        startTime = time.perf_counter()
+        stats.queueStats(userID, liveServerID, color, int(time.time()))
+        stats.flush()
+        latencies.append((time.perf_counter() - startTime) * 1000)
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"changes": 0}
+    return {"changes": len(latencies),
+            "p50Ms": round(latencies[len(latencies) // 2], 3),
+            "p99Ms": round(latencies[int(len(latencies) * 0.99)], 3),
+            "maxMs": round(latencies[-1], 3)}
+
+def runCompaction(args, tempDir):
+    randomizer = random.Random(args.seed)
+    stats.dbPath = os.path.join(tempDir, "compaction.db")
+    config.config["Stats"]["RetentionDays"] = str(args.retention_days)
+    config.config["Stats"]["CompactBatchSize"] = str(args.batch_size)
+    seededRows = seedHistory(args.users, args.changes, args.old_database,
+                             randomizer)
+    conn = sqlite3.connect(stats.dbPath)
+    tablesBefore = readTables(conn)
+    cutoff = int(time.time() - args.retention_days * 24 * 60 * 60)
+    expected = conn.execute("""
+SELECT count(*), sum(length) FROM colorHistory WHERE serverID=? AND NOT length=-1
+AND startTime + length < ?""", (seededServerID, cutoff)).fetchone()
+    activeRows = conn.execute("""
+SELECT count(*) FROM colorHistory WHERE serverID=? AND length=-1""",
+                              (seededServerID,)).fetchone()[0]
+    conn.close()
+
+    # The writer switches an old database over to incremental vacuum before
+    # taking any writes
+    startTime = time.perf_counter()
+    stats.startWriter()
+    stats.flush()
+    writerStartSeconds = time.perf_counter() - startTime
+
+    # Latencies with nothing else going on, to compare against
+    idleLatencies = []
+    stopping = threading.Event()
+    timer = threading.Timer(1, stopping.set)
+    timer.start()
+    makeChanges(stopping, randomizer, idleLatencies)
+
+    latencies = []
+    stopping = threading.Event()
+    changer = threading.Thread(target = makeChanges, args = (stopping,
+                                                             randomizer,
+                                                             latencies))
+    changer.start()
+    startTime = time.perf_counter()
+    before, after, compactedCount = stats.compactHistory()
+    compactSeconds = time.perf_counter() - startTime
+    stopping.set()
+    changer.join()
+    stats.close()
+
+    conn = sqlite3.connect(stats.dbPath)
+    tablesAfter = readTables(conn)
+    archived = conn.execute("""
+SELECT sum(picks), sum(totalTime) FROM colorHistoryArchive WHERE serverID=?""",
+                            (seededServerID,)).fetchone()
+    remainingActive = conn.execute("""
+SELECT count(*) FROM colorHistory WHERE serverID=? AND length=-1""",
+                                   (seededServerID,)).fetchone()[0]
+    tooNew = conn.execute("""
+SELECT count(*) FROM colorHistory WHERE serverID=? AND NOT length=-1 AND
+startTime + length < ?""", (seededServerID, cutoff)).fetchone()[0]
+    autoVacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    conn.close()
+
+    changedTables = [table for table in statsTables if tablesBefore[table] !=
+                     tablesAfter[table]]
+    checks = {
+        "statsUnchanged": not changedTables,
+        "archiveMatches": tuple(archived) == (expected[0], expected[1]) and
+                          compactedCount == expected[0],
+        "activeRowsKept": remainingActive == activeRows,
+        "nothingLeftToCompact": tooNew == 0,
+        "incrementalVacuum": autoVacuum == 2,
+    }
+    metricLines = [line for line in metrics.render().splitlines() if
+                   line.startswith(("coloriz_database", "coloriz_history"))]
+    return {
+        "seededRows": seededRows,
+        "compactedRows": compactedCount,
+        "changedTables": changedTables,
+        "writerStartSeconds": round(writerStartSeconds, 3),
+        "compactSeconds": round(compactSeconds, 3),
+        "before": before,
+        "after": after,
+        "idleLatency": summarize(idleLatencies),
+        "latencyDuringCompaction": summarize(latencies),
+        "metrics": metricLines,
+        "checks": checks,
+        "passed": all(checks.values()),
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type = int, default = 2_000)
+    parser.add_argument("--changes", type = int, default = 200,
+                        help = "how many color changes each user has made")
+    parser.add_argument("--retention-days", type = float, default = 90)
+    parser.add_argument("--batch-size", type = int, default = 2_000)
+    parser.add_argument("--old-database", action = "store_true",
+                        help = "start from a database without incremental vacuum")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    # Anything stats.py prints goes to stderr, so stdout is just the JSON
+    with tempfile.TemporaryDirectory() as tempDir, \
+         contextlib.redirect_stdout(sys.stderr):
+        results = runCompaction(args, tempDir)
+    report = {
+        "createdAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "parameters": vars(args),
+        "results": results,
+    }
+    output = json.dumps(report, indent = 2)
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            outputFile.write(output + "\n")
+    else:
+        print(output)
+    sys.exit(0 if results["passed"] else 1)
+
+if __name__ == "__main__":
+    main()
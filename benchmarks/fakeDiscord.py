@@ -0,0 +1,365 @@
+# A local stand-in for the parts of Discord's REST API and gateway the bot
+# uses, so the real bot can be run against it (see loadTest.py) without
+# Discord. It keeps its own guilds, roles, members and channels, answers the
+# bot's requests the way Discord does, sends the matching gateway events back
+# (GUILD_ROLE_CREATE after a role is created, GUILD_MEMBER_UPDATE after a
+# member's roles change, and so on) and can answer a share of requests with a
+# 429 to exercise the rate limit handling. Every request is counted by route.
+#
+# Only JSON text frames are sent over the gateway, which discord.py accepts
+# even though it asks for zlib-stream compression. Sharded connections (see
+# shardTest.py) only get their own guilds, going by Discord's
+# (guild ID >> 22) % shard count.
+
+import aiohttp
+import asyncio
+import collections
+import json
+import random
+import time
+from aiohttp import web
+
+apiPrefix = "/api/v10"
+joinedAt = "2021-01-01T00:00:00+00:00"
+
+# Made up snowflakes, counted up from here so they never collide
+nextID = 10 ** 17
+
+def newID():
+    global nextID
+    nextID += 1
+    return str(nextID)
+
+# discord.py only decodes responses whose Content-Type is exactly
+# application/json, without the charset aiohttp's json_response() adds
+def jsonResponse(data, status = 200, headers = None):
+    headers = dict(headers or {})
+    headers["Content-Type"] = "application/json"
+    return web.Response(body = json.dumps(data).encode("utf-8"), status = status,
+                        headers = headers)
+
+def makeUser(userID, name, bot = False):
+    return {"id": userID, "username": name, "discriminator": "0",
+            "global_name": None, "avatar": None, "bot": bot}
+
+def makeRole(roleID, name, position, color = 0, permissions = 0):
+    return {"id": roleID, "name": name, "color": color,
+            "colors": {"primary_color": color, "secondary_color": None,
+                       "tertiary_color": None},
+            "hoist": False, "position": position,
+            "permissions": str(permissions), "managed": False,
+            "mentionable": False, "flags": 0}
+
+class FakeGuild:
+    def __init__(self, guildID, name):
+        self.id = guildID
+        self.name = name
+        # Role ID -> role payload, and member ID -> (user payload, role IDs)
+        self.roles = {}
+        self.members = {}
+        self.channels = []
+
+    def memberPayload(self, userID):
+        user, roleIDs = self.members[userID]
+        return {"user": user, "roles": list(roleIDs), "joined_at": joinedAt,
+                "deaf": False, "mute": False, "flags": 0, "nick": None}
+
+    def payload(self):
+        return {
+            "id": self.id, "name": self.name, "icon": None, "owner_id": newID(),
+            "roles": list(self.roles.values()), "emojis": [], "stickers": [],
+            "features": [], "member_count": len(self.members),
+            "members": [self.memberPayload(userID) for userID in self.members],
+            "channels": self.channels, "threads": [], "voice_states": [],
+            "presences": [], "large": False, "unavailable": False,
+            "mfa_level": 0, "verification_level": 0,
+            "explicit_content_filter": 0, "default_message_notifications": 0,
+            "system_channel_flags": 0, "premium_tier": 0,
+            "preferred_locale": "en-US", "nsfw_level": 0, "afk_timeout": 300,
+            "premium_progress_bar_enabled": False,
+        }
+
+class FakeDiscord:
+    def __init__(self, rateLimitChance = 0.0, rateLimitSeconds = 0.05,
+                 seed = 0):
+        self.randomizer = random.Random(seed)
+        self.rateLimitChance = rateLimitChance
+        self.rateLimitSeconds = rateLimitSeconds
+        self.botUser = makeUser(newID(), "coloriz", bot = True)
+        self.guilds = {}
+        # Route (e.g., "PUT /guilds/{guildID}/members/{userID}/roles/{roleID}")
+        # -> how many times it was called, and how many of those got a 429
+        self.requestCounts = collections.Counter()
+        self.rateLimitCounts = collections.Counter()
+        # Identified gateway connection -> its [shard ID, shard count], or None
+        # if it isn't sharded
+        self.sockets = {}
+        self.sequence = 0
+        # Channel ID -> futures waiting for the bot's next message there, and
+        # the last message it sent there
+        self.replyWaiters = collections.defaultdict(list)
+        self.lastMessages = {}
+        self.runner = None
+
+    # Adds a guild with colorRoleCount color roles and memberCount members,
+    # colorShare of whom have one of them, and channelCount text channels.
+    # The bot gets a role above all of them. Returns the FakeGuild.
+    # The guild's ID can be given, to put it on a particular shard.
+    def addGuild(self, colorRoleCount = 250, memberCount = 1000,
+                 colorShare = 0.6, channelCount = 50, guildID = None):
+        guild = FakeGuild(guildID or newID(), f"Load Test {len(self.guilds) + 1}")
+        # @everyone's ID is the guild's
+        guild.roles[guild.id] = makeRole(guild.id, "@everyone", 0)
+        colorRoleIDs = []
+        usedHexes = set()
+        while len(colorRoleIDs) < colorRoleCount:
+            color = self.randomizer.randrange(1 << 24)
+            if color in usedHexes:
+                continue
+            usedHexes.add(color)
+            roleID = newID()
+            guild.roles[roleID] = makeRole(roleID, "#{:06x}".format(color),
+                                           len(guild.roles), color)
+            colorRoleIDs.append(roleID)
+        botRoleID = newID()
+        guild.roles[botRoleID] = makeRole(botRoleID, "coloriz", len(guild.roles),
+                                          permissions = 8)
+        guild.members[self.botUser["id"]] = (self.botUser, [botRoleID])
+        for number in range(memberCount):
+            roleIDs = []
+            if colorRoleIDs and self.randomizer.random() < colorShare:
+                roleIDs.append(self.randomizer.choice(colorRoleIDs))
+            userID = newID()
+            guild.members[userID] = (makeUser(userID, f"member{number}"), roleIDs)
+        for number in range(channelCount):
+            guild.channels.append({"id": newID(), "type": 0, "name": f"load-{number}",
+                                   "position": number, "guild_id": guild.id,
+                                   "permission_overwrites": [], "nsfw": False,
+                                   "parent_id": None})
+        self.guilds[guild.id] = guild
+        return guild
+
+    # ================================== Gateway ===================================
+
+    # Whether the connection gets the guild's events
+    def onShard(self, shard, guildID):
+        return shard == None or (int(guildID) >> 22) % shard[1] == shard[0]
+
+    async def dispatch(self, eventName, data):
+        self.sequence += 1
+        message = json.dumps({"op": 0, "t": eventName, "s": self.sequence,
+                              "d": data})
+        guildID = data.get("guild_id")
+        for socket, shard in list(self.sockets.items()):
+            if guildID != None and not self.onShard(shard, guildID):
+                continue
+            try:
+                await socket.send_str(message)
+            except ConnectionError:
+                self.sockets.pop(socket, None)
+
+    async def handleGateway(self, request):
+        socket = web.WebSocketResponse()
+        await socket.prepare(request)
+        await socket.send_json({"op": 10, "d": {"heartbeat_interval": 41250}})
+        async for message in socket:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                continue
+            payload = json.loads(message.data)
+            if payload["op"] == 1:
+                await socket.send_json({"op": 11})
+            elif payload["op"] == 2:
+                shard = payload["d"].get("shard")
+                self.sockets[socket] = shard
+                await self.sendReady(socket, shard)
+        self.sockets.pop(socket, None)
+        return socket
+
+    async def sendReady(self, socket, shard):
+        guilds = [guild for guild in self.guilds.values() if
+                  self.onShard(shard, guild.id)]
+        self.sequence += 1
+        await socket.send_json({"op": 0, "t": "READY", "s": self.sequence, "d": {
+            "v": 10, "user": self.botUser, "session_id": "loadtest",
+            "resume_gateway_url": self.gatewayURL,
+            "guilds": [{"id": guild.id, "unavailable": True} for guild in
+                       guilds],
+            "application": {"id": self.botUser["id"], "flags": 0},
+            "shard": shard,
+        }})
+        for guild in guilds:
+            self.sequence += 1
+            await socket.send_json({"op": 0, "t": "GUILD_CREATE",
+                                    "s": self.sequence, "d": guild.payload()})
+
+    # Sends a message from the member in the channel, like a user typing a
+    # command
+    async def sendMessage(self, guild, channelID, userID, content):
+        user, roleIDs = guild.members[userID]
+        await self.dispatch("MESSAGE_CREATE", {
+            "id": newID(), "channel_id": channelID, "guild_id": guild.id,
+            "author": user, "member": {"roles": list(roleIDs),
+                                       "joined_at": joinedAt, "deaf": False,
+                                       "mute": False, "flags": 0},
+            "content": content, "timestamp": joinedAt,
+            "edited_timestamp": None, "tts": False, "mention_everyone": False,
+            "mentions": [], "mention_roles": [], "attachments": [],
+            "embeds": [], "pinned": False, "type": 0, "flags": 0,
+        })
+
+    # Returns a future which is resolved with the time the bot next sends a
+    # message to the channel
+    def waitForReply(self, channelID):
+        future = asyncio.get_running_loop().create_future()
+        self.replyWaiters[channelID].append(future)
+        return future
+
+    # ==================================== REST ====================================
+
+    # Counts every request by route and answers rateLimitChance of them (other
+    # than the ones made while logging in) with a 429
+    @web.middleware
+    async def countRequests(self, request, handler):
+        resource = request.match_info.route.resource
+        path = resource.canonical if resource != None else request.path
+        route = f"{request.method} {path.removeprefix(apiPrefix)}"
+        self.requestCounts[route] += 1
+        await request.read()
+        if (not request.path.endswith("/@me") and
+            self.randomizer.random() < self.rateLimitChance):
+            self.rateLimitCounts[route] += 1
+            # Without a Via header discord.py takes it for a Cloudflare ban
+            headers = {"Retry-After": str(self.rateLimitSeconds),
+                       "X-RateLimit-Scope": "user", "Via": "1.1 google"}
+            return jsonResponse({"message": "You are being rate limited.",
+                                 "retry_after": self.rateLimitSeconds,
+                                 "global": False}, status = 429,
+                                headers = headers)
+        return await handler(request)
+
+    async def getMe(self, request):
+        return jsonResponse(self.botUser)
+
+    async def getApplication(self, request):
+        return jsonResponse({"id": self.botUser["id"], "name": "coloriz",
+                             "description": "", "icon": None,
+                             "rpc_origins": [], "bot_public": False,
+                             "bot_require_code_grant": False,
+                             "owner": makeUser(newID(), "owner"),
+                             "verify_key": "", "flags": 0})
+
+    def messagePayload(self, channelID, content = ""):
+        return {"id": newID(), "channel_id": channelID, "author": self.botUser,
+                "content": content, "timestamp": joinedAt,
+                "edited_timestamp": None, "tts": False,
+                "mention_everyone": False, "mentions": [], "mention_roles": [],
+                "attachments": [], "embeds": [], "pinned": False, "type": 0,
+                "flags": 0}
+
+    async def createMessage(self, request):
+        channelID = request.match_info["channelID"]
+        content = ""
+        if request.content_type == "application/json":
+            message = await request.json()
+            content = message.get("content") or ""
+            self.lastMessages[channelID] = message
+        replyTime = time.perf_counter()
+        for future in self.replyWaiters.pop(channelID, []):
+            if not future.done():
+                future.set_result(replyTime)
+        return jsonResponse(self.messagePayload(channelID, content))
+
+    async def editMessage(self, request):
+        return jsonResponse(self.messagePayload(request.match_info["channelID"]))
+
+    async def createRole(self, request):
+        guild = self.guilds[request.match_info["guildID"]]
+        data = await request.json()
+        color = data.get("color") or data.get("colors", {}).get("primary_color") or 0
+        role = makeRole(newID(), data.get("name", "new role"), 1, color)
+        guild.roles[role["id"]] = role
+        await self.dispatch("GUILD_ROLE_CREATE", {"guild_id": guild.id, "role": role})
+        return jsonResponse(role)
+
+    async def editRolePositions(self, request):
+        guild = self.guilds[request.match_info["guildID"]]
+        for change in await request.json():
+            role = guild.roles.get(str(change["id"]))
+            if role != None:
+                role["position"] = change["position"]
+                await self.dispatch("GUILD_ROLE_UPDATE", {"guild_id": guild.id,
+                                                          "role": role})
+        return jsonResponse(list(guild.roles.values()))
+
+    async def deleteRole(self, request):
+        guild = self.guilds[request.match_info["guildID"]]
+        roleID = request.match_info["roleID"]
+        if guild.roles.pop(roleID, None) == None:
+            return jsonResponse({"message": "Unknown Role", "code": 10011},
+                                status = 404)
+        for user, roleIDs in guild.members.values():
+            if roleID in roleIDs:
+                roleIDs.remove(roleID)
+        await self.dispatch("GUILD_ROLE_DELETE", {"guild_id": guild.id,
+                                                  "role_id": roleID})
+        return web.Response(status = 204)
+
+    async def changeMemberRole(self, request):
+        guild = self.guilds[request.match_info["guildID"]]
+        userID = request.match_info["userID"]
+        roleID = request.match_info["roleID"]
+        if roleID not in guild.roles or userID not in guild.members:
+            return jsonResponse({"message": "Unknown Role", "code": 10011},
+                                status = 404)
+        user, roleIDs = guild.members[userID]
+        if request.method == "PUT" and roleID not in roleIDs:
+            roleIDs.append(roleID)
+        elif request.method == "DELETE" and roleID in roleIDs:
+            roleIDs.remove(roleID)
+        else:
+            return web.Response(status = 204)
+        memberUpdate = guild.memberPayload(userID)
+        memberUpdate["guild_id"] = guild.id
+        await self.dispatch("GUILD_MEMBER_UPDATE", memberUpdate)
+        return web.Response(status = 204)
+
+    async def unknownRoute(self, request):
+        return jsonResponse({"message": "404: Not Found", "code": 0},
+                            status = 404)
+
+    # ==============================================================================
+
+    # Starts serving on the given port (a free one if 0). Returns the REST base
+    # URL and the gateway URL to point discord.py at.
+    async def start(self, host = "127.0.0.1", port = 0):
+        app = web.Application(middlewares = [self.countRequests],
+                              client_max_size = 32 * 1024 * 1024)
+        app.router.add_get("/", self.handleGateway)
+        app.router.add_get(f"{apiPrefix}/users/@me", self.getMe)
+        app.router.add_get(f"{apiPrefix}/oauth2/applications/@me",
+                           self.getApplication)
+        app.router.add_post(f"{apiPrefix}/channels/{{channelID}}/messages",
+                            self.createMessage)
+        app.router.add_patch(f"{apiPrefix}/channels/{{channelID}}/messages/{{messageID}}",
+                             self.editMessage)
+        app.router.add_post(f"{apiPrefix}/guilds/{{guildID}}/roles", self.createRole)
+        app.router.add_patch(f"{apiPrefix}/guilds/{{guildID}}/roles",
+                             self.editRolePositions)
+        app.router.add_delete(f"{apiPrefix}/guilds/{{guildID}}/roles/{{roleID}}",
+                              self.deleteRole)
+        memberRolePath = f"{apiPrefix}/guilds/{{guildID}}/members/{{userID}}/roles/{{roleID}}"
+        app.router.add_put(memberRolePath, self.changeMemberRole)
+        app.router.add_delete(memberRolePath, self.changeMemberRole)
+        app.router.add_route("*", "/{tail:.*}", self.unknownRoute)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.gatewayURL = f"ws://{host}:{port}/"
+        return f"http://{host}:{port}{apiPrefix}", self.gatewayURL
+
+    async def stop(self):
+        for socket in list(self.sockets):
+            await socket.close()
+        await self.runner.cleanup()
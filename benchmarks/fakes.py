@@ -0,0 +1,132 @@
+# Stand-ins for the discord.py objects the bot's commands work with (contexts,
+# guilds, members and roles), so they can be benchmarked without Discord. They
+# only have what the bot actually uses, and every "request" to Discord
+# succeeds straight away. makeGuild() builds a whole guild of them.
+
+import random
+
+# Made up IDs, counted up from here so they never collide
+nextID = 10 ** 17
+
+def newID():
+    global nextID
+    nextID += 1
+    return nextID
+
+class FakeAsset:
+    def __init__(self, url):
+        self.url = url
+
+class FakeRole:
+    def __init__(self, guild, name, color = None):
+        self.id = newID()
+        self.guild = guild
+        self.name = name
+        self.color = color
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return f"<FakeRole {self.name}>"
+
+    @property
+    def members(self):
+        return [member for member in self.guild.members if self in member.roles]
+
+    async def delete(self, reason = None):
+        self.guild.roles.remove(self)
+        self.guild.roleIDs.pop(self.id, None)
+
+class FakeMember:
+    def __init__(self, guild, name, roles):
+        self.id = newID()
+        self.guild = guild
+        self.name = name
+        self.nick = name
+        self.display_name = name
+        self.roles = roles
+        self.color = None
+        self.display_avatar = FakeAsset(f"https://example.invalid/{self.id}.png")
+
+    async def add_roles(self, *roles):
+        for role in roles:
+            if role not in self.roles:
+                self.roles.append(role)
+
+    async def remove_roles(self, *roles):
+        for role in roles:
+            if role in self.roles:
+                self.roles.remove(role)
+
+class FakeGuild:
+    def __init__(self, name = "Benchmark Guild"):
+        self.id = newID()
+        self.name = name
+        self.roles = []
+        self.roleIDs = {}
+        self.members = []
+        self.me = None
+        self.filesize_limit = 25 * 1024 * 1024
+
+    def get_role(self, roleID):
+        return self.roleIDs.get(roleID)
+
+    def addRole(self, name, color = None):
+        role = FakeRole(self, name, color)
+        self.roles.append(role)
+        self.roleIDs[role.id] = role
+        return role
+
+    async def create_role(self, name = None, color = None):
+        return self.addRole(name, color)
+
+    async def edit_role_positions(self, positions):
+        pass
+
+class FakeMessage:
+    def __init__(self, author):
+        self.author = author
+
+    async def edit(self, content = None):
+        pass
+
+class FakeContext:
+    def __init__(self, guild, author):
+        self.guild = guild
+        self.author = author
+        self.message = FakeMessage(author)
+        self.sent = 0
+
+    async def send(self, content = None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self.author)
+
+# Builds a guild with colorRoleCount color roles (named after random hex codes)
+# plus a few ordinary ones, and memberCount members. colorShare of the members
+# have a random one of the color roles. The bot's own member, with the top
+# role, is guild.me.
+def makeGuild(colorRoleCount = 250, memberCount = 100_000, colorShare = 0.6,
+              seed = 0):
+    randomizer = random.Random(seed)
+    guild = FakeGuild()
+    everyone = guild.addRole("@everyone")
+    ordinaryRoles = [guild.addRole(f"Role {number}") for number in range(5)]
+    colorRoles = []
+    usedHexes = set()
+    while len(colorRoles) < colorRoleCount:
+        hexName = "#{:06x}".format(randomizer.randrange(1 << 24))
+        if hexName not in usedHexes:
+            usedHexes.add(hexName)
+            colorRoles.append(guild.addRole(hexName))
+    botRole = guild.addRole("coloriz")
+    guild.me = FakeMember(guild, "coloriz", [everyone, botRole])
+    guild.members.append(guild.me)
+    for number in range(memberCount):
+        roles = [everyone]
+        if randomizer.random() < 0.2:
+            roles.append(randomizer.choice(ordinaryRoles))
+        if colorRoles and randomizer.random() < colorShare:
+            roles.append(randomizer.choice(colorRoles))
+        guild.members.append(FakeMember(guild, f"member{number}", roles))
+    return guild
@@ -0,0 +1,104 @@
+# Benchmarks the stats queries against a big colorHistory table, before and
+# after the migrations in dbMigrations.py (epoch timestamps and indexes). The
+# database is built from scratch in a temporary directory with made up
+# history, so this never touches the bot's own coloriz.db.
+#
+# Run from the repo root:
+#     python benchmarks/historyQueries.py [--rows 10000000] [--pairs 100000]
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# dbMigrations lives one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import dbMigrations
+
+# The queries stats.py made before the migrations, and the ones it makes now
+oldQueries = {
+    "activeColor": """
+SELECT color, timestamp FROM colorHistory WHERE length=-1 AND userID=? AND serverID=?""",
+    "longestColor": """
+SELECT max(length), color FROM colorHistory WHERE userID=? AND serverID=?
+AND NOT length=-1""",
+}
+newQueries = {
+    "activeColor": """
+SELECT color, startTime FROM colorHistory WHERE serverID=? AND userID=? AND length=-1""",
+    "longestColor": """
+SELECT max(length), color FROM colorHistory WHERE serverID=? AND userID=?
+AND NOT length=-1""",
+}
+
+# Fills the (version 1) table with rows spread over the given number of
+# (server, user) pairs. Every pair's last row is their active color.
+def seedHistory(conn, rowCount, pairCount):
+    start = datetime(2021, 1, 1)
+    rowsPerPair = max(1, rowCount // pairCount)
+    def rows():
+        for pair in range(pairCount):
+            serverID = 1000 + pair % 100
+            userID = 10 ** 17 + pair
+            timestamp = start
+            for row in range(rowsPerPair):
+                length = -1 if row == rowsPerPair - 1 else random.randint(1, 10 ** 6)
+                color = "#{:06X}".format(random.randrange(1 << 24))
+                yield (userID, serverID, color, str(timestamp), length)
+                timestamp += timedelta(seconds = max(length, 0))
+    conn.executemany("INSERT INTO colorHistory VALUES (NULL, ?, ?, ?, ?, ?)",
+                     rows())
+    conn.commit()
+    return rowsPerPair * pairCount
+
+# Runs each query for the sampled pairs and returns the average time per query
+# in milliseconds
+def timeQueries(conn, queries, samplePairs):
+    results = {}
+    for name, query in queries.items():
+        startTime = time.perf_counter()
+        for serverID, userID in samplePairs:
+            if "serverID=? AND userID=?" in query:
+                conn.execute(query, (serverID, userID)).fetchall()
+            else:
+                conn.execute(query, (userID, serverID)).fetchall()
+        elapsed = time.perf_counter() - startTime
+        results[name] = round(elapsed / len(samplePairs) * 1000, 4)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type = int, default = 10_000_000)
+    parser.add_argument("--pairs", type = int, default = 100_000)
+    parser.add_argument("--samples", type = int, default = 50)
+    args = parser.parse_args()
+    random.seed(0)
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        conn = sqlite3.connect(os.path.join(tempDir, "bench.db"))
+        dbMigrations.createColorHistory(conn.cursor())
+        conn.execute("PRAGMA user_version = 1")
+        startTime = time.perf_counter()
+        rowCount = seedHistory(conn, args.rows, args.pairs)
+        print(f"Seeded {rowCount} rows in {time.perf_counter() - startTime:.1f}s")
+
+        samplePairs = []
+        for sample in range(args.samples):
+            pair = random.randrange(args.pairs)
+            samplePairs.append((1000 + pair % 100, 10 ** 17 + pair))
+
+        before = timeQueries(conn, oldQueries, samplePairs)
+        print(f"Before migrating (ms per query): {before}")
+        startTime = time.perf_counter()
+        dbMigrations.migrate(conn)
+        print(f"Migrated in {time.perf_counter() - startTime:.1f}s")
+        after = timeQueries(conn, newQueries, samplePairs)
+        print(f"After migrating (ms per query): {after}")
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+# Load test for the whole bot: runs the real coloriz.py cogs against the local
+# Discord stand-in in fakeDiscord.py and replays a mix of commands at them from
+# a number of simulated users at once, each of whom sends a command, waits for
+# the bot's reply and sends the next. Reports, as JSON, the throughput, the
+# latency (from the command's MESSAGE_CREATE to the bot's reply) and how many
+# Discord API calls each kind of command made.
+#
+# Each kind of command in the mix gets a phase of its own (so the API calls
+# can be put down to it), followed by a phase of the whole mix. The bot, the
+# stand-in and the simulated users all share one event loop, so the numbers
+# are a little pessimistic. The named colors are made up and the stats go to a
+# temporary database.
+#
+# Run from the repo root:
+#     python benchmarks/loadTest.py [--users 20] [--commands 500]
+#         [--mix set=60,random=10,clear=10,search=10,stats=10]
+#         [--rate-limit-chance 0.01] [--output results.json]
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+# The bot's modules live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import config
+import discord
+import fakeDiscord
+import yarl
+from suite import loadSyntheticColors, syllables
+
+defaultMix = "set=60,random=10,clear=10,search=10,stats=10"
+
+# Returns the text of a command of the given kind for the member to send
+def makeCommand(kind, prefix, guild, colorNames, randomizer):
+    if kind == "set":
+        roll = randomizer.random()
+        if roll < 0.7:
+            # Most people pick a color someone already has
+            roleNames = [role["name"] for role in guild.roles.values() if
+                         role["name"].startswith("#")]
+            return f"{prefix}color set {randomizer.choice(roleNames)}"
+        if roll < 0.85:
+            return f"{prefix}color set #{randomizer.randrange(1 << 24):06x}"
+        return f"{prefix}color set {randomizer.choice(colorNames)}"
+    if kind == "search":
+        return f"{prefix}color search {randomizer.choice(syllables)}"
+    if kind == "name":
+        return f"{prefix}color name #{randomizer.randrange(1 << 24):06x}"
+    if kind == "stats":
+        return f"{prefix}stats"
+    return f"{prefix}color {kind}"
+
+def parseMix(mixText):
+    mix = {}
+    for part in mixText.split(","):
+        kind, weight = part.split("=")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+def percentile(sortedValues, fraction):
+    if not sortedValues:
+        return None
+    index = min(len(sortedValues) - 1, int(len(sortedValues) * fraction))
+    return round(sortedValues[index] * 1000, 3)
+
+# Runs commandCount commands drawn from the mix, spread over the simulated
+# users, and returns the phase's results
+async def runPhase(server, guild, users, mix, commandCount, timeout, colorNames,
+                   randomizer):
+    prefix = config.getPrefix()
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    latencies = {kind: [] for kind in kinds}
+    timeouts = {kind: 0 for kind in kinds}
+    requestsBefore = server.requestCounts.copy()
+    rateLimitsBefore = server.rateLimitCounts.copy()
+    remaining = [commandCount]
+
+    async def simulateUser(userID, channelID):
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            kind = randomizer.choices(kinds, weights)[0]
+            content = makeCommand(kind, prefix, guild, colorNames, randomizer)
+            reply = server.waitForReply(channelID)
+            startTime = time.perf_counter()
+            await server.sendMessage(guild, channelID, userID, content)
+            try:
+                replyTime = await asyncio.wait_for(reply, timeout)
+            except asyncio.TimeoutError:
+                timeouts[kind] += 1
+                continue
+            latencies[kind].append(replyTime - startTime)
+
+    startTime = time.perf_counter()
+    await asyncio.gather(*(simulateUser(userID, channelID) for userID, channelID
+                           in users))
+    elapsed = time.perf_counter() - startTime
+
+    requests = server.requestCounts - requestsBefore
+    rateLimits = server.rateLimitCounts - rateLimitsBefore
+    # Logging in and the gateway aren't part of any command
+    requests.pop("GET /", None)
+    completed = sum(len(values) for values in latencies.values())
+    allLatencies = sorted(value for values in latencies.values() for value in
+                          values)
+    results = {
+        "commands": completed,
+        "timeouts": sum(timeouts.values()),
+        "seconds": round(elapsed, 3),
+        "commandsPerSecond": round(completed / elapsed, 2) if elapsed else None,
+        "latencyMs": {
+            "p50": percentile(allLatencies, 0.5),
+            "p95": percentile(allLatencies, 0.95),
+            "p99": percentile(allLatencies, 0.99),
+            "max": percentile(allLatencies, 1),
+        },
+        "apiCalls": dict(sorted(requests.items())),
+        "apiCallsPerCommand": round(sum(requests.values()) / completed, 3) if
+                              completed else None,
+        "rateLimited": dict(sorted(rateLimits.items())),
+        "byCommand": {},
+    }
+    for kind in kinds:
+        values = sorted(latencies[kind])
+        results["byCommand"][kind] = {
+            "commands": len(values),
+            "timeouts": timeouts[kind],
+            "p50Ms": percentile(values, 0.5),
+            "p95Ms": percentile(values, 0.95),
+            "p99Ms": percentile(values, 0.99),
+        }
+    return results
+
+async def runLoadTest(args, tempDir):
+    randomizer = random.Random(args.seed)
+    server = fakeDiscord.FakeDiscord(args.rate_limit_chance,
+                                     args.rate_limit_seconds, args.seed)
+    guild = server.addGuild(args.roles, args.members, channelCount = args.users)
+    restURL, gatewayURL = await server.start()
+    discord.http.Route.BASE = restURL
+    discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(gatewayURL)
+
+    # The bot itself, with its stats in the temporary directory and without a
+    # metrics server
+    config.config["Metrics"]["Port"] = "0"
+    import coloriz
+    import startupProfile
+    import stats
+    stats.dbPath = os.path.join(tempDir, "loadtest.db")
+    colorNames = loadSyntheticColors(args.colors, randomizer)
+    coloriz.bot.setup_hook = coloriz.setup
+    coloriz.loginTime = startupProfile.sinceStart()
+    botTask = asyncio.create_task(coloriz.bot.start("load-test-token"))
+    await asyncio.wait_for(coloriz.bot.wait_until_ready(), 60)
+
+    memberIDs = [userID for userID in guild.members if userID !=
+                 server.botUser["id"]]
+    users = list(zip(randomizer.sample(memberIDs, args.users),
+                     [channel["id"] for channel in guild.channels]))
+    mix = parseMix(args.mix)
+    phases = {}
+    for kind in mix:
+        print(f"Running {kind}...", file = sys.stderr)
+        phases[kind] = await runPhase(server, guild, users, {kind: 1},
+                                      args.commands, args.timeout, colorNames,
+                                      randomizer)
+    print("Running mix...", file = sys.stderr)
+    phases["mix"] = await runPhase(server, guild, users, mix, args.commands,
+                                   args.timeout, colorNames, randomizer)
+
+    await coloriz.bot.close()
+    await botTask
+    await asyncio.to_thread(stats.close)
+    await server.stop()
+    return phases
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type = int, default = 20,
+                        help = "how many simulated users send commands at once")
+    parser.add_argument("--commands", type = int, default = 500,
+                        help = "how many commands to send in each phase")
+    parser.add_argument("--mix", default = defaultMix,
+                        help = "kinds of command and their weights")
+    parser.add_argument("--members", type = int, default = 5_000)
+    parser.add_argument("--roles", type = int, default = 250)
+    parser.add_argument("--colors", type = int, default = 30_000,
+                        help = "how many named colors to make up")
+    parser.add_argument("--rate-limit-chance", type = float, default = 0.01,
+                        help = "share of requests answered with a 429")
+    parser.add_argument("--rate-limit-seconds", type = float, default = 0.05)
+    parser.add_argument("--timeout", type = float, default = 30,
+                        help = "seconds to wait for a reply before giving up")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    # Anything the bot prints goes to stderr, so stdout is just the JSON
+    with tempfile.TemporaryDirectory() as tempDir:
+        with contextlib.redirect_stdout(sys.stderr):
+            phases = asyncio.run(runLoadTest(args, tempDir))
+
+    report = {
+        "createdAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "discordPy": discord.__version__,
+        "parameters": vars(args),
+        "phases": phases,
+    }
+    output = json.dumps(report, indent = 2)
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            outputFile.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
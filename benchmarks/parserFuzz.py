@@ -0,0 +1,218 @@
+# Checks and times colorParser.py. Three parts:
+#     corpus      every input in colorInputs.json must give its expected color,
+#                 "name" (looked up as a color name) or error (problem code)
+#     fuzz        random inputs, both made from scratch and made by mangling
+#                 the corpus, must only ever give a valid color, None or a
+#                 ColorParseError, and exactly what the tokenizer alone
+#                 (parseTokens()) gives, so the fast paths can't drift from
+#                 it; colors written out in each format must parse back to
+#                 themselves
+#     throughput  inputs parsed per second for each kind of input
+# Results are written as JSON; exits with 1 if any check failed.
+#
+# Run from the repo root:
+#     python benchmarks/parserFuzz.py [--fuzz 200000] [--iterations 100000]
+#         [--seed 0] [--output results.json]
+
+import argparse
+import colorsys
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+# The bot's modules live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import colorParser
+
+corpusPath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "colorInputs.json")
+
+# Characters the fuzzer builds inputs from, weighted towards ones the parser
+# treats specially
+fuzzAlphabet = "0123456789abcdefABCDEFghxyz#(),;/ %.+-_degrslvé@\t"
+
+# Parses the input and returns what the corpus would expect: a [red, green,
+# blue] list, "name", or the error's problem code
+def describeResult(text, parse = colorParser.parseColor):
+    try:
+        rgb = parse(text)
+    except colorParser.ColorParseError as parseError:
+        return parseError.problem
+    if rgb == None:
+        return "name"
+    return list(rgb)
+
+def checkCorpus(corpus):
+    failures = []
+    for entry in corpus:
+        for parse in (colorParser.parseColor, colorParser.parseTokens):
+            result = describeResult(entry["input"], parse)
+            if result != entry["expected"]:
+                failures.append({"input": entry["input"], "parser":
+                                 parse.__name__, "expected": entry["expected"],
+                                 "got": result})
+    return failures
+
+def mangle(text, randomizer):
+    characters = list(text)
+    for change in range(randomizer.randint(1, 3)):
+        action = randomizer.random()
+        position = randomizer.randint(0, len(characters))
+        if action < 0.4 or not characters:
+            characters.insert(position, randomizer.choice(fuzzAlphabet))
+        elif action < 0.7:
+            del characters[min(position, len(characters) - 1)]
+        else:
+            characters[min(position, len(characters) - 1)] = randomizer.choice(fuzzAlphabet)
+    return "".join(characters)
+
+# Returns what the parser made of the input: ("color", (red, green, blue)),
+# ("name", None) or ("error", (problem, position))
+def parseOutcome(text, parse):
+    try:
+        rgb = parse(text)
+    except colorParser.ColorParseError as parseError:
+        return "error", (parseError.problem, parseError.position)
+    if rgb == None:
+        return "name", None
+    return "color", rgb
+
+# Returns a problem with the parse of the input (as a string), or None if the
+# result was fine
+def fuzzOne(text):
+    try:
+        outcome = parseOutcome(text, colorParser.parseColor)
+        tokenOutcome = parseOutcome(text, colorParser.parseTokens)
+    except Exception as otherError:
+        return f"raised {type(otherError).__name__}: {otherError}"
+    if outcome != tokenOutcome:
+        return f"gave {outcome!r}, but the tokenizer gave {tokenOutcome!r}"
+    kind, detail = outcome
+    if kind == "error" and not 0 <= detail[1] <= len(text):
+        return f"error position {detail[1]} is outside the input"
+    if kind == "color" and (len(detail) != 3 or not all(type(value) == int and
+                                                        0 <= value <= 255 for
+                                                        value in detail)):
+        return f"gave {detail!r}"
+    return None
+
+# Writes the color out in every format and returns the ones which don't parse
+# back to it. HSL / HSV are allowed to be off by one in each channel from
+# rounding.
+def roundTrip(red, green, blue):
+    problems = []
+    exact = {
+        "hex": "#{:02x}{:02x}{:02x}".format(red, green, blue),
+        "rgb": f"rgb({red}, {green}, {blue})",
+        "triplet": f"{red} {green} {blue}",
+        "percent": f"rgb({red / 2.55:.4f}%, {green / 2.55:.4f}%, {blue / 2.55:.4f}%)",
+    }
+    if red >> 4 == red & 0xF and green >> 4 == green & 0xF and blue >> 4 == blue & 0xF:
+        exact["shortHex"] = "#{:x}{:x}{:x}".format(red & 0xF, green & 0xF, blue & 0xF)
+    for name, text in exact.items():
+        if colorParser.parseColor(text) != (red, green, blue):
+            problems.append(text)
+    hue, lightness, saturation = colorsys.rgb_to_hls(red / 255, green / 255, blue / 255)
+    hsvHue, hsvSaturation, value = colorsys.rgb_to_hsv(red / 255, green / 255, blue / 255)
+    close = {
+        "hsl": f"hsl({hue * 360:.3f}, {saturation * 100:.3f}%, {lightness * 100:.3f}%)",
+        "hsv": f"hsv({hsvHue * 360:.3f}deg, {hsvSaturation * 100:.3f}%, {value * 100:.3f}%)",
+    }
+    for name, text in close.items():
+        parsed = colorParser.parseColor(text)
+        if max(abs(got - wanted) for got, wanted in zip(parsed, (red, green, blue))) > 1:
+            problems.append(text)
+    return problems
+
+def runFuzz(corpus, fuzzCount, randomizer):
+    problems = []
+    for attempt in range(fuzzCount):
+        if attempt % 2:
+            text = mangle(randomizer.choice(corpus)["input"], randomizer)
+        else:
+            text = "".join(randomizer.choice(fuzzAlphabet) for character in
+                           range(randomizer.randint(0, 24)))
+        problem = fuzzOne(text)
+        if problem != None:
+            problems.append({"input": text, "problem": problem})
+    roundTripFailures = []
+    for attempt in range(fuzzCount // 10):
+        red, green, blue = (randomizer.randrange(256) for channel in range(3))
+        roundTripFailures.extend(roundTrip(red, green, blue))
+    return problems, roundTripFailures
+
+def timeParser(inputs, iterations):
+    inputCycle = inputs * (iterations // len(inputs) + 1)
+    parseColor = colorParser.parseColor
+    startTime = time.perf_counter()
+    for text in inputCycle[:iterations]:
+        try:
+            parseColor(text)
+        except colorParser.ColorParseError:
+            pass
+    elapsed = time.perf_counter() - startTime
+    return {"inputsPerSecond": round(iterations / elapsed),
+            "meanUs": round(elapsed / iterations * 1e6, 3)}
+
+def runThroughput(corpus, iterations, randomizer):
+    def randomRGB():
+        return [randomizer.randrange(256) for channel in range(3)]
+    inputs = {
+        "hex": ["#{:02x}{:02x}{:02x}".format(*randomRGB()) for sample in range(1000)],
+        "shortHex": ["#{:03x}".format(randomizer.randrange(1 << 12)) for sample in range(1000)],
+        "triplet": ["({}, {}, {})".format(*randomRGB()) for sample in range(1000)],
+        "rgbPercent": ["rgb({}%, {}%, {}%)".format(*(randomizer.randrange(101) for
+                                                   channel in range(3))) for sample in range(1000)],
+        "hsl": ["hsl({}, {}%, {}%)".format(randomizer.randrange(360), randomizer.randrange(101),
+                                            randomizer.randrange(101)) for sample in range(1000)],
+        "hsv": ["hsv({}deg, {}%, {}%)".format(randomizer.randrange(360), randomizer.randrange(101),
+                                               randomizer.randrange(101)) for sample in range(1000)],
+        "name": [entry["input"] for entry in corpus if entry["expected"] == "name"],
+        "error": [entry["input"] for entry in corpus if isinstance(entry["expected"], str)
+                  and entry["expected"] != "name"],
+    }
+    return {kind: timeParser(kindInputs, iterations) for kind, kindInputs in
+            inputs.items()}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fuzz", type = int, default = 200_000,
+                        help = "how many random inputs to try")
+    parser.add_argument("--iterations", type = int, default = 100_000,
+                        help = "how many inputs to time for each kind")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    randomizer = random.Random(args.seed)
+    with open(corpusPath) as corpusFile:
+        corpus = json.load(corpusFile)
+    corpusFailures = checkCorpus(corpus)
+    fuzzProblems, roundTripFailures = runFuzz(corpus, args.fuzz, randomizer)
+    report = {
+        "createdAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "corpus": {"inputs": len(corpus), "failures": corpusFailures},
+        # Only the first few of each, there could be a lot
+        "fuzz": {"inputs": args.fuzz, "problems": fuzzProblems[:20],
+                 "problemCount": len(fuzzProblems),
+                 "roundTripFailures": roundTripFailures[:20],
+                 "roundTripFailureCount": len(roundTripFailures)},
+        "throughput": runThroughput(corpus, args.iterations, randomizer),
+    }
+    passed = not (corpusFailures or fuzzProblems or roundTripFailures)
+    report["passed"] = passed
+    output = json.dumps(report, indent = 2, ensure_ascii = False)
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            outputFile.write(output + "\n")
+    else:
+        print(output)
+    sys.exit(0 if passed else 1)
+
+if __name__ == "__main__":
+    main()
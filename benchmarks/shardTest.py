@@ -0,0 +1,268 @@
+# End-to-end test of the sharded bot: runs sharding.py's launcher (a stats
+# writer process plus several shard processes, each the real coloriz.py)
+# against the local Discord stand-in in fakeDiscord.py, with servers spread
+# over every shard. Simulated users in every server change their colors at
+# the same time, then look up their stats, and the test checks that
+#     - every command was answered, by the shard the server is on
+#     - every color change reached the database, through the one writer
+#     - each shard's stats show the changes the writer committed for it, i.e.,
+#       the writer told it which cached stats to drop
+# and reports the results (and how long it all took) as JSON. Exits with 1 if
+# any check failed. Everything runs in a temporary directory with its own
+# config.ini and database.
+#
+# Run from the repo root:
+#     python benchmarks/shardTest.py [--shards 4] [--processes 2]
+#         [--guilds 8] [--users 16] [--commands 400] [--output results.json]
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import runpy
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+
+# The bot's modules live one directory up
+botDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, botDirectory)
+import config
+import discord
+import fakeDiscord
+import sharding
+import yarl
+
+testToken = "shard-test-token"
+
+# ================================ Shard Process ===============================
+# The launcher runs this file with --shard-process (and the shard arguments)
+# instead of coloriz.py, to point discord.py at the stand-in and make up the
+# named colors before running coloriz.py as usual.
+
+def runShardProcess(restURL, gatewayURL, colorCount, seed):
+    discord.http.Route.BASE = restURL
+    discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(gatewayURL)
+    from suite import loadSyntheticColors
+    loadSyntheticColors(colorCount, random.Random(seed))
+    colorizPath = os.path.join(botDirectory, "coloriz.py")
+    sys.argv = [colorizPath] + sys.argv[6:]
+    runpy.run_path(colorizPath, run_name = "__main__")
+
+# ==================================== Test ====================================
+
+def findFreePort():
+    with socket.socket() as freeSocket:
+        freeSocket.bind(("127.0.0.1", 0))
+        return freeSocket.getsockname()[1]
+
+# Writes a config.ini for the test to tempDir (the token the stand-in expects,
+# no metrics servers and a free port for the stats writer), along with the
+# command help
+def writeTestConfig(tempDir):
+    config.config["Bot"]["DiscordToken"] = testToken
+    config.config["Metrics"]["Port"] = "0"
+    config.config["Sharding"]["WriterPort"] = str(findFreePort())
+    with open(os.path.join(tempDir, "config.ini"), "w") as configFile:
+        config.config.write(configFile)
+    shutil.copy(os.path.join(botDirectory, "commandConfig.json"), tempDir)
+
+# Sends the command and waits for the bot's reply. Returns the reply's
+# message payload (if it was sent as JSON), or None if it timed out.
+async def sendCommand(server, guild, channelID, userID, content, timeout):
+    reply = server.waitForReply(channelID)
+    await server.sendMessage(guild, channelID, userID, content)
+    try:
+        await asyncio.wait_for(reply, timeout)
+    except asyncio.TimeoutError:
+        return None
+    return server.lastMessages.get(channelID, {})
+
+# Returns the value of the stats embed's field with the given name
+def getEmbedField(message, fieldName):
+    for embed in (message or {}).get("embeds", []):
+        for field in embed.get("fields", []):
+            if field["name"] == fieldName:
+                return field["value"]
+    return None
+
+# Waits until every server answers a command, i.e., every shard is connected
+# and its process has finished setting up
+async def waitForShards(server, users, timeout):
+    deadline = time.monotonic() + timeout
+    waiting = {guild.id: (guild, channelID, userID) for guild, userID,
+               channelID in users}
+    while waiting:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{len(waiting)} servers never answered")
+        for guildID, (guild, channelID, userID) in list(waiting.items()):
+            if await sendCommand(server, guild, channelID, userID,
+                                 f"{config.getPrefix()}stats", 2) != None:
+                del waiting[guildID]
+
+async def runShardTest(args, tempDir):
+    randomizer = random.Random(args.seed)
+    prefix = config.getPrefix()
+    server = fakeDiscord.FakeDiscord(seed = args.seed)
+    channelsPerGuild = -(-args.users // args.guilds)
+    guilds = []
+    for number in range(args.guilds):
+        # Consecutive values above the low 22 bits land on consecutive shards
+        guildID = str((1_000_000 + number) << 22)
+        guilds.append(server.addGuild(args.roles, args.members, channelCount =
+                                      channelsPerGuild, guildID = guildID))
+    restURL, gatewayURL = await server.start()
+
+    # Each simulated user has a channel of their own in one of the servers
+    users = []
+    for number in range(args.users):
+        guild = guilds[number % len(guilds)]
+        memberIDs = [userID for userID in guild.members if userID !=
+                     server.botUser["id"] and userID not in
+                     [user[1] for user in users]]
+        users.append((guild, randomizer.choice(memberIDs),
+                      guild.channels[number // len(guilds)]["id"]))
+
+    writeTestConfig(tempDir)
+    shardCommand = [sys.executable, os.path.abspath(__file__), "--shard-process",
+                    restURL, gatewayURL, str(args.colors), str(args.seed)]
+    launcher = sharding.Launcher(args.shards, args.processes, shardCommand,
+                                 tempDir, identifySeconds = 0)
+    launcherTask = asyncio.create_task(asyncio.to_thread(launcher.run))
+    results = {"shardRanges": [sharding.formatShards(shards) for shards in
+                               launcher.shardRanges]}
+    try:
+        startTime = time.perf_counter()
+        await waitForShards(server, users, args.startup_timeout)
+        results["startupSeconds"] = round(time.perf_counter() - startTime, 3)
+        results["identifiedShards"] = sorted(shard[0] for shard in
+                                             server.sockets.values() if shard)
+
+        # Everyone changes their color over and over, all at once
+        changeCounts = {(guild.id, userID): 0 for guild, userID, channelID in
+                        users}
+        remaining = [args.commands]
+        timeouts = [0]
+        latencies = []
+
+        async def simulateUser(guild, userID, channelID):
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                color = "#{:06x}".format(randomizer.randrange(1 << 24))
+                commandStart = time.perf_counter()
+                reply = await sendCommand(server, guild, channelID, userID,
+                                          f"{prefix}color set {color}",
+                                          args.timeout)
+                if reply == None:
+                    timeouts[0] += 1
+                    continue
+                latencies.append(time.perf_counter() - commandStart)
+                changeCounts[(guild.id, userID)] += 1
+
+        startTime = time.perf_counter()
+        await asyncio.gather(*(simulateUser(*user) for user in users))
+        elapsed = time.perf_counter() - startTime
+        latencies.sort()
+        results["colorSet"] = {
+            "commands": len(latencies),
+            "timeouts": timeouts[0],
+            "seconds": round(elapsed, 3),
+            "commandsPerSecond": round(len(latencies) / elapsed, 2),
+            "p50Ms": round(latencies[len(latencies) // 2] * 1000, 3) if
+                     latencies else None,
+            "p95Ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 3) if
+                     latencies else None,
+        }
+
+        # Give the writer a moment to commit the last group, then check each
+        # shard sees every change (their stats were cached by waitForShards()
+        # for some of these users, so a stale cache would show up here)
+        await asyncio.sleep(0.5)
+        staleStats = []
+        for guild, userID, channelID in users:
+            reply = await sendCommand(server, guild, channelID, userID,
+                                      f"{prefix}stats", args.timeout)
+            shownCount = getEmbedField(reply, "Color Changes")
+            expectedCount = changeCounts[(guild.id, userID)]
+            if expectedCount and shownCount != str(expectedCount):
+                staleStats.append({"guild": guild.id, "user": userID,
+                                   "shown": shownCount,
+                                   "expected": expectedCount})
+        results["staleStats"] = staleStats
+    finally:
+        launcher.stop()
+        await launcherTask
+        await server.stop()
+
+    # Once the writer has stopped, everything it was sent is in the database
+    conn = sqlite3.connect(os.path.join(tempDir, "coloriz.db"))
+    storedCounts = dict(((str(serverID), str(userID)), changeCount) for
+                        serverID, userID, changeCount in conn.execute(
+                            "SELECT serverID, userID, changeCount FROM userColorStats"))
+    conn.close()
+    missingChanges = []
+    for cacheKey, changeCount in changeCounts.items():
+        if storedCounts.get(cacheKey, 0) != changeCount:
+            missingChanges.append({"guild": cacheKey[0], "user": cacheKey[1],
+                                   "stored": storedCounts.get(cacheKey, 0),
+                                   "expected": changeCount})
+    results["missingChanges"] = missingChanges
+    results["passed"] = (results["identifiedShards"] == list(range(args.shards))
+                         and results["colorSet"]["timeouts"] == 0 and not
+                         staleStats and not missingChanges)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type = int, default = 4)
+    parser.add_argument("--processes", type = int, default = 2)
+    parser.add_argument("--guilds", type = int, default = 8)
+    parser.add_argument("--members", type = int, default = 200)
+    parser.add_argument("--roles", type = int, default = 50)
+    parser.add_argument("--colors", type = int, default = 3_000,
+                        help = "how many named colors to make up")
+    parser.add_argument("--users", type = int, default = 16,
+                        help = "how many simulated users change colors at once")
+    parser.add_argument("--commands", type = int, default = 400,
+                        help = "how many color changes to make in all")
+    parser.add_argument("--timeout", type = float, default = 30,
+                        help = "seconds to wait for a reply before giving up")
+    parser.add_argument("--startup-timeout", type = float, default = 120)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    # Everything the launched processes print goes to stderr, so stdout is
+    # just the JSON
+    jsonOutput = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    with tempfile.TemporaryDirectory() as tempDir:
+        results = asyncio.run(runShardTest(args, tempDir))
+
+    report = {
+        "createdAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "discordPy": discord.__version__,
+        "parameters": vars(args),
+        "results": results,
+    }
+    output = json.dumps(report, indent = 2)
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            outputFile.write(output + "\n")
+    else:
+        jsonOutput.write(output + "\n")
+        jsonOutput.flush()
+    sys.exit(0 if results["passed"] else 1)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--shard-process":
+        runShardProcess(sys.argv[2], sys.argv[3], int(sys.argv[4]),
+                        int(sys.argv[5]))
+    else:
+        main()
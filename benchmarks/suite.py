@@ -0,0 +1,403 @@
+# Micro-benchmarks for the bot's hot paths, run entirely offline: color parsing,
+# color set from start to finish, named color lookups and searches, assigning
+# colors in a big guild, and the stats queries. Discord is replaced by the
+# stand-ins in fakes.py, the named colors are made up, and the database is a
+# temporary one seeded with made up history, so this never touches the bot's
+# own coloriz.db or the network. Results are written as JSON so runs can be
+# compared.
+#
+# Run from the repo root:
+#     python benchmarks/suite.py [--colors 30000] [--roles 250]
+#         [--members 100000] [--history 50000] [--iterations 2000]
+#         [--only search] [--output results.json]
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# The bot's modules live one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import botCommands
+import colorCommands
+import colorParser
+import fakes
+import namedColors
+import roleIndex
+import roleScheduler
+import searchResults
+import stats
+
+# =============================== Synthetic Data ===============================
+
+syllables = ["am", "ber", "co", "ral", "da", "wn", "e", "me", "ra", "ld", "fo",
+             "rest", "gla", "cier", "ha", "ze", "i", "vo", "ry", "ja", "de",
+             "la", "va", "mi", "st", "no", "ir", "o", "pal", "pe", "ach", "qu",
+             "artz", "ro", "se", "sa", "ge", "te", "al", "um", "ber", "vi",
+             "o", "let", "wi", "ne", "xa", "nth", "yel", "low", "zi", "nc"]
+
+# Makes up colorCount unique color names of one to three words, each with a
+# random hex code, and loads them as the named colors. Returns the names.
+def loadSyntheticColors(colorCount, randomizer):
+    words = set()
+    while len(words) < max(50, colorCount // 20):
+        syllableCount = randomizer.randint(2, 4)
+        words.add("".join(randomizer.choice(syllables) for syllable in
+                          range(syllableCount)).capitalize())
+    words = sorted(words)
+    names = set()
+    while len(names) < colorCount:
+        wordCount = randomizer.choice([1, 2, 2, 3])
+        names.add(" ".join(randomizer.choice(words) for word in
+                           range(wordCount)))
+    rows = sorted((name.lower(), name, "#{:06x}".format(randomizer.randrange(1 << 24)))
+                  for name in names)
+    keys = [row[0] for row in rows]
+    names = [row[1] for row in rows]
+    hexes = [row[2] for row in rows]
+    namedColors.loadNamedColors(names, keys, hexes)
+    # Don't let the first lookup load the real snapshot over these
+    namedColors.loaded = True
+    return names
+
+# Points stats.py at a new database in tempDir, and fills it with historyRows
+# color changes spread over userCount users of the guild (through the same
+# writeStats() the bot uses, so the rollup tables match). Returns the users'
+# IDs.
+def seedStats(tempDir, guild, historyRows, userCount, randomizer):
+    stats.dbPath = os.path.join(tempDir, "bench.db")
+    conn = stats.openConnection()
+    curs = conn.cursor()
+    members = guild.members[1:userCount + 1]
+    timestamps = {member.id: 1_600_000_000 for member in members}
+    for row in range(historyRows):
+        member = members[row % len(members)]
+        timestamps[member.id] += randomizer.randint(60, 10 ** 6)
+        color = "#{:06X}".format(randomizer.randrange(1 << 24))
+        stats.writeStats(curs, member.id, guild.id, color, timestamps[member.id])
+    conn.commit()
+    conn.close()
+    return [member.id for member in members]
+
+# ================================== Timing ====================================
+
+# Times each call of function (made iterations times, after a few warm up
+# calls), returning the per-call statistics in microseconds
+def timeCalls(function, iterations, warmup = 10):
+    for call in range(min(warmup, iterations)):
+        function()
+    timings = []
+    for call in range(iterations):
+        startTime = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - startTime)
+    return summarize(timings)
+
+# The same for a coroutine function, with every call awaited on one loop
+def timeAsyncCalls(function, iterations, warmup = 10):
+    async def timeAll():
+        for call in range(min(warmup, iterations)):
+            await function()
+        timings = []
+        for call in range(iterations):
+            startTime = time.perf_counter()
+            await function()
+            timings.append(time.perf_counter() - startTime)
+        return timings
+    return summarize(asyncio.run(timeAll()))
+
+def summarize(timings):
+    timings.sort()
+    def percentile(fraction):
+        return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+    return {
+        "iterations": len(timings),
+        "meanUs": round(statistics.fmean(timings) * 1e6, 3),
+        "minUs": round(timings[0] * 1e6, 3),
+        "p50Us": round(percentile(0.5) * 1e6, 3),
+        "p95Us": round(percentile(0.95) * 1e6, 3),
+        "maxUs": round(timings[-1] * 1e6, 3),
+    }
+
+# ================================= Benchmarks =================================
+# Each benchmark takes the shared setup (see main()) and returns its timings.
+# Anything random is drawn from setup["random"], so runs are repeatable.
+
+def benchParseHex(setup):
+    randomizer = setup["random"]
+    inputs = ["#{:06x}".format(randomizer.randrange(1 << 24)) for sample in
+              range(1000)]
+    inputCycle = iter(inputs * (setup["iterations"] // 1000 + 2))
+    return timeCalls(lambda: colorParser.parseColor(next(inputCycle)),
+                     setup["iterations"])
+
+def benchParseRGB(setup):
+    randomizer = setup["random"]
+    inputs = [f"({randomizer.randrange(256)}, {randomizer.randrange(256)}, "
+              f"{randomizer.randrange(256)})" for sample in range(1000)]
+    inputCycle = iter(inputs * (setup["iterations"] // 1000 + 2))
+    return timeCalls(lambda: colorParser.parseColor(next(inputCycle)),
+                     setup["iterations"])
+
+# The formats which need more than integer parsing: short hex, percentages
+# and HSL / HSV
+def benchParseFormats(setup):
+    randomizer = setup["random"]
+    inputs = []
+    for sample in range(1000):
+        kind = sample % 4
+        if kind == 0:
+            inputs.append("#{:03x}".format(randomizer.randrange(1 << 12)))
+        elif kind == 1:
+            inputs.append(f"rgb({randomizer.randrange(101)}%, {randomizer.randrange(101)}%, "
+                          f"{randomizer.randrange(101)}%)")
+        elif kind == 2:
+            inputs.append(f"hsl({randomizer.randrange(360)}, {randomizer.randrange(101)}%, "
+                          f"{randomizer.randrange(101)}%)")
+        else:
+            inputs.append(f"hsv({randomizer.randrange(360)}deg, {randomizer.randrange(101)}%, "
+                          f"{randomizer.randrange(101)}%)")
+    inputCycle = iter(inputs * (setup["iterations"] // 1000 + 2))
+    return timeCalls(lambda: colorParser.parseColor(next(inputCycle)),
+                     setup["iterations"])
+
+# parseColor() working out which parser to hand a mix of inputs to
+def benchParseColor(setup):
+    randomizer = setup["random"]
+    names = setup["colorNames"]
+    inputs = []
+    for sample in range(1000):
+        kind = sample % 3
+        if kind == 0:
+            inputs.append("#{:06x}".format(randomizer.randrange(1 << 24)))
+        elif kind == 1:
+            inputs.append(f"{randomizer.randrange(256)} {randomizer.randrange(256)} "
+                          f"{randomizer.randrange(256)}")
+        else:
+            inputs.append(randomizer.choice(names))
+    inputCycle = iter(inputs * (setup["iterations"] // 1000 + 2))
+    return timeCalls(lambda: botCommands.parseColor(next(inputCycle)),
+                     setup["iterations"])
+
+def benchFindNamedColorHex(setup):
+    randomizer = setup["random"]
+    keys = [name.lower() for name in randomizer.sample(setup["colorNames"],
+                                                        min(1000, len(setup["colorNames"])))]
+    keyCycle = iter(keys * (setup["iterations"] // len(keys) + 2))
+    return timeCalls(lambda: namedColors.findNamedColorHex(next(keyCycle)),
+                     setup["iterations"])
+
+# Misspelled names, which have to go through the typo index
+def benchFindCorrectedNamedColorHex(setup):
+    randomizer = setup["random"]
+    typos = []
+    for name in randomizer.sample(setup["colorNames"], min(1000, len(setup["colorNames"]))):
+        key = name.lower()
+        position = randomizer.randrange(len(key))
+        typos.append(key[:position] + key[position + 1:])
+    typoCycle = iter(typos * (setup["iterations"] // len(typos) + 2))
+    def correct():
+        try:
+            namedColors.findCorrectedNamedColorHex(next(typoCycle))
+        except NameError:
+            pass
+    return timeCalls(correct, setup["iterations"])
+
+def benchSearchNamedColorPositions(setup):
+    randomizer = setup["random"]
+    terms = [randomizer.choice(syllables) + randomizer.choice(syllables) for
+             sample in range(200)] + list(syllables)
+    termCycle = iter(terms * (setup["iterations"] // len(terms) + 2))
+    return timeCalls(lambda: namedColors.searchNamedColorPositions(next(termCycle)),
+                     setup["iterations"])
+
+# color search as users page through it: every fifth call is a new search,
+# and the rest are other pages of it, out of the result cache
+def benchColorSearchPages(setup):
+    randomizer = setup["random"]
+    terms = [randomizer.choice(syllables) for sample in range(200)]
+    searchState = {"calls": 0, "result": None}
+    def page():
+        if searchState["calls"] % 5 == 0:
+            searchState["result"] = searchResults.search(randomizer.randrange(100),
+                                                         randomizer.choice(terms))
+        searchState["calls"] += 1
+        result = searchState["result"]
+        searchResults.formatPage(result, randomizer.randrange(searchResults.getPageCount(result)))
+    return timeCalls(page, setup["iterations"])
+
+def benchNearestNamedColor(setup):
+    randomizer = setup["random"]
+    return timeCalls(lambda: namedColors.findNearestNamedColor(randomizer.randrange(256),
+                                                               randomizer.randrange(256),
+                                                               randomizer.randrange(256)),
+                     setup["iterations"])
+
+# Building a guild's color role index, which walks every role and member
+def benchRebuildRoleIndex(setup):
+    guild = setup["guild"]
+    return timeCalls(lambda: roleIndex.rebuildIndex(guild),
+                     max(5, setup["iterations"] // 200), warmup = 1)
+
+# assignColor() with colors that already have a role, so it's the lookups
+# and role swaps (through the scheduler) without creating anything
+def benchAssignColor(setup):
+    guild = setup["guild"]
+    randomizer = setup["random"]
+    roleIndex.rebuildIndex(guild)
+    colorRoles = roleIndex.getColorRoles(guild)
+    members = guild.members[1:]
+    async def assign():
+        member = randomizer.choice(members)
+        role = randomizer.choice(colorRoles)
+        ctx = fakes.FakeContext(guild, member)
+        await colorCommands.assignColor(ctx, int(role.name[1:3], 16),
+                                        int(role.name[3:5], 16),
+                                        int(role.name[5:7], 16))
+    return timeAsyncCalls(assign, setup["iterations"])
+
+# The whole of color set: parsing, assigning, queueing the stats write and
+# building the reply
+def benchColorSet(setup):
+    guild = setup["guild"]
+    randomizer = setup["random"]
+    roleIndex.rebuildIndex(guild)
+    colorRoles = roleIndex.getColorRoles(guild)
+    members = guild.members[1:]
+    async def colorSet():
+        member = randomizer.choice(members)
+        ctx = fakes.FakeContext(guild, member)
+        await botCommands.colorSet(ctx, [randomizer.choice(colorRoles).name])
+    timings = timeAsyncCalls(colorSet, setup["iterations"])
+    stats.flush()
+    return timings
+
+def benchReadUserStats(setup):
+    randomizer = setup["random"]
+    guildID = setup["guild"].id
+    userIDs = setup["statsUsers"]
+    return timeCalls(lambda: stats.readUserStats(randomizer.choice(userIDs),
+                                                 guildID),
+                     setup["iterations"])
+
+def benchFetchUserStatsCached(setup):
+    randomizer = setup["random"]
+    guildID = setup["guild"].id
+    userIDs = setup["statsUsers"][:100]
+    return timeCalls(lambda: stats.fetchUserStats(randomizer.choice(userIDs),
+                                                  guildID),
+                     setup["iterations"])
+
+def benchFetchServerStats(setup):
+    guildID = setup["guild"].id
+    return timeCalls(lambda: stats.fetchServerStats(guildID),
+                     max(10, setup["iterations"] // 10))
+
+# Writing one color change and committing it, on a connection of its own
+# (through recordStats() this would mostly be time spent waiting out the
+# writer's group commit window)
+def benchWriteStats(setup):
+    guildID = setup["guild"].id
+    randomizer = setup["random"]
+    userIDs = setup["statsUsers"]
+    conn = stats.openConnection()
+    curs = conn.cursor()
+    def write():
+        stats.writeStats(curs, randomizer.choice(userIDs), guildID,
+                         "#{:06X}".format(randomizer.randrange(1 << 24)),
+                         int(time.time()))
+        conn.commit()
+    timings = timeCalls(write, max(10, setup["iterations"] // 10))
+    conn.close()
+    return timings
+
+benchmarks = {
+    "parseHex": benchParseHex,
+    "parseRGB": benchParseRGB,
+    "parseFormats": benchParseFormats,
+    "parseColor": benchParseColor,
+    "findNamedColorHex": benchFindNamedColorHex,
+    "findCorrectedNamedColorHex": benchFindCorrectedNamedColorHex,
+    "searchNamedColorPositions": benchSearchNamedColorPositions,
+    "colorSearchPages": benchColorSearchPages,
+    "findNearestNamedColor": benchNearestNamedColor,
+    "rebuildRoleIndex": benchRebuildRoleIndex,
+    "assignColor": benchAssignColor,
+    "colorSet": benchColorSet,
+    "readUserStats": benchReadUserStats,
+    "fetchUserStatsCached": benchFetchUserStatsCached,
+    "fetchServerStats": benchFetchServerStats,
+    "writeStats": benchWriteStats,
+}
+
+# ==============================================================================
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--colors", type = int, default = 30_000,
+                        help = "how many named colors to make up")
+    parser.add_argument("--roles", type = int, default = 250,
+                        help = "how many color roles the guild has")
+    parser.add_argument("--members", type = int, default = 100_000,
+                        help = "how many members the guild has")
+    parser.add_argument("--history", type = int, default = 50_000,
+                        help = "how many color changes to seed the database with")
+    parser.add_argument("--stats-users", type = int, default = 5_000,
+                        help = "how many members the history is spread over")
+    parser.add_argument("--iterations", type = int, default = 2_000)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--only", action = "append", default = [],
+                        help = "only run benchmarks whose name contains this")
+    parser.add_argument("--output", help = "write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    # New roles would otherwise wait to be moved in a batch
+    roleScheduler.positionBatchDelay = 0
+    randomizer = random.Random(args.seed)
+    setup = {"random": randomizer, "iterations": args.iterations}
+    setupTimes = {}
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        startTime = time.perf_counter()
+        setup["colorNames"] = loadSyntheticColors(args.colors, randomizer)
+        setupTimes["loadColors"] = round(time.perf_counter() - startTime, 3)
+        startTime = time.perf_counter()
+        setup["guild"] = fakes.makeGuild(args.roles, args.members, seed = args.seed)
+        setupTimes["makeGuild"] = round(time.perf_counter() - startTime, 3)
+        startTime = time.perf_counter()
+        setup["statsUsers"] = seedStats(tempDir, setup["guild"], args.history,
+                                        min(args.stats_users, args.members),
+                                        randomizer)
+        setupTimes["seedStats"] = round(time.perf_counter() - startTime, 3)
+
+        results = {}
+        for name, benchmark in benchmarks.items():
+            if args.only and not any(only in name for only in args.only):
+                continue
+            print(f"Running {name}...", file = sys.stderr)
+            results[name] = benchmark(setup)
+        stats.close()
+
+    report = {
+        "createdAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "setupSeconds": setupTimes,
+        "results": results,
+    }
+    output = json.dumps(report, indent = 2)
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            outputFile.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
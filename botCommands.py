@@ -1,10 +1,10 @@
 # Python Modules
-import re
-import time
 # Third-Party Modules
 # Custom Modules
 import colorCommands
+import colorParser
 import namedColors
+import searchResults
 import stats
 # All commands (and their necessary functions) for the coloriz bot
 
@@ -23,95 +23,92 @@ def hexToRGB(hexValue):
 
 # =============================== Color Commands ===============================
 
-# parseHex() parses a user's hex input into three integers. It checks to make
-# sure it is a valid hex code and converts it to an RGB triplet (via hexToRGB())
-# in the form of three values returned: red, green, blue. If it's not a valid
-# hex code, raise an error with some relevant information.
-def parseHex(hexInput):
-    # Pattern to find exactly six digits or lower- and uppercase characters A-F
-    hexPattern = "#[0-9,a-f,A-F]{6,6}"
-    hexSearch = re.search(hexPattern, hexInput)
-    if hexSearch == None:
-        raise ValueError(f"{hexInput} is not a valid hex code")
-    else:
-        return hexToRGB(hexSearch.group())
+# parseColor() parses a user's input as a hex code, an RGB, HSL or HSV color
+# (see colorParser.py), or a named color, and returns the red, green, and blue
+# values (in order), along with the name a misspelled color name was corrected
+# to (None if it wasn't). If it can't be parsed, the ColorParseError (a
+# ValueError) or NameError is raised; it can be printed out by the bot as a
+# message to the user.
+def parseColor(arguments):
+    rgb = colorParser.parseColor(arguments)
+    # If it isn't any of the color formats, it's a name
+    if rgb == None:
+        return colorCommands.colorByName(arguments)
+    red, green, blue = rgb
+    return red, green, blue, None
 
-# parseRGB() parses a user's input into three integers. It checks to makes sure
-# the triplet is well-formed and within bounds [0,255]. If everything checks out,
-# the red, green, and blue values are returned (in order); if not, errors with
-# appropriate messages for the user are raised.
-def parseRGB(rgbInput):
-    # We want to mach three numbers, each with 1-3 digits.  They might be
-    # separated by spaces, commas, or a mix of both. The digitPattern is used to
-    # match one number at a time, utilizing re.findall(), which returns a list
-    # of all the found values.  The pattern means: "find 1-3 instances of a
-    # digit."
-    numPattern = r"[\d]{1,3}"
-    result = re.findall(numPattern, rgbInput)
-    # Check that ONLY three numbers were found.
-    if len(result)  != 3:
-        raise ValueError("An RGB triplet should only have three integers")
-    # Check the results to make sure they're valid RGB values [0,255].
-    for value in result:
-        if not 0 <= int(value) <= 255:
-            raise ValueError("RGB values must be between 0 and 255")
-    red, green, blue = int(result[0]), int(result[1]), int(result[2])
-    return red, green, blue
+# Returns a short description of the named color closest to the given one, to
+# tack onto replies, e.g., "(closest named color: **Forest Green**)". If there
+# are no named colors loaded, this is empty.
+def describeNearestName(red, green, blue):
+    try:
+        name, colorHex, distance = namedColors.findNearestNamedColor(red, green,
+                                                                     blue)
+    except NameError:
+        return ""
+    if distance < 0.5:
+        return f" (**{name}**)"
+    return f" (closest named color: **{name}**)"
 
-# colorSet() sets a user's color based of a given hex code, RGB triplet, or a
-# named color. Parsing is all done here, not in coloriz.py. Returns a string of
-# the color assigned or raises an error with relevant info on what went wrong;
-# this error can be printed out by the bot as a message to the user.
+# colorSet() sets a user's color based of a given hex code, RGB / HSL / HSV
+# color, or a named color. Parsing is all done here, not in coloriz.py. Returns a string of
+# the color assigned and its hex code (for the swatch), or an error with
+# relevant info on what went wrong and None; this error can be printed out by
+# the bot as a message to the user.
 async def colorSet(ctx, args):
-    # Combine the arguments into one string so it can easily be parsed with
-    # regex. Remove trailing / leading whitespace after combining.
-    arguments = ""
-    for arg in args:
-        arguments += f"{arg} "
-    arguments = arguments.strip()
-    # This pattern is used to check if there are at least two sets of numbers
-    # separated by non-numeric characters. If there are, then we can be pretty
-    # confident that it is not a named color and parseRGB() can be called. Thus,
-    # we can return any errors thrown by parseRGB().
-    rgbPattern = r"[\D]*[0-9]{1,}[\D]{1,}[0-9]{1,}[\D]*[0-9]{1,}[\D]*"
-    # If it starts with a '#', try to parse it as a hex code. If not, check if
-    # it could be a valid RGB triplet with the above regex pattern. If it's not,
-    # then see if it's a named color.
-    if arguments.startswith("#"):
-        try:
-            red, green, blue = parseHex(arguments)
-        except ValueError as hexError:
-            return hexError
-    elif re.search(rgbPattern, arguments):
-        try:
-            red, green, blue = parseRGB(arguments)
-        except ValueError as rgbError:
-            return rgbError
-    else:
-        try:
-            red, green, blue = colorCommands.colorByName(arguments)
-        except NameError as colorNameError:
-            return colorNameError
-    color = await colorCommands.assignColor(ctx, red, green, blue)
+    # Combine the arguments into one string so it can be parsed in one go
+    arguments = " ".join(args).strip()
+    try:
+        red, green, blue, correctedName = parseColor(arguments)
+    except (ValueError, NameError) as colorError:
+        return colorError, None
+    color, snapped = await colorCommands.assignColor(ctx, red, green, blue)
+    # A color clear queued after this one overtook it; the clear records itself
+    if color == None:
+        return "Your color was cleared before it could be set", None
     stats.recordStats(ctx, str(color))
-    return f"Your color is **{str(color)}**"
+    nearestName = describeNearestName(color.r, color.g, color.b)
+    setMessage = f"Your color is **{str(color)}**{nearestName}"
+    # If an existing role was close enough to use instead, say so
+    if snapped:
+        requestedHex = "#{:02x}{:02x}{:02x}".format(red, green, blue)
+        setMessage += f"\n(**{requestedHex}** is close enough to an existing color role that you were given that one instead)"
+    # If the name was misspelled, let the user know what it was taken to be
+    if correctedName != None:
+        setMessage = f"Couldn't find \"{arguments}\", using **{correctedName}** instead.\n{setMessage}"
+    return setMessage, str(color)
+
+# colorName() finds the named color which looks closest to a given hex code or
+# RGB / HSL / HSV color and returns a string saying what it is and how far off it is.
+async def colorName(ctx, args):
+    arguments = " ".join(args).strip()
+    try:
+        red, green, blue, correctedName = parseColor(arguments)
+    except (ValueError, NameError) as colorError:
+        return colorError
+    try:
+        name, colorHex, distance = namedColors.findNearestNamedColor(red, green,
+                                                                     blue)
+    except NameError as nameError:
+        return nameError
+    givenHex = "#{:02x}{:02x}{:02x}".format(red, green, blue)
+    if distance < 0.5:
+        return f"**{givenHex}** is **{name}**"
+    return f"The closest named color to **{givenHex}** is **{name}** ({colorHex}, ΔE {distance:.1f})"
 
+# colorSearch() searches the named colors for the given string. Returns a string
+# listing the first page of matches, the hex codes of the top few for a palette
+# strip (None if nothing matched), and the buttons for paging through the rest
+# (None if they all fit on one page).
 async def colorSearch(ctx, args):
-    arguments = ""
-    for arg in args:
-        arguments += f"{arg} "
-    arguments = arguments.strip()
-    startTime = time.time()
-    matches = namedColors.searchNamedColors(arguments)
-    endTime = time.time()
-    timeTaken = "{:.4}".format(endTime - startTime)
-    returnString = f"Found {len(matches)} Colors in {timeTaken}s:\n```"
-    for match in matches[0:50]:
-        returnString += f"- {match}\n"
-    if len(matches) > 50:
-        returnString += "Only showing first 50 colors..."
-    returnString += "```"
-    return returnString
+    arguments = " ".join(args).strip()
+    userID = ctx.message.author.id
+    result = searchResults.search(userID, arguments)
+    returnString, paletteHexes = searchResults.formatPage(result, 0)
+    pagesView = None
+    if searchResults.getPageCount(result) > 1:
+        pagesView = searchResults.SearchPages(userID, result)
+    return returnString, paletteHexes, pagesView
 
 # colorRandom() sets a user's color to a completely random color. It takes no
 # arguments other than the ctx and returns a string that states what the user's
@@ -120,7 +117,9 @@ async def colorRandom(ctx):
     # Get three random integers between [0.255] and assign the user's color with
     # them.
     red, green, blue = colorCommands.randomColor()
-    color = await colorCommands.assignColor(ctx, red, green, blue)
+    color, snapped = await colorCommands.assignColor(ctx, red, green, blue)
+    if color == None:
+        return "Your color was cleared before it could be set"
     stats.recordStats(ctx, str(color))
     return f"Your color is **{str(color)}**"
 
@@ -131,4 +130,25 @@ async def colorClear(ctx):
     stats.recordStats(ctx, None)
     return "Your color role has been cleared"
 
+# =============================== Sudo Commands ================================
+
+# parsePaletteArguments() reads what comes after sudo palette's target:
+# nothing or "distinct" for colors as different from each other as possible,
+# or "gradient" and the two colors to run between (in any format color set
+# takes; ones with spaces in them need quotes). Returns None for distinct
+# colors, or the gradient's two (red, green, blue) ends. Raises a ValueError
+# or NameError, which can be printed out to the user, if they don't make sense.
+def parsePaletteArguments(args):
+    mode = args[0].lower() if len(args) > 0 else "distinct"
+    if mode == "distinct" and len(args) <= 1:
+        return None
+    if mode == "gradient" and len(args) == 3:
+        gradientEnds = []
+        for arguments in args[1:]:
+            red, green, blue, correctedName = parseColor(arguments.strip())
+            gradientEnds.append((red, green, blue))
+        return gradientEnds
+    raise ValueError("Give either ``distinct``, or ``gradient`` followed by "
+                     "two colors, e.g., ``gradient #ff0000 #0000ff``")
+
 # ==============================================================================
@@ -1,81 +1,352 @@
+import asyncio
+import collections
+import colorSpace
 import csv
 import random
+import time
 import discord
 import botCommands
+import config
 import namedColors
+import roleIndex
+import roleScheduler
+import stats
 
 # Returns the index position of the Bots top role in the guild's list of roles
-def getBotTopRoleNum(ctx):
-    botMember = ctx.guild.me
+def getBotTopRoleNum(guild):
+    botMember = guild.me
     botRoles = botMember.roles
     topBotRole = botRoles[len(botRoles) - 1]
-    return ctx.guild.roles.index(topBotRole)
+    return guild.roles.index(topBotRole)
 
 
+# Sets the user's color role to the given color. The change is handed to the
+# role scheduler, which might merge it with other changes the user asked for
+# in the meantime, so this returns the color the user ends up with (and
+# whether it was snapped to an existing role) once it's in place. If they
+# cleared their color in the meantime, that's (None, False).
 async def assignColor(ctx, red, green, blue):
     color = discord.Color.from_rgb(int(red), int(green), int(blue))
     user = ctx.message.author
-    topRole = user.top_role
-    for role in user.roles:
-        if str(role).startswith("#"):
-            await user.remove_roles(role)
-            break
-    needsNewRole = True
-    for role in ctx.guild.roles:
-        if role.name == str(color):
-            print(f"{role.name} is {str(color)}")
-            await user.add_roles(role)
-            needsNewRole = False
-            break
-
-    if needsNewRole:
-        role = await ctx.guild.create_role(name = str(color), color = color)
-        await user.add_roles(role)
-        # The top color role will be the one directly under the bot's own top role
-        topColorRoleNum = getBotTopRoleNum(ctx) - 1
-        try:
-            await ctx.guild.edit_role_positions(positions = {role: topColorRoleNum})
-        except:
-            await ctx.send(f"Something went wrong moving {str(color)} to position {topColorRoleNum}")
-    return color
+    return await roleScheduler.setColor(ctx.guild, user, color)
 
+# Does the actual work of changing a member's color role: swaps their old color
+# role for the one for the given color (or just removes it if color is None),
+# creating the role if it doesn't exist yet. Only called by the role scheduler.
+# Returns the color the member was given and whether it was snapped to a close
+# existing role.
+async def applyColor(guild, user, color):
+    callDiscord = roleScheduler.callDiscord
+    oldRole = roleIndex.getMemberColorRole(guild, user)
+    if oldRole != None:
+        await callDiscord(lambda: user.remove_roles(oldRole), "remove_roles")
+        roleIndex.setMemberColorRole(guild, user, None)
+    if color == None:
+        return None, False
+    role = roleIndex.findColorRole(guild, str(color))
+    snapped = False
+    # If there's no role for this exact color, an existing one might be close
+    # enough that nobody could tell the difference; use that one instead of
+    # making a new role
+    snapThreshold = config.getSnapThreshold(guild.id)
+    if role == None and snapThreshold > 0:
+        role = roleIndex.findNearestColorRole(guild, color.r, color.g, color.b,
+                                              snapThreshold)
+        if role != None:
+            color = discord.Color(int(role.name[1:], 16))
+            snapped = True
+    if role != None:
+        # Mark the role as taken before the request goes out, so the automatic
+        # cleanup can't delete it out from under us in the meantime
+        roleIndex.setMemberColorRole(guild, user, role)
+        await callDiscord(lambda: user.add_roles(role), "add_roles")
+    else:
+        role = await callDiscord(lambda: guild.create_role(name = str(color),
+                                                           color = color),
+                                 "create_role")
+        await callDiscord(lambda: user.add_roles(role), "add_roles")
+        roleIndex.setMemberColorRole(guild, user, role)
+        await roleScheduler.moveRole(guild, role)
+    return color, snapped
+
+# How often (in seconds) a ProgressMessage can be edited
+progressInterval = 2
+
+# A message kept updated with how far along a long job (e.g., sudo cleanup) is.
+# update() doesn't edit it more than once every progressInterval seconds, it
+# would just burn through the rate limit; finish() always does.
+class ProgressMessage:
+    def __init__(self, message):
+        self.message = message
+        self.lastUpdate = time.monotonic()
+
+    async def update(self, content):
+        if time.monotonic() - self.lastUpdate > progressInterval:
+            self.lastUpdate = time.monotonic()
+            await self.message.edit(content = content)
+
+    async def finish(self, content):
+        await self.message.edit(content = content)
+
+# Deletes every color role nobody has, a few at a time (CleanupConcurrency in
+# config.ini), and keeps a message updated with how far along it is.
 async def cleanupColors(ctx):
+    unusedRoles = roleIndex.getUnusedColorRoles(ctx.guild)
+    progress = ProgressMessage(await ctx.send(f"Deleting {len(unusedRoles)} unused roles..."))
     rolesDeleted = 0
-    for role in ctx.guild.roles:
-        if str(role).startswith("#"):
-            if len(role.members) == 0:
-                await role.delete(reason = "Unused")
-                rolesDeleted += 1
+    failedCount = 0
+    deleteSlots = asyncio.Semaphore(config.getCleanupConcurrency())
+
+    async def deleteRole(role):
+        nonlocal rolesDeleted, failedCount
+        async with deleteSlots:
+            try:
+                await roleScheduler.callDiscord(lambda: role.delete(reason = "Unused"),
+                                                 "delete_role")
+            except discord.NotFound:
+                # Someone else already deleted it
+                pass
+            except (discord.HTTPException, discord.RateLimited) as deleteError:
+                # e.g., the role is above the bot's own; the rest can still go
+                print(f"Could not delete unused role {role}: {deleteError}")
+                failedCount += 1
+                return
+            roleIndex.roleDeleted(role)
+            rolesDeleted += 1
+            await progress.update(f"Deleted {rolesDeleted} / {len(unusedRoles)} roles...")
+
+    await asyncio.gather(*[deleteRole(role) for role in unusedRoles])
     message = f"Deleted {rolesDeleted} roles."
-    await ctx.send(message)
+    if failedCount > 0:
+        message += f" Couldn't delete {failedCount}, see the log."
+    await progress.finish(message)
+
+# ================================ Bulk Palettes ===============================
+# sudo palette recolors a whole group at once (everyone with a role, or the
+# whole server): either colors as different from each other as possible, or a
+# gradient running down the member list. All of the colors are worked out up
+# front, then the changes are planned so each color gets one role, reusing an
+# existing color role wherever one is close enough, and only the roles that
+# are still missing get made. Members who already have their planned color
+# are left alone.
+
+# Discord won't let a server have more roles than this
+maxGuildRoles = 250
+
+# A planned palette: assignments is a list of (member, hex code) changes to
+# make, createHexes the hex codes of the roles which have to be made first,
+# reusedHexes the existing roles being handed out, and unchangedCount how many
+# members already have their color
+PalettePlan = collections.namedtuple("PalettePlan", ["assignments",
+                                                     "createHexes",
+                                                     "reusedHexes",
+                                                     "unchangedCount"])
+
+# Works out everyone's color. For a gradient (from gradientEnds[0] to
+# gradientEnds[1]) members are sorted by name and the colors run down the list;
+# otherwise (gradientEnds is None) the colors are distinct and handed out at
+# random. There are at most PaletteColors colors, so with more members than
+# that, some share. Returns a list of (member, (red, green, blue)) tuples.
+def pickPaletteColors(members, gradientEnds, randomizer = random):
+    colorCount = min(len(members), config.getPaletteColors())
+    if gradientEnds == None:
+        colors = colorSpace.distinctColors(colorCount, randomizer)
+        members = list(members)
+        randomizer.shuffle(members)
+        return [(member, colors[number % len(colors)]) for number, member in
+                enumerate(members)]
+    colors = colorSpace.gradientColors(gradientEnds[0], gradientEnds[1],
+                                       colorCount)
+    members = sorted(members, key = lambda member: member.display_name.casefold())
+    return [(member, colors[number * colorCount // len(members)]) for number,
+            member in enumerate(members)]
+
+# Plans the changes for the given (member, (red, green, blue)) tuples. Returns
+# a PalettePlan.
+def planPalette(guild, memberColors):
+    # The colors were picked by the bot, not asked for, so an existing role
+    # nobody could tell apart from one is as good as making a new one
+    snapThreshold = max(config.getSnapThreshold(guild.id),
+                        config.getPaletteSnapThreshold())
+    # Planned hex code -> hex code of the role it's handed out as
+    roleHexes = {}
+    createHexes = []
+    reusedHexes = set()
+    assignments = []
+    unchangedCount = 0
+    for member, rgb in memberColors:
+        hexName = "#{:02x}{:02x}{:02x}".format(*rgb)
+        roleHex = roleHexes.get(hexName)
+        if roleHex == None:
+            role = roleIndex.findColorRole(guild, hexName)
+            if role == None and snapThreshold > 0:
+                role = roleIndex.findNearestColorRole(guild, *rgb, snapThreshold)
+            if role != None:
+                roleHex = role.name.lower()
+                reusedHexes.add(roleHex)
+            else:
+                roleHex = hexName
+                createHexes.append(roleHex)
+            roleHexes[hexName] = roleHex
+        currentRole = roleIndex.getMemberColorRole(guild, member)
+        if currentRole != None and currentRole.name.lower() == roleHex:
+            unchangedCount += 1
+        else:
+            assignments.append((member, roleHex))
+    return PalettePlan(assignments, createHexes, sorted(reusedHexes),
+                       unchangedCount)
 
-# Given a color name, this function will search the colors given in the
-# colorNames.csv file for that name. If found, it will return the red, green,
-# blue values pertaining to that color; if not, the user is notified. CSV from
-# meodai's repo on GitHub.
+# Carries out a PalettePlan: makes the missing roles, moves them into place
+# (in one request, through the role scheduler), then gives every member their
+# color, PaletteConcurrency requests at a time, keeping a message updated with
+# how far along it is. Every change is then recorded in one go.
+async def applyPalette(ctx, plan):
+    guild = ctx.guild
+    if len(guild.roles) + len(plan.createHexes) > maxGuildRoles:
+        roomLeft = maxGuildRoles - len(guild.roles)
+        await ctx.send(f"This needs {len(plan.createHexes)} new roles, but the "
+                       f"server only has room for {roomLeft} more. Try a smaller "
+                       f"PaletteColors, or clear out unused roles with sudo "
+                       f"cleanup.")
+        return
+    callDiscord = roleScheduler.callDiscord
+    slots = asyncio.Semaphore(config.getPaletteConcurrency())
+    progress = ProgressMessage(await ctx.send(f"Making {len(plan.createHexes)} roles and "
+                                              f"changing {len(plan.assignments)} colors..."))
+
+    async def createRole(hexName):
+        async with slots:
+            color = discord.Color(int(hexName[1:], 16))
+            try:
+                role = await callDiscord(lambda: guild.create_role(name = hexName,
+                                                                   color = color),
+                                         "create_role")
+            except (discord.HTTPException, discord.RateLimited) as createError:
+                print(f"Could not create the {hexName} role: {createError}")
+                return None
+            # So the members' changes find it without waiting for the gateway
+            roleIndex.roleCreated(role)
+            return role
+
+    createdRoles = await asyncio.gather(*[createRole(hexName) for hexName in
+                                          plan.createHexes])
+    failedHexes = set(hexName for hexName, role in zip(plan.createHexes,
+                                                        createdRoles) if
+                      role == None)
+    createdRoles = [role for role in createdRoles if role != None]
+    moveRoles = asyncio.gather(*[roleScheduler.moveRole(guild, role) for role in
+                                 createdRoles])
+    changes = []
+    failedCount = 0
+    clearedCount = 0
+
+    async def assignMember(member, hexName):
+        nonlocal failedCount, clearedCount
+        async with slots:
+            color = discord.Color(int(hexName[1:], 16))
+            try:
+                color, snapped = await roleScheduler.setColor(guild, member,
+                                                              color)
+            except (discord.HTTPException, discord.RateLimited) as assignError:
+                print(f"Could not give {member} {hexName}: {assignError}")
+                failedCount += 1
+                return
+            # The member cleared their color before this could be applied
+            if color == None:
+                clearedCount += 1
+                return
+            changes.append((member.id, str(color)))
+            await progress.update(f"Changed {len(changes)} / {len(plan.assignments)} colors...")
+
+    await asyncio.gather(*[assignMember(member, hexName) for member, hexName in
+                           plan.assignments if hexName not in failedHexes])
+    await moveRoles
+    if changes:
+        stats.recordManyStats(guild.id, changes)
+    failedCount += sum(1 for member, hexName in plan.assignments if hexName in
+                       failedHexes)
+    message = (f"Changed {len(changes)} colors ({len(createdRoles)} new roles, "
+               f"{len(plan.reusedHexes)} reused); {plan.unchangedCount} "
+               f"members already had theirs.")
+    if clearedCount > 0:
+        message += f" {clearedCount} cleared their color in the meantime."
+    if failedCount > 0:
+        message += f" Couldn't change {failedCount}, see the log."
+    await progress.finish(message)
+
+# ======================= Automatic Color Role Cleanup =========================
+# With AutoCleanup on, a color role is deleted as soon as its last member drops
+# it (after a grace period, in case someone picks it back up), so there's no
+# need to run sudo cleanup every so often. Role IDs -> tasks waiting out their
+# grace period
+pendingCleanups = {}
+
+# Called when members lose color roles (they changed color, cleared it, or
+# left the server); any of those roles which are now unused get deleted once
+# the grace period is up
+def queueUnusedRoles(guild, roles):
+    if not config.getAutoCleanup():
+        return
+    for role in roles:
+        if role.id in pendingCleanups:
+            continue
+        if roleIndex.isUnusedColorRole(guild, role):
+            pendingCleanups[role.id] = asyncio.create_task(deleteIfUnused(guild,
+                                                                          role))
+
+async def deleteIfUnused(guild, role):
+    try:
+        await asyncio.sleep(config.getCleanupGraceSeconds())
+        # Someone might have been given the role during the grace period
+        if not roleIndex.isUnusedColorRole(guild, role):
+            return
+        await roleScheduler.callDiscord(lambda: role.delete(reason = "Unused"),
+                                         "delete_role")
+        roleIndex.roleDeleted(role)
+    except discord.NotFound:
+        roleIndex.roleDeleted(role)
+    except (discord.HTTPException, discord.RateLimited) as deleteError:
+        print(f"Could not delete unused role {role}: {deleteError}")
+    finally:
+        del pendingCleanups[role.id]
+
+# ==============================================================================
+
+# Given a color name, this function will search the named colors (loaded from
+# the snapshot of colorNames.csv) for that name. If found, it will return the
+# red, green, blue values pertaining to that color, and None. If the name is
+# misspelled but one named color is clearly the closest, it returns that
+# color's red, green, blue values and its name, so the user can be told what it
+# was corrected to; if not, the user is notified (with some suggestions, if
+# there are any). CSV from meodai's repo on GitHub.
 # (https://github.com/meodai/color-names/blob/master/dist/colornames.csv)
 def colorByName(name):
     # Replace any underscores in the name with spaces and make it lowercase
     name = name.replace("_", " ")
     name = name.lower()
-    colorHex = namedColors.findNamedColorHex(name)
+    correctedName = None
+    try:
+        colorHex = namedColors.findNamedColorHex(name)
+    except NameError:
+        colorHex, correctedName = namedColors.findCorrectedNamedColorHex(name)
     red, green, blue = botCommands.hexToRGB(colorHex)
-    return red, green, blue
+    return red, green, blue, correctedName
 
 def countColorRoles(ctx):
-    roleCount = 0
-    for role in ctx.guild.roles:
-        if str(role).startswith("#"):
-            roleCount += 1
-    return roleCount
-
-# Returns a message string containing the specified user's color. If the user
-# does not have a color role, then return a message with such.
+    return roleIndex.countColorRoles(ctx.guild)
+
+# Returns a message string containing the specified user's color, along with the
+# color's hex code for a swatch (None if the role's name isn't a proper hex
+# code). If the user does not have a color role, then return a message with
+# such, and None.
 def getUserColor(ctx, user):
-    for role in user.roles:
-        if str(role).startswith("#"):
-            return f"**{user.nick}'s** color is {str(role)}"
-    return f"**{user.nick}** does not have a color role"
+    role = roleIndex.getMemberColorRole(ctx.guild, user)
+    if role == None:
+        return f"**{user.nick}** does not have a color role", None
+    colorMessage = f"**{user.nick}'s** color is {str(role)}"
+    if roleIndex.hexToLab(role.name) == None:
+        return colorMessage, None
+    return colorMessage, role.name
 
 # Chooses three random numbers, each 0-255 and returns them
 def randomColor():
@@ -87,7 +358,4 @@ def randomColor():
 
 async def removeColorRole(ctx):
     user = ctx.message.author
-    for role in user.roles:
-        if str(role).startswith("#"):
-            await user.remove_roles(role)
-            break
+    await roleScheduler.setColor(ctx.guild, user, None)
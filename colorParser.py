@@ -0,0 +1,263 @@
+# Parses what a user typed as a color, in one pass over the input:
+#     #abc, #aabbcc                   hex codes (3 or 6 digits)
+#     rgb(255, 128, 0)                RGB, 0-255 or percentages
+#     255 128 0, (255, 128, 0)        RGB without the rgb()
+#     hsl(30, 100%, 50%)              hue (degrees), saturation, lightness
+#     hsv(30deg, 100%, 100%)          hue, saturation, value
+# The brackets after rgb / hsl / hsv can be left out, and the components can
+# be separated by spaces, commas, semicolons or slashes. Anything else (i.e.,
+# anything with a word in it that isn't one of the color functions) is taken
+# to be a color name, which namedColors.py looks up.
+#
+# The grammar is defined by the tokenizer and parseTokens(). Since nearly
+# everything people type is either a well-formed color or a name, those are
+# recognized first by a precompiled pattern each, which the regular expression
+# engine matches in one scan without any Python in the loop; only input
+# which is neither (i.e., a mistake) goes through the tokenizer, to find out
+# what the mistake is. Problems are raised as a ColorParseError saying what was
+# wrong and where, so the bot can point it out to the user.
+
+import collections
+import colorsys
+import math
+import re
+
+# Every token, in the order they're tried. Separators only ever come between
+# components, so a run of them is one token.
+tokenPattern = re.compile(r"""
+    (?P<hex>\#\w*)
+  | (?P<number>[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:%|deg)?)
+  | (?P<word>[^\W\d_]+)
+  | (?P<open>\()
+  | (?P<close>\))
+  | (?P<separator>[\s,;/]+)
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+hexDigits = frozenset("0123456789abcdefABCDEF")
+
+# The fast paths, which have to agree with the tokenizer exactly (see
+# benchmarks/parserFuzz.py). colorPattern is a whole well-formed color;
+# the brackets have to match. namePattern finds a word the tokenizer will see
+# as a word (not a "deg" or a hex code's digits), in input that doesn't start
+# with a hex code or color function.
+separators = r"[\s,;/]"
+# Spelled out rather than with IGNORECASE, which would also match "DEG" and
+# some non-ASCII letters the tokenizer doesn't take as the same
+functionNames = r"(?:[Rr][Gg][Bb]|[Hh][Ss][LlVv])"
+number = r"[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:%|deg)?"
+colorPattern = re.compile(rf"""
+    {separators}*
+    (?:
+        \#(?P<hex>[0-9a-fA-F]{{6}}|[0-9a-fA-F]{{3}})
+      | (?P<function>{functionNames})?{separators}*
+        (?P<open>\()?{separators}*
+        (?P<first>{number}){separators}+
+        (?P<second>{number}){separators}+
+        (?P<third>{number}){separators}*
+        (?(open)\))
+    )
+    {separators}*
+""", re.VERBOSE)
+namePattern = re.compile(rf"""
+    (?!{separators}*\#)
+    (?!{separators}*{functionNames}{separators}*[(\d.+-])
+    .*?(?<![\d.\w\#])[^\W\d_]
+""", re.VERBOSE | re.DOTALL)
+
+# The color functions, and the largest value each of their components can be
+# (a percentage can always be up to 100%). Hues wrap around, so they have no
+# limit.
+colorFunctions = {
+    "rgb": (255, 255, 255),
+    "hsl": (None, 100, 100),
+    "hsv": (None, 100, 100),
+}
+
+# A token: its kind (the group it matched in tokenPattern), its text and where
+# it starts in the input
+Token = collections.namedtuple("Token", ["kind", "text", "position"])
+
+# Raised when the input looks like a color but isn't a valid one. problem is a
+# short code for what went wrong (e.g., "hexLength"), position is where in the
+# input it was found, and the message is what to tell the user.
+class ColorParseError(ValueError):
+    def __init__(self, problem, position, message):
+        super().__init__(message)
+        self.problem = problem
+        self.position = position
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+# Splits the input into tokens, leaving out the separators. Returns the tokens
+# and whether any of them were words (i.e., whether it could be a color name).
+def tokenize(text):
+    tokens = []
+    hasWord = False
+    for match in tokenPattern.finditer(text):
+        kind = match.lastgroup
+        if kind == "separator":
+            continue
+        if kind == "word":
+            hasWord = True
+        tokens.append(Token(kind, match.group(), match.start()))
+    return tokens, hasWord
+
+# Parses the input. Returns the color's (red, green, blue), or None if it's
+# not a hex code, RGB or HSL / HSV color, so should be looked up as a name.
+# Raises a ColorParseError if it is one of those, but isn't a valid one.
+def parseColor(text):
+    match = colorPattern.fullmatch(text)
+    if match != None:
+        hexCode = match.group("hex")
+        if hexCode != None:
+            if len(hexCode) == 3:
+                hexCode = "".join(digit * 2 for digit in hexCode)
+            value = int(hexCode, 16)
+            return value >> 16, (value >> 8) & 0xFF, value & 0xFF
+        function = match.group("function")
+        function = function.lower() if function != None else "rgb"
+        return convertComponents(function, match.group("first", "second", "third"),
+                                 (match.start("first"), match.start("second"),
+                                  match.start("third")), match.start())
+    if namePattern.match(text):
+        return None
+    return parseTokens(text)
+
+# parseColor() the long way, token by token. Gives the same results, but
+# also works out what's wrong with anything that isn't a color.
+def parseTokens(text):
+    tokens, hasWord = tokenize(text)
+    if not tokens:
+        raise ColorParseError("empty", 0, "Please give a color")
+    first = tokens[0]
+    if first.kind == "hex":
+        expectEnd(tokens, 1, "hex code")
+        return parseHexToken(first)
+    if first.kind == "word" and first.text.lower() in colorFunctions:
+        function = first.text.lower()
+        if len(tokens) > 1 and tokens[1].kind == "open":
+            components, end = readComponents(tokens, 2, tokens[1])
+            expectEnd(tokens, end, f"{function}()")
+            return convertTokens(function, components, first)
+        if len(tokens) > 1 and tokens[1].kind == "number":
+            components, end = readComponents(tokens, 1, None)
+            return convertTokens(function, components, first)
+    if hasWord:
+        return None
+    # Just numbers, maybe in brackets, is RGB
+    if first.kind == "open":
+        components, end = readComponents(tokens, 1, first)
+        expectEnd(tokens, end, "RGB triplet")
+    else:
+        components, end = readComponents(tokens, 0, None)
+    return convertTokens("rgb", components, first)
+
+# Reads number tokens from start until the closing bracket (if opener is
+# given) or the end of the input. Returns the tokens and the index after them.
+def readComponents(tokens, start, opener):
+    components = []
+    index = start
+    while index < len(tokens):
+        token = tokens[index]
+        if token.kind == "number":
+            components.append(token)
+        elif token.kind == "close" and opener != None:
+            return components, index + 1
+        else:
+            raise ColorParseError("unexpected", token.position,
+                                  f"Didn't expect \"{token.text}\" in a color")
+        index += 1
+    if opener != None:
+        raise ColorParseError("unclosed", opener.position,
+                              "Missing a closing bracket")
+    return components, index
+
+def expectEnd(tokens, index, description):
+    if index < len(tokens):
+        token = tokens[index]
+        raise ColorParseError("trailing", token.position,
+                              f"Didn't expect \"{token.text}\" after the {description}")
+
+def parseHexToken(token):
+    digits = token.text[1:]
+    for offset, digit in enumerate(digits):
+        if digit not in hexDigits:
+            raise ColorParseError("hexDigit", token.position + 1 + offset,
+                                  f"{token.text} is not a valid hex code: \"{digit}\" isn't a hex digit")
+    # #abc is short for #aabbcc
+    if len(digits) == 3:
+        digits = "".join(digit * 2 for digit in digits)
+    if len(digits) != 6:
+        raise ColorParseError("hexLength", token.position,
+                              f"{token.text} is not a valid hex code: hex codes have 3 or 6 digits")
+    value = int(digits, 16)
+    return value >> 16, (value >> 8) & 0xFF, value & 0xFF
+
+# Hues go round in a circle, so any angle is fine as long as it's a number
+def wrapHue(text, position):
+    hue = float(text)
+    if not math.isfinite(hue):
+        raise ColorParseError("componentRange", position,
+                              f"{text} is too big to be a hue")
+    return hue % 360
+
+def convertTokens(function, components, first):
+    return convertComponents(function, [token.text for token in components],
+                             [token.position for token in components],
+                             first.position)
+
+# Checks the components (their text and where each starts) are in range and
+# converts them to (red, green, blue). firstPosition is where the color
+# starts.
+def convertComponents(function, texts, positions, firstPosition):
+    name = "An RGB triplet" if function == "rgb" else f"{function}()"
+    if len(texts) != 3:
+        position = positions[3] if len(texts) > 3 else firstPosition
+        raise ColorParseError("componentCount", position,
+                              f"{name} should have three numbers, not {len(texts)}")
+    # Plain RGB numbers are by far the most common
+    if function == "rgb" and texts[0].isdecimal() and texts[1].isdecimal() and texts[2].isdecimal():
+        red, green, blue = int(texts[0]), int(texts[1]), int(texts[2])
+        if red <= 255 and green <= 255 and blue <= 255:
+            return red, green, blue
+    values = []
+    for text, position, limit in zip(texts, positions, colorFunctions[function]):
+        if text.endswith("deg"):
+            if limit != None:
+                raise ColorParseError("unit", position,
+                                      f"Only a hue can be in degrees, not \"{text}\"")
+            values.append(wrapHue(text[:-3], position))
+            continue
+        if text.endswith("%"):
+            if limit == None:
+                raise ColorParseError("unit", position,
+                                      f"A hue is in degrees, not a percentage (\"{text}\")")
+            percentage = float(text[:-1])
+            if not 0 <= percentage <= 100:
+                raise ColorParseError("componentRange", position,
+                                      f"Percentages must be between 0% and 100%, not {text}")
+            values.append(percentage / 100 * limit)
+            continue
+        if limit == None:
+            values.append(wrapHue(text, position))
+            continue
+        value = float(text)
+        if not 0 <= value <= limit:
+            label = "RGB values" if function == "rgb" else "Saturation, lightness and value"
+            raise ColorParseError("componentRange", position,
+                                  f"{label} must be between 0 and {limit}, not {text}")
+        values.append(value)
+    if function == "rgb":
+        red, green, blue = values
+    elif function == "hsl":
+        red, green, blue = colorsys.hls_to_rgb(values[0] / 360, values[2] / 100,
+                                               values[1] / 100)
+        red, green, blue = red * 255, green * 255, blue * 255
+    else:
+        red, green, blue = colorsys.hsv_to_rgb(values[0] / 360, values[1] / 100,
+                                               values[2] / 100)
+        red, green, blue = red * 255, green * 255, blue * 255
+    return round(red), round(green), round(blue)
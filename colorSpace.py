@@ -0,0 +1,192 @@
+# Color math for comparing colors the way people see them. RGB distances don't
+# line up with how different two colors look, so colors are converted to
+# CIELAB, where the straight-line distance between two colors (ΔE76) roughly
+# matches the perceived difference. A ΔE of about 2.3 is the smallest
+# difference most people can notice.
+
+# Reference white for the D65 illuminant (the one sRGB is defined against)
+whiteX = 0.95047
+whiteY = 1.00000
+whiteZ = 1.08883
+
+# Converts one 0-255 sRGB channel to a linear 0-1 value
+def linearizeChannel(value):
+    value = value / 255
+    if value <= 0.04045:
+        return value / 12.92
+    return ((value + 0.055) / 1.055) ** 2.4
+
+# The nonlinear part of the XYZ -> Lab conversion
+def labCurve(value):
+    if value > 216 / 24389:
+        return value ** (1 / 3)
+    return (24389 / 27 * value + 16) / 116
+
+# Converts an sRGB color (three 0-255 integers) to a CIELAB (L, a, b) tuple
+def rgbToLab(red, green, blue):
+    red = linearizeChannel(red)
+    green = linearizeChannel(green)
+    blue = linearizeChannel(blue)
+    x = (0.4124564 * red + 0.3575761 * green + 0.1804375 * blue) / whiteX
+    y = (0.2126729 * red + 0.7151522 * green + 0.0721750 * blue) / whiteY
+    z = (0.0193339 * red + 0.1191920 * green + 0.9503041 * blue) / whiteZ
+    x, y, z = labCurve(x), labCurve(y), labCurve(z)
+    return (116 * y - 16, 500 * (x - y), 200 * (y - z))
+
+# Converts one linear 0-1 value back to a 0-255 sRGB channel, clamping colors
+# outside of sRGB to its edge
+def delinearizeChannel(value):
+    value = min(1, max(0, value))
+    if value <= 0.0031308:
+        value *= 12.92
+    else:
+        value = 1.055 * value ** (1 / 2.4) - 0.055
+    return round(value * 255)
+
+def inverseLabCurve(value):
+    if value > 6 / 29:
+        return value ** 3
+    return (116 * value - 16) * 27 / 24389
+
+# Converts a CIELAB color back to sRGB (three 0-255 integers). Lab can describe
+# colors sRGB can't show; those come out as the nearest color it can.
+def labToRgb(lightness, a, b):
+    y = (lightness + 16) / 116
+    x = inverseLabCurve(y + a / 500) * whiteX
+    z = inverseLabCurve(y - b / 200) * whiteZ
+    y = inverseLabCurve(y) * whiteY
+    return (delinearizeChannel(3.2404542 * x - 1.5371385 * y - 0.4985314 * z),
+            delinearizeChannel(-0.9692660 * x + 1.8760108 * y + 0.0415560 * z),
+            delinearizeChannel(0.0556434 * x - 0.2040259 * y + 1.0572252 * z))
+
+# Returns the squared ΔE76 between two Lab colors. Comparing squared distances
+# saves a square root when all that matters is which color is closer.
+def deltaESquared(lab1, lab2):
+    dL = lab1[0] - lab2[0]
+    da = lab1[1] - lab2[1]
+    db = lab1[2] - lab2[2]
+    return dL * dL + da * da + db * db
+
+# Returns the ΔE76 between two Lab colors
+def deltaE(lab1, lab2):
+    return deltaESquared(lab1, lab2) ** 0.5
+
+# ================================== k-d Tree ==================================
+# A k-d tree over Lab points for nearest-neighbour lookups. Each node is a
+# tuple of (point index, splitting axis, left subtree, right subtree); every
+# point in the left subtree is <= the node's point along the splitting axis.
+# A lookup only has to visit the handful of branches that could hold
+# something closer than the best match so far, instead of every point.
+
+# Builds a k-d tree over a list of Lab points. Returns the root node, or None
+# if there are no points.
+def buildKDTree(points):
+    return buildSubtree(points, list(range(len(points))), 0)
+
+def buildSubtree(points, indices, axis):
+    if len(indices) == 0:
+        return None
+    indices.sort(key = lambda index: points[index][axis])
+    middle = len(indices) // 2
+    nextAxis = (axis + 1) % 3
+    return (indices[middle], axis,
+            buildSubtree(points, indices[:middle], nextAxis),
+            buildSubtree(points, indices[middle + 1:], nextAxis))
+
+# Finds the point in the tree closest to the given Lab point. Returns the index
+# of that point and its ΔE from the given one, or (None, None) for an empty
+# tree.
+def findNearest(tree, points, point):
+    # best holds the squared distance and index of the closest point so far
+    best = [float("inf"), None]
+    searchSubtree(tree, points, point, best)
+    if best[1] == None:
+        return None, None
+    return best[1], best[0] ** 0.5
+
+def searchSubtree(node, points, point, best):
+    if node == None:
+        return
+    index, axis, left, right = node
+    distance = deltaESquared(point, points[index])
+    if distance < best[0]:
+        best[0] = distance
+        best[1] = index
+    # Search the side the point falls on first. The other side only needs to
+    # be searched if the splitting plane is closer than the best match.
+    offset = point[axis] - points[index][axis]
+    if offset <= 0:
+        searchSubtree(left, points, point, best)
+        if offset * offset < best[0]:
+            searchSubtree(right, points, point, best)
+    else:
+        searchSubtree(right, points, point, best)
+        if offset * offset < best[0]:
+            searchSubtree(left, points, point, best)
+
+# =================================== Palettes =================================
+# Colors for a whole group of people at once (see sudo palette).
+
+# Candidate colors for distinctColors(): an even grid over sRGB, converted to
+# Lab the first time it's needed. Very dark and very light colors are left
+# out, since they disappear against Discord's dark or light theme (and
+# #000000 means "no color" to Discord).
+paletteGridSteps = 12
+minPaletteLightness = 25
+maxPaletteLightness = 90
+paletteGrid = None
+
+def getPaletteGrid():
+    global paletteGrid
+    if paletteGrid == None:
+        levels = [round(step * 255 / (paletteGridSteps - 1)) for step in
+                  range(paletteGridSteps)]
+        rgbs = []
+        labs = []
+        for red in levels:
+            for green in levels:
+                for blue in levels:
+                    lab = rgbToLab(red, green, blue)
+                    if minPaletteLightness <= lab[0] <= maxPaletteLightness:
+                        rgbs.append((red, green, blue))
+                        labs.append(lab)
+        paletteGrid = (rgbs, labs)
+    return paletteGrid
+
+# Returns count colors (as (red, green, blue) tuples) which are as far apart
+# from each other as possible. The first is random, then each one after is the
+# candidate farthest from every color picked so far (farthest point sampling).
+# Each candidate's distance to its nearest pick is kept in one list, so every
+# pick is a single pass over the grid rather than comparing against every
+# earlier pick.
+def distinctColors(count, randomizer):
+    rgbs, labs = getPaletteGrid()
+    count = min(count, len(rgbs))
+    picked = []
+    nearest = [float("inf")] * len(labs)
+    index = randomizer.randrange(len(labs))
+    while len(picked) < count:
+        picked.append(rgbs[index])
+        pickedL, pickedA, pickedB = labs[index]
+        nearest = [min(distance, (lightness - pickedL) ** 2 + (a - pickedA) ** 2
+                       + (b - pickedB) ** 2) for distance, (lightness, a, b) in
+                   zip(nearest, labs)]
+        index = max(range(len(nearest)), key = nearest.__getitem__)
+    return picked
+
+# Returns count colors (as (red, green, blue) tuples) evenly spaced from start
+# to end. They're spaced out in Lab, so each step looks about the same size.
+def gradientColors(start, end, count):
+    startLab = rgbToLab(*start)
+    endLab = rgbToLab(*end)
+    if count == 1:
+        return [tuple(start)]
+    colors = []
+    for step in range(count):
+        fraction = step / (count - 1)
+        colors.append(labToRgb(*(startValue + (endValue - startValue) * fraction
+                                 for startValue, endValue in zip(startLab,
+                                                                 endLab))))
+    return colors
+
+# ==============================================================================
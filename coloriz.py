@@ -1,3 +1,7 @@
+# Imported first so --profile-startup can time everything imported below
+import startupProfile
+startupProfile.startImportTiming()
+
 import asyncio
 import auth
 import botCommands
@@ -5,12 +9,26 @@ import colorCommands
 import commandConfig
 import config
 import discord
+import metrics
+import namedColors
+import os
 import re
+import roleIndex
+import roleScheduler
+import searchResults
+import sharding
+import sqlite3
 import stats
+import statsWriter
+import swatch
 import  sys
-from discord.ext import commands
+import time
+import typing
+from discord.ext import commands, tasks
 from pretty_help import PrettyHelp
 
+startupProfile.stopImportTiming()
+
 owner_ID = 174362561385332736
 botToken = config.getToken()
 prefix = config.getPrefix()
@@ -19,8 +37,16 @@ intents = discord.Intents().default()
 intents.members = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix = prefix, intents = intents, help_command =
-                   PrettyHelp())
+# When started by sharding.py, this process is one of several, each running a
+# range of the bot's shards
+shardIDs, shardCount, processIndex = sharding.getShardArguments(sys.argv)
+if shardCount == None:
+    bot = commands.Bot(command_prefix = prefix, intents = intents, help_command =
+                       PrettyHelp())
+else:
+    bot = commands.AutoShardedBot(command_prefix = prefix, intents = intents,
+                                  help_command = PrettyHelp(), shard_ids =
+                                  shardIDs, shard_count = shardCount)
 
 # Outputs a link to the table of color names, and some help
 @bot.command()
@@ -45,6 +71,77 @@ class ColorCommands(commands.Cog, name = "Color Commands"):
     def __init__(self, bot):
         self.bot = bot
 
+    # Build the color role index for every guild once the bot is up. If a
+    # refresh interval is set, also start checking upstream for a new list of
+    # named colors.
+    @commands.Cog.listener()
+    async def on_ready(self):
+        for guild in self.bot.guilds:
+            roleIndex.rebuildIndex(guild)
+        if not self.checkRoleIndexes.is_running():
+            self.checkRoleIndexes.start()
+        refreshHours = config.getColorRefreshHours()
+        if refreshHours > 0 and not self.refreshColors.is_running():
+            self.refreshColors.change_interval(hours = refreshHours)
+            self.refreshColors.start()
+
+    # Keep the color role index in sync with the guilds. Events can be missed
+    # while the connection is down, so after a reconnect the indexes are thrown
+    # out and rebuilt as they're needed.
+    @commands.Cog.listener()
+    async def on_resumed(self):
+        roleIndex.invalidate()
+
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild):
+        roleIndex.invalidate(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        roleIndex.invalidate(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        roleIndex.roleCreated(role)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        roleIndex.roleUpdated(before, after)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        roleIndex.roleDeleted(role)
+
+    # Any color roles a member drops might now be unused, and can be cleaned
+    # up automatically
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        roleIndex.memberUpdated(before, after)
+        droppedRoles = [role for role in before.roles if role not in after.roles]
+        colorCommands.queueUnusedRoles(after.guild, droppedRoles)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        roleIndex.memberRemoved(member)
+        colorCommands.queueUnusedRoles(member.guild, member.roles)
+
+    # Every so often, make sure no events slipped through the cracks
+    @tasks.loop(hours = 1)
+    async def checkRoleIndexes(self):
+        for guild in self.bot.guilds:
+            if not roleIndex.checkIndex(guild):
+                print(f"Rebuilt the color role index for {guild.name}")
+
+    # The refresh is a conditional GET, so most of the time this is just a
+    # "304 Not Modified" from upstream. It runs in a thread so the download and
+    # parse never block the bot.
+    @tasks.loop(hours = 24)
+    async def refreshColors(self):
+        try:
+            await asyncio.to_thread(namedColors.refreshNamedColors)
+        except Exception as refreshError:
+            print(f"Could not refresh named colors: {refreshError}")
+
     @commands.group(name = "color", invoke_without_command = True,
                     aliases = commandConfig.getAliases("color"),
                     brief = commandConfig.getBrief("color"),
@@ -54,14 +151,14 @@ class ColorCommands(commands.Cog, name = "Color Commands"):
         # Calling the command with no arguments or subcommands has the bot
         # return a message.
         user = ctx.message.author
-        colorMessage = colorCommands.getUserColor(ctx, user)
+        colorMessage, colorHex = colorCommands.getUserColor(ctx, user)
         # If there are arguments passed with the command, ask the user if they
         # wanted to set their color instead.
         if len(args) > 0:
             colorMessage += f"""
 Colors are now assigned with ``{prefix}color set``, did you mean to do this?
 """
-        await ctx.send(colorMessage)
+        await swatch.sendWithSwatch(ctx, colorMessage, colorHex)
 
     # color set is used for setting colors based off a given hex code, RGB
     # triplet, or a named color
@@ -71,8 +168,19 @@ Colors are now assigned with ``{prefix}color set``, did you mean to do this?
                    usage = commandConfig.getUsage("color set"),
                    help = commandConfig.getHelp("color set"))
     async def set(self, ctx, *args):
-        setMessage = await botCommands.colorSet(ctx, args)
-        await ctx.send(setMessage)
+        setMessage, colorHex = await botCommands.colorSet(ctx, args)
+        await swatch.sendWithSwatch(ctx, setMessage, colorHex)
+
+    # color name finds the named color closest to a given hex code or RGB
+    # triplet
+    @color.command(name = "name",
+                   aliases = commandConfig.getAliases("color name"),
+                   brief = commandConfig.getBrief("color name"),
+                   usage = commandConfig.getUsage("color name"),
+                   help = commandConfig.getHelp("color name"))
+    async def name(self, ctx, *args):
+        nameMessage = await botCommands.colorName(ctx, args)
+        await ctx.send(nameMessage)
 
     # color search is used to search the named colors for a given string
     @color.command(name = "search",
@@ -81,8 +189,11 @@ Colors are now assigned with ``{prefix}color set``, did you mean to do this?
                    usage = commandConfig.getUsage("color search"),
                    help = commandConfig.getHelp("color search"))
     async def search(self, ctx, *args):
-        searchMessage = await botCommands.colorSearch(ctx, args)
-        await ctx.send(searchMessage)
+        searchMessage, paletteHexes, pagesView = await botCommands.colorSearch(ctx, args)
+        sentMessage = await swatch.sendWithSwatch(ctx, searchMessage,
+                                                  paletteHexes, pagesView)
+        if pagesView != None:
+            pagesView.message = sentMessage
 
     # color random assigns the user with a completely random color.
     @color.command(name = "random",
@@ -111,7 +222,30 @@ class StatsCommands(commands.Cog, name = "Stats Commands"):
     def __init__(self, bot):
         self.bot = bot
 
-    @commands.group(name = "stats", invoke_without_command = True)
+    # With a retention policy, old color history is compacted every so often.
+    # A shard process leaves that to the stats writer.
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if (config.getRetentionDays() > 0 and shardCount == None and not
+            self.compactHistory.is_running()):
+            self.compactHistory.change_interval(hours = config.getCompactHours())
+            self.compactHistory.start()
+
+    @tasks.loop(hours = 24)
+    async def compactHistory(self):
+        try:
+            result = await asyncio.to_thread(stats.compactHistory)
+        except sqlite3.Error as compactError:
+            print(f"Could not compact the color history: {compactError}")
+            return
+        if result != None:
+            print(stats.describeCompaction(*result))
+
+    @commands.group(name = "stats", invoke_without_command = True,
+                    aliases = commandConfig.getAliases("stats"),
+                    brief = commandConfig.getBrief("stats"),
+                    usage = commandConfig.getUsage("stats"),
+                    help = commandConfig.getHelp("stats"))
     async def stats(self, ctx, *args):
         # If the user mentions someone else, use that instead of the author of
         # the message.
@@ -124,9 +258,20 @@ class StatsCommands(commands.Cog, name = "Stats Commands"):
         if user == None:
             await ctx.send("Sorry, that user does not exist, or that isn't a valid ID. :(")
         else:
-            statsEmbed = stats.createEmbed(ctx.guild.id, user)
+            statsEmbed = await asyncio.to_thread(stats.createEmbed, ctx.guild.id,
+                                                 user)
             await ctx.send(embed = statsEmbed)
 
+    # stats server shows the stats and leaderboards for the whole server
+    @stats.command(name = "server",
+                   aliases = commandConfig.getAliases("stats server"),
+                   brief = commandConfig.getBrief("stats server"),
+                   usage = commandConfig.getUsage("stats server"),
+                   help = commandConfig.getHelp("stats server"))
+    async def server(self, ctx):
+        serverEmbed = await asyncio.to_thread(stats.createServerEmbed, ctx.guild)
+        await ctx.send(embed = serverEmbed)
+
 
 # ================================ Sudo Commands ===============================
 
@@ -156,6 +301,102 @@ class SudoCommands(commands.Cog, name = "Sudo Commands"):
         else:
             await ctx.send(sudoFailMessage)
 
+    # sudo palette colors everyone with the given role (or everyone on the
+    # server) at once, with distinct colors or a gradient
+    @sudo.command(name = "palette",
+                  aliases = commandConfig.getAliases("sudo palette"),
+                  brief = commandConfig.getBrief("sudo palette"),
+                  usage = commandConfig.getUsage("sudo palette"),
+                  help = commandConfig.getHelp("sudo palette"))
+    async def palette(self, ctx, role: typing.Optional[discord.Role] = None,
+                      *args):
+        sudoFailMessage = f"**{ctx.message.author.name}** {auth.failMessage}"
+        if not auth.canManageRoles(ctx):
+            await ctx.send(sudoFailMessage)
+            return
+        try:
+            gradientEnds = botCommands.parsePaletteArguments(args)
+        except (ValueError, NameError) as paletteError:
+            await ctx.send(paletteError)
+            return
+        members = role.members if role != None else ctx.guild.members
+        members = [member for member in members if not member.bot]
+        if len(members) == 0:
+            await ctx.send("There's nobody to color")
+            return
+        memberColors = colorCommands.pickPaletteColors(members, gradientEnds)
+        plan = colorCommands.planPalette(ctx.guild, memberColors)
+        await colorCommands.applyPalette(ctx, plan)
+
+    @sudo.command(name = "scheduler",
+                  aliases = commandConfig.getAliases("sudo scheduler"),
+                  brief = commandConfig.getBrief("sudo scheduler"),
+                  usage = commandConfig.getUsage("sudo scheduler"),
+                  help = commandConfig.getHelp("sudo scheduler"))
+    async def scheduler(self, ctx):
+        sudoFailMessage = f"**{ctx.message.author.name}** {auth.failMessage}"
+        if not auth.canManageRoles(ctx):
+            await ctx.send(sudoFailMessage)
+            return
+        schedulerStats = roleScheduler.getSchedulerStats()
+        statsMessage = "```"
+        for name, value in schedulerStats.items():
+            statsMessage += f"{name}: {value}\n"
+        statsMessage += "```"
+        await ctx.send(statsMessage)
+
+    @sudo.command(name = "cache",
+                  aliases = commandConfig.getAliases("sudo cache"),
+                  brief = commandConfig.getBrief("sudo cache"),
+                  usage = commandConfig.getUsage("sudo cache"),
+                  help = commandConfig.getHelp("sudo cache"))
+    async def cache(self, ctx):
+        sudoFailMessage = f"**{ctx.message.author.name}** {auth.failMessage}"
+        if not auth.canManageRoles(ctx):
+            await ctx.send(sudoFailMessage)
+            return
+        cacheMessage = "```"
+        cacheMessage += "stats\n"
+        for name, value in stats.getCacheStats().items():
+            cacheMessage += f"  {name}: {value}\n"
+        cacheMessage += "swatches\n"
+        for name, value in swatch.getCacheStats().items():
+            cacheMessage += f"  {name}: {value}\n"
+        cacheMessage += "color search\n"
+        for name, value in searchResults.getCacheStats().items():
+            cacheMessage += f"  {name}: {value}\n"
+        cacheMessage += "```"
+        await ctx.send(cacheMessage)
+
+    @sudo.command(name = "export",
+                  aliases = commandConfig.getAliases("sudo export"),
+                  brief = commandConfig.getBrief("sudo export"),
+                  usage = commandConfig.getUsage("sudo export"),
+                  help = commandConfig.getHelp("sudo export"))
+    async def export(self, ctx, exportFormat = "csv"):
+        sudoFailMessage = f"**{ctx.message.author.name}** {auth.failMessage}"
+        if not auth.canManageRoles(ctx):
+            await ctx.send(sudoFailMessage)
+            return
+        exportFormat = exportFormat.lower()
+        if exportFormat not in stats.exportFormats:
+            formats = ", ".join(stats.exportFormats)
+            await ctx.send(f"Can't export as {exportFormat}, try one of: {formats}")
+            return
+        await ctx.send("Exporting color history...")
+        exportPath, rowCount = await asyncio.to_thread(stats.exportHistory,
+                                                       ctx.guild.id,
+                                                       exportFormat)
+        try:
+            if os.path.getsize(exportPath) > ctx.guild.filesize_limit:
+                await ctx.send(f"The export ({rowCount} rows) is too big to upload here")
+                return
+            fileName = f"colorHistory-{ctx.guild.id}.{exportFormat}.gz"
+            await ctx.send(f"Exported {rowCount} rows",
+                           file = discord.File(exportPath, filename = fileName))
+        finally:
+            os.remove(exportPath)
+
     @sudo.command(name = "shutdown",
                   aliases = commandConfig.getAliases("sudo shutdown"),
                   brief = commandConfig.getBrief("sudo shutdown"),
@@ -170,9 +411,50 @@ class SudoCommands(commands.Cog, name = "Sudo Commands"):
         else:
             await ctx.send("Sleep mode activated...")
             print("Stopping Bot...")
+            # Make sure every stat waiting to be written makes it to disk
+            await asyncio.to_thread(stats.close)
             await bot.close()
             sys.exit()
 
+    @sudo.command(name = "refreshcolors",
+                  aliases = commandConfig.getAliases("sudo refreshcolors"),
+                  brief = commandConfig.getBrief("sudo refreshcolors"),
+                  usage = commandConfig.getUsage("sudo refreshcolors"),
+                  help = commandConfig.getHelp("sudo refreshcolors"))
+    async def refreshcolors(self, ctx):
+        sudoFailMessage = f"**{ctx.message.author.name}** {auth.failMessage}"
+        if (ctx.message.author.id != owner_ID):
+            await ctx.send(sudoFailMessage)
+            return
+        await ctx.send("Checking for new named colors...")
+        try:
+            changed = await asyncio.to_thread(namedColors.refreshNamedColors)
+        except Exception as refreshError:
+            await ctx.send(f"Could not refresh named colors: {refreshError}")
+            return
+        colorCount = namedColors.countNamedColors()
+        if changed:
+            await ctx.send(f"Loaded {colorCount} named colors")
+        else:
+            await ctx.send(f"Named colors are already up to date ({colorCount} colors)")
+
+    @sudo.command(name = "reloadhelp",
+                  aliases = commandConfig.getAliases("sudo reloadhelp"),
+                  brief = commandConfig.getBrief("sudo reloadhelp"),
+                  usage = commandConfig.getUsage("sudo reloadhelp"),
+                  help = commandConfig.getHelp("sudo reloadhelp"))
+    async def reloadhelp(self, ctx):
+        sudoFailMessage = f"**{ctx.message.author.name}** {auth.failMessage}"
+        if (ctx.message.author.id != owner_ID):
+            await ctx.send(sudoFailMessage)
+            return
+        try:
+            updatedCount = commandConfig.reloadCommandConfig(bot)
+        except (OSError, ValueError, commandConfig.CommandConfigError) as reloadError:
+            await ctx.send(f"Could not reload commandConfig.json: {reloadError}")
+            return
+        await ctx.send(f"Reloaded help for {updatedCount} commands")
+
 # ============================== Testing Commands ==============================
 
 # Commands for testing various functionalities of the bot
@@ -195,10 +477,125 @@ async def ed(ctx, *args):
     await ctx.send("?")
 
 
-async def setup(bot):
-    await bot.add_cog(SudoCommands(bot))
-    await bot.add_cog(StatsCommands(bot))
-    await bot.add_cog(ColorCommands(bot))
+# ================================== Metrics ===================================
+# Every command is timed from when discord.py starts invoking it to when it
+# finishes (or fails), and failures are counted by the error's type. See
+# metrics.py.
+
+@bot.listen("on_command")
+async def startCommandTimer(ctx):
+    ctx.commandStart = time.perf_counter()
+
+@bot.listen("on_command_completion")
+async def stopCommandTimer(ctx):
+    commandStart = getattr(ctx, "commandStart", None)
+    if commandStart != None:
+        metrics.commandSeconds.observe(time.perf_counter() - commandStart,
+                                       ctx.command.qualified_name)
+
+@bot.listen("on_command_error")
+async def countCommandError(ctx, error):
+    commandName = ctx.command.qualified_name if ctx.command else "unknown"
+    # Most errors come wrapped in a CommandInvokeError; count the real one
+    error = getattr(error, "original", error)
+    metrics.commandErrors.inc(commandName, type(error).__name__)
+    commandStart = getattr(ctx, "commandStart", None)
+    if commandStart != None:
+        metrics.commandSeconds.observe(time.perf_counter() - commandStart,
+                                       commandName)
+
+metricsServer = None
+
+async def startMetricsServer():
+    global metricsServer
+    port = config.getMetricsPort()
+    if port == 0:
+        return
+    # Each shard process gets a port of its own
+    port += processIndex
+    try:
+        metricsServer = await metrics.startServer(config.getMetricsHost(), port)
+    except OSError as serverError:
+        print(f"Could not serve metrics on port {port}: {serverError}")
+
+# ================================== Startup ===================================
+# The cogs are added once the bot has logged in, before it connects to the
+# gateway (discord.py's setup_hook). Loading the named colors and bringing the
+# database up to date are the slow parts of starting up, so they run on worker
+# threads at the same time as the gateway connection instead of holding it up;
+# anything that needs them before they're done waits for them.
+initTask = None
+setupTime = None
+
+def runPhase(name, function):
+    with startupProfile.phase(name):
+        function()
+
+# The first time the bot runs there's no snapshot of the named colors yet, so
+# they're downloaded in the background; until then the bot works without them,
+# and startup never waits on the network
+downloadTask = None
+
+async def downloadNamedColors():
+    try:
+        await asyncio.to_thread(namedColors.refreshNamedColors)
+    except Exception as refreshError:
+        print(f"Could not download named colors: {refreshError}")
+        return
+    print(f"Downloaded {namedColors.countNamedColors()} named colors")
+
+async def loadNamedColors():
+    global downloadTask
+    await asyncio.to_thread(runPhase, "load named colors", namedColors.ensureLoaded)
+    if namedColors.countNamedColors() == 0 and not startupProfile.enabled:
+        downloadTask = asyncio.create_task(downloadNamedColors())
+
+async def initSubsystems():
+    await asyncio.gather(
+        loadNamedColors(),
+        asyncio.to_thread(runPhase, "prepare database", stats.prepareDatabase))
+
+async def setup():
+    global initTask, setupTime
+    setupTime = startupProfile.sinceStart()
+    startupProfile.recordPhase("log in", setupTime - loginTime)
+    # A shard process has to be connected to the stats writer before it can
+    # handle any commands
+    if shardCount != None:
+        with startupProfile.phase("connect to stats writer"):
+            writerClient = await asyncio.to_thread(statsWriter.connect)
+            stats.useRemoteWriter(writerClient)
+    initTask = asyncio.create_task(initSubsystems())
+    await startMetricsServer()
+    with startupProfile.phase("add cogs"):
+        await bot.add_cog(SudoCommands(bot))
+        await bot.add_cog(StatsCommands(bot))
+        await bot.add_cog(ColorCommands(bot))
+
+# Reports how long it took to be ready, the first time the bot is. When
+# profiling, the bot stops once the profile has been printed.
+@bot.listen("on_ready")
+async def reportStartup():
+    global setupTime
+    if setupTime == None:
+        return
+    startupProfile.recordPhase("connect to gateway", startupProfile.sinceStart()
+                               - setupTime)
+    await initTask
+    startupProfile.report()
+    setupTime = None
+    if startupProfile.enabled:
+        await bot.close()
 
-asyncio.run(setup(bot))
-bot.run(botToken)
+if __name__ == "__main__":
+    bot.setup_hook = setup
+    loginTime = startupProfile.sinceStart()
+    try:
+        bot.run(botToken)
+    except (discord.LoginFailure, discord.HTTPException, OSError) as startError:
+        if not startupProfile.enabled:
+            raise
+        # Still show how long the rest of startup takes
+        print(f"Could not connect to Discord: {startError}")
+        asyncio.run(initSubsystems())
+        startupProfile.report(ready = False)
@@ -1,10 +1,20 @@
 # This file provides "getter" functions to retrieve the help messages from the
 # JSON file which stores the various texts needed by discord.py's builtin help
 # command.
+#
+# The JSON is only walked once, when it's loaded: every (sub)command is
+# checked and flattened into commandTable, which maps its full name (e.g.,
+# "color clear") to a CommandInfo with the help already joined together, so the
+# getters are a single dictionary lookup. reloadCommandConfig() loads the file
+# again and updates the bot's commands in place, without a restart.
 
-import copy
+import collections
+import discord
+import inspect
 import json
 
+configPath = "commandConfig.json"
+
 # Custom exception to be raised when a command is not found in the JSON.
 class NameNotFoundError(Exception):
     def __init__(self, name):
@@ -13,75 +23,167 @@ class NameNotFoundError(Exception):
     def __str__(self):
         return f"{self.name} was not found"
 
-# Load the JSON file into Python data structures (lists and dictionaries).
-with open("commandConfig.json") as commandHelp:
-    commandConfig = json.load(commandHelp)
-
-# ======================== Helper Functions for Getters ========================
-
-# Given a list of command JSON objects, return a Python dict of the one which
-# name matches the given searchName. If none is found, raise a
-# NameNotFoundError.
-def findNameInList(searchName, searchList):
-    for command in searchList:
-        if command["name"] == searchName:        
-            return command
-    raise NameNotFoundError(searchName)
-
-# Returns the dictionary representing the JSON object of a given
-# (sub)command. For instance, if "color clear" is given, the JSON object for
-# just "color" is discarded. Thus, theDict["name"] would return "clear". If the
-# given command is not in the JSON file, pass along the NameNotFoundError raised
-# by findNameInList().
-def trimCommandConfig(command):
-    splitCommands = command.split(" ")
-    trimmedJSON = copy.deepcopy(commandConfig)
-    lastCommand = splitCommands[len(splitCommands) - 1]
-    for command in splitCommands:
-        # If it's a list of commands, then search through it for the command. If
-        # its name is the last command in the splitCommands list, then it's the
-        # deepest subcommand; return it. Otherwise, we haven't reached the
-        # deepest yet, so we need the next subcommand level.
-        if type(trimmedJSON) == list:
-            trimmedJSON = findNameInList(command, trimmedJSON)
-        if trimmedJSON["name"] == lastCommand:
-            return trimmedJSON
+# Custom exception to be raised when the JSON isn't laid out the way the getters
+# expect; path is the (sub)command it was found in.
+class CommandConfigError(Exception):
+    def __init__(self, path, problem):
+        self.path = path
+        self.problem = problem
+
+    def __str__(self):
+        return f"{self.path or 'commandConfig.json'}: {self.problem}"
+
+# Everything known about one (sub)command. Aliases are a tuple so nothing can
+# change a CommandInfo once it's been compiled.
+CommandInfo = collections.namedtuple("CommandInfo", ["name", "aliases", "brief",
+                                                     "usage", "help"])
+
+# The fields every command's JSON object needs, and the types they can be (help
+# is usually a list of strings, but a short one can be a single string)
+commandFields = {
+    "name": [str],
+    "aliases": [list],
+    "brief": [str],
+    "usage": [str],
+    "help": [list, str],
+    "subcommands": [list],
+}
+
+# ========================== Compiling the JSON File ===========================
+
+# Checks the JSON object for a (sub)command, raising a CommandConfigError if
+# anything is missing or the wrong type
+def validateCommand(path, command):
+    if type(command) != dict:
+        raise CommandConfigError(path, "each command must be an object")
+    for field, fieldTypes in commandFields.items():
+        if field not in command:
+            raise CommandConfigError(path, f"missing \"{field}\"")
+        if type(command[field]) not in fieldTypes:
+            typeNames = " or ".join(fieldType.__name__ for fieldType in fieldTypes)
+            raise CommandConfigError(path, f"\"{field}\" must be a {typeNames}")
+    for listField in ["aliases", "help"]:
+        for value in command[listField]:
+            if type(value) != str:
+                raise CommandConfigError(path, f"\"{listField}\" must only contain strings")
+
+# Adds the given list of commands (and all of their subcommands) to the table,
+# under the given parent's name
+def compileCommands(table, parentPath, commandList):
+    if type(commandList) != list:
+        raise CommandConfigError(parentPath, "commands must be in a list")
+    for command in commandList:
+        if type(command) == dict and type(command.get("name")) == str:
+            path = f"{parentPath} {command['name']}".strip()
         else:
-            trimmedJSON = trimmedJSON["subcommands"]
-    return trimmedJSON
+            path = f"{parentPath} ?".strip()
+        validateCommand(path, command)
+        if path in table:
+            raise CommandConfigError(path, "is listed more than once")
+        # The help is stored as a list of strings due to JSON's inability to
+        # have multi-line strings, so join it together now, once. An empty
+        # alias means none (e.g., sudo's), so it's left out.
+        aliases = tuple(alias for alias in command["aliases"] if alias != "")
+        table[path] = CommandInfo(command["name"], aliases,
+                                  command["brief"], command["usage"],
+                                  "".join(command["help"]))
+        compileCommands(table, path, command["subcommands"])
+
+# Loads and checks the JSON file, returning its table of command name ->
+# CommandInfo. Raises a CommandConfigError (or a ValueError, if it isn't valid
+# JSON) instead of returning anything half-loaded.
+def loadCommandConfig(path = None):
+    with open(path or configPath) as commandHelp:
+        commandConfig = json.load(commandHelp)
+    table = {}
+    compileCommands(table, "", commandConfig)
+    return table
+
+commandTable = loadCommandConfig()
 
 # ============================== Getter Functions ==============================
 # Each of these functions returns a list or string of the given (sub)command's
-# respective field. If the given command is not found, pass along the
-# NameNotFoundError raised by findNameInList() and passed by
-# trimCommandConfig().
+# respective field, given its full name (e.g., "color clear"). If the given
+# command is not found, a NameNotFoundError is raised.
+
+def getCommandInfo(command):
+    info = commandTable.get(command)
+    if info == None:
+        raise NameNotFoundError(command)
+    return info
 
 # getAliases() returns a list of strings
 def getAliases(command):
-    trimmedJSON = trimCommandConfig(command)
-    return trimmedJSON["aliases"]
+    return list(getCommandInfo(command).aliases)
 
 # getBrief() returns a string
 def getBrief(command):
-    trimmedJSON = trimCommandConfig(command)
-    return trimmedJSON["brief"]
+    return getCommandInfo(command).brief
 
 # getUsage() returns a string
 def getUsage(command):
-    trimmedJSON = trimCommandConfig(command)
-    return trimmedJSON["usage"]
+    return getCommandInfo(command).usage
 
 # getHelp() returns a string
 def getHelp(command):
-    trimmedJSON = trimCommandConfig(command)
-    helpList = trimmedJSON["help"]
-    # Concatenates the list of strings into one string to be returned. The help
-    # is stored as a list of strings due to JSON's inability to have multi-line
-    # strings.
-    helpString = ""
-    for fragment in helpList:
-        helpString += fragment
-    return helpString
+    return getCommandInfo(command).help
 
-# ==============================================================================
+# ================================= Hot Reload =================================
 
+# Raises a CommandConfigError if giving the commands their new aliases
+# (command -> tuple of aliases) would leave two commands under the same parent
+# sharing a name or alias. Nothing is changed either way.
+def checkAliasConflicts(bot, newAliases):
+    parents = [bot] + [command for command in bot.walk_commands() if
+                       hasattr(command, "commands")]
+    for parent in parents:
+        taken = {}
+        for command in parent.commands:
+            aliases = newAliases.get(command, tuple(command.aliases))
+            for name in (command.name,) + aliases:
+                owner = taken.get(name)
+                if owner != None and owner != command:
+                    raise CommandConfigError(command.qualified_name,
+                                             f"\"{name}\" is already {owner.qualified_name}'s name or alias")
+                taken[name] = command
+
+# Loads the JSON file again and, if it checks out, updates the help, brief,
+# usage and aliases of the bot's live commands to match and swaps it in. If it
+# doesn't (including if any new alias is already taken), the error is raised
+# and everything is left as it was. Returns how many of the bot's commands
+# were updated.
+def reloadCommandConfig(bot, path = None):
+    global commandTable
+    newTable = loadCommandConfig(path)
+    updates = []
+    for command in list(bot.walk_commands()):
+        info = newTable.get(command.qualified_name)
+        if info != None:
+            updates.append((command, info))
+    checkAliasConflicts(bot, {command: info.aliases for command, info in
+                              updates if tuple(command.aliases) != info.aliases})
+    for command, info in updates:
+        # discord.py cleans up help the same way when a command is made
+        command.help = inspect.cleandoc(info.help)
+        command.brief = info.brief
+        command.usage = info.usage
+        if tuple(command.aliases) != info.aliases:
+            # Aliases are registered with the command's parent, so it has to be
+            # taken off and put back on for new ones to be picked up. If that
+            # fails anyway, it goes back on with its old aliases.
+            parent = command.parent or bot
+            oldAliases = command.aliases
+            parent.remove_command(command.name)
+            command.aliases = list(info.aliases)
+            try:
+                parent.add_command(command)
+            except discord.ClientException:
+                command.aliases = oldAliases
+                parent.add_command(command)
+                raise
+    # Swapping the whole table in one assignment, once every command is up to
+    # date, means nothing ever sees a mix of the old and new files
+    commandTable = newTable
+    return len(updates)
+
+# ==============================================================================
@@ -14,3 +14,111 @@ def getPrefix():
 def getToken():
     token = str(config["Bot"]["DiscordToken"])
     return token
+
+def getColorSourceURL():
+    url = config["Colors"]["SourceURL"]
+    return url
+
+def getColorSnapshotFile():
+    snapshotFile = config["Colors"]["SnapshotFile"]
+    return snapshotFile
+
+def getColorRefreshHours():
+    refreshHours = config["Colors"].getfloat("RefreshHours")
+    return refreshHours
+
+def getTypoDistance():
+    typoDistance = config["Colors"].getint("TypoDistance")
+    return typoDistance
+
+def getAutoCleanup():
+    autoCleanup = config["Colors"].getboolean("AutoCleanup")
+    return autoCleanup
+
+def getCleanupGraceSeconds():
+    graceSeconds = config["Colors"].getfloat("CleanupGraceSeconds")
+    return graceSeconds
+
+def getCleanupConcurrency():
+    concurrency = config["Colors"].getint("CleanupConcurrency")
+    return concurrency
+
+def getPaletteColors():
+    paletteColors = config["Colors"].getint("PaletteColors")
+    return paletteColors
+
+def getPaletteSnapThreshold():
+    snapThreshold = config["Colors"].getfloat("PaletteSnapThreshold")
+    return snapThreshold
+
+def getPaletteConcurrency():
+    concurrency = config["Colors"].getint("PaletteConcurrency")
+    return concurrency
+
+def getStatsCacheSize():
+    cacheSize = config["Stats"].getint("CacheSize")
+    return cacheSize
+
+def getStatsCacheSeconds():
+    cacheSeconds = config["Stats"].getfloat("CacheSeconds")
+    return cacheSeconds
+
+def getRetentionDays():
+    retentionDays = config["Stats"].getfloat("RetentionDays")
+    return retentionDays
+
+def getCompactHours():
+    compactHours = config["Stats"].getfloat("CompactHours")
+    return compactHours
+
+def getCompactBatchSize():
+    batchSize = config["Stats"].getint("CompactBatchSize")
+    return batchSize
+
+def getSwatchCacheSize():
+    cacheSize = config["Swatches"].getint("CacheSize")
+    return cacheSize
+
+def getSearchCacheSize():
+    cacheSize = config["Search"].getint("CacheSize")
+    return cacheSize
+
+def getSearchCacheSeconds():
+    cacheSeconds = config["Search"].getfloat("CacheSeconds")
+    return cacheSeconds
+
+def getSearchPageSize():
+    pageSize = config["Search"].getint("PageSize")
+    return pageSize
+
+def getMetricsHost():
+    host = config["Metrics"]["Host"]
+    return host
+
+def getMetricsPort():
+    port = config["Metrics"].getint("Port")
+    return port
+
+def getShardCount():
+    shardCount = config["Sharding"].getint("ShardCount")
+    return shardCount
+
+def getShardProcesses():
+    processes = config["Sharding"].getint("Processes")
+    return processes
+
+def getWriterHost():
+    host = config["Sharding"]["WriterHost"]
+    return host
+
+def getWriterPort():
+    port = config["Sharding"].getint("WriterPort")
+    return port
+
+# Servers can override some settings in their own [Guild <server ID>] section
+def getSnapThreshold(guildID):
+    guildSection = f"Guild {guildID}"
+    if config.has_option(guildSection, "SnapThreshold"):
+        return config[guildSection].getfloat("SnapThreshold")
+    snapThreshold = config["Colors"].getfloat("SnapThreshold")
+    return snapThreshold
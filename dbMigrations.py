@@ -0,0 +1,169 @@
+# Versioned schema migrations for coloriz.db. The database's user_version
+# says how many of the migrations below have been applied; migrate() applies
+# the rest, in order, each in its own transaction. To change the schema, add a
+# new function to the end of the migrations list; never edit one that has
+# already shipped.
+
+import colorsys
+
+# Shorthand string used in every table to create the sqlID column, which gives
+# each row a unique ID that autoincrements whenever a row is inserted into the
+# table. (To autoincrement it, NULL must be inserted into its column)
+sqlID = "sqlID INTEGER PRIMARY KEY AUTOINCREMENT"
+
+# 1: The original table for color history, as made by the old setupDB.py
+def createColorHistory(curs):
+    curs.execute(f"""
+CREATE TABLE IF NOT EXISTS colorHistory ({sqlID}, userID INTEGER, serverID
+INTEGER, color TEXT, timestamp TEXT, length INTEGER)""")
+
+# 2: Store when each color started as whole seconds since the epoch (UTC)
+# instead of an ISO string, so lengths are a subtraction instead of parsing
+# dates. SQLite can't change a column's type, so the table is rebuilt.
+def useEpochTimestamps(curs):
+    curs.execute(f"""
+CREATE TABLE colorHistoryNew ({sqlID}, userID INTEGER, serverID INTEGER, color
+TEXT, startTime INTEGER, length INTEGER)""")
+    curs.execute("""
+INSERT INTO colorHistoryNew (sqlID, userID, serverID, color, startTime, length)
+SELECT sqlID, userID, serverID, color, CAST(strftime('%s', timestamp) AS INTEGER),
+length FROM colorHistory""")
+    curs.execute("DROP TABLE colorHistory")
+    curs.execute("ALTER TABLE colorHistoryNew RENAME TO colorHistory")
+
+# 3: Every stats query looks up one user on one server, and most only want
+# their active color (length = -1), which gets its own, much smaller, index
+def addHistoryIndexes(curs):
+    curs.execute("""
+CREATE INDEX colorHistoryUser ON colorHistory (serverID, userID)""")
+    curs.execute("""
+CREATE INDEX colorHistoryActive ON colorHistory (serverID, userID)
+WHERE length=-1""")
+
+# 4: Running totals per user per server, kept up to date by stats.py as colors
+# change, so the stats command is one lookup instead of a pass over the
+# user's whole history. userColorTotals holds how long the user has had each
+# color, which is needed to keep track of their most used one.
+def addUserColorStats(curs):
+    curs.execute("""
+CREATE TABLE userColorStats (serverID INTEGER, userID INTEGER, longestColor
+TEXT, longestLength INTEGER, shortestColor TEXT, shortestLength INTEGER,
+totalTime INTEGER, changeCount INTEGER, mostUsedColor TEXT, mostUsedTime
+INTEGER, currentColor TEXT, currentStart INTEGER, PRIMARY KEY (serverID,
+userID))""")
+    curs.execute("""
+CREATE TABLE userColorTotals (serverID INTEGER, userID INTEGER, color TEXT,
+totalTime INTEGER, PRIMARY KEY (serverID, userID, color))""")
+    # Fill them in from the history so far
+    curs.execute("""
+INSERT INTO userColorTotals SELECT serverID, userID, color, sum(length)
+FROM colorHistory WHERE NOT length=-1 GROUP BY serverID, userID, color""")
+    curs.execute("""
+INSERT INTO userColorStats (serverID, userID, totalTime, changeCount)
+SELECT serverID, userID, sum(CASE WHEN length=-1 THEN 0 ELSE length END),
+count(*) FROM colorHistory GROUP BY serverID, userID""")
+    curs.execute("""
+UPDATE userColorStats SET (longestLength, longestColor) = (SELECT max(length),
+color FROM colorHistory WHERE serverID=userColorStats.serverID AND
+userID=userColorStats.userID AND NOT length=-1)""")
+    curs.execute("""
+UPDATE userColorStats SET (shortestLength, shortestColor) = (SELECT
+min(length), color FROM colorHistory WHERE serverID=userColorStats.serverID AND
+userID=userColorStats.userID AND NOT length=-1)""")
+    curs.execute("""
+UPDATE userColorStats SET (mostUsedColor, mostUsedTime) = (SELECT color,
+totalTime FROM userColorTotals WHERE serverID=userColorStats.serverID AND
+userID=userColorStats.userID ORDER BY totalTime DESC LIMIT 1)""")
+    curs.execute("""
+UPDATE userColorStats SET (currentColor, currentStart) = (SELECT color,
+startTime FROM colorHistory WHERE serverID=userColorStats.serverID AND
+userID=userColorStats.userID AND length=-1)""")
+
+# Which of the 12 hue buckets (30 degrees each, starting at red) a hex color
+# falls in, or -1 for grays, which don't really have a hue. stats.py uses this
+# too, so both sort colors the same way.
+def hueBucket(color):
+    red = int(color[1:3], 16) / 255
+    green = int(color[3:5], 16) / 255
+    blue = int(color[5:7], 16) / 255
+    hue, lightness, saturation = colorsys.rgb_to_hls(red, green, blue)
+    if saturation < 0.1 or lightness < 0.05 or lightness > 0.95:
+        return -1
+    return int(hue * 12) % 12
+
+# 5: Running totals per server for stats server. guildColorStats has how often
+# each color was picked, how long it's been held and how many members have it
+# right now; guildHueStats has how often each hue bucket was picked; and
+# guildSummary has how many colors and members are active. The indexes let
+# the leaderboards read just their top few rows.
+def addGuildStats(curs):
+    curs.execute("""
+CREATE TABLE guildColorStats (serverID INTEGER, color TEXT, picks INTEGER,
+totalTime INTEGER, activeCount INTEGER, PRIMARY KEY (serverID, color))""")
+    curs.execute("""
+CREATE TABLE guildHueStats (serverID INTEGER, hueBucket INTEGER, picks INTEGER,
+PRIMARY KEY (serverID, hueBucket))""")
+    curs.execute("""
+CREATE TABLE guildSummary (serverID INTEGER PRIMARY KEY, activeColors INTEGER,
+activeMembers INTEGER)""")
+    curs.execute("""
+CREATE INDEX guildColorPicks ON guildColorStats (serverID, picks)""")
+    curs.execute("""
+CREATE INDEX guildColorTime ON guildColorStats (serverID, totalTime)""")
+    curs.execute("""
+CREATE INDEX userColorChanges ON userColorStats (serverID, changeCount)""")
+    curs.execute("""
+CREATE INDEX userColorLongest ON userColorStats (serverID, longestLength)""")
+    # Fill them in from the history so far
+    curs.execute("""
+INSERT INTO guildColorStats SELECT serverID, color, count(*),
+sum(CASE WHEN length=-1 THEN 0 ELSE length END), sum(length=-1)
+FROM colorHistory GROUP BY serverID, color""")
+    curs.execute("""
+INSERT INTO guildSummary SELECT serverID, sum(activeCount > 0), sum(activeCount)
+FROM guildColorStats GROUP BY serverID""")
+    hueCounts = {}
+    for serverID, color, picks in curs.execute("""
+SELECT serverID, color, picks FROM guildColorStats""").fetchall():
+        key = (serverID, hueBucket(color))
+        hueCounts[key] = hueCounts.get(key, 0) + picks
+    curs.executemany("INSERT INTO guildHueStats VALUES (?, ?, ?)",
+                     [(serverID, bucket, picks) for (serverID, bucket), picks
+                      in hueCounts.items()])
+
+# 6: What's left of colorHistory rows once they're compacted (see
+# compactHistory() in stats.py): for each user and color, how many times they
+# picked it, how long they had it in all, when they first picked it and when
+# they last stopped having it. The other stats tables already count those
+# rows, so they don't change. The partial index finds closed rows by age.
+def addHistoryArchive(curs):
+    curs.execute("""
+CREATE TABLE colorHistoryArchive (serverID INTEGER, userID INTEGER, color TEXT,
+picks INTEGER, totalTime INTEGER, firstStart INTEGER, lastEnd INTEGER,
+PRIMARY KEY (serverID, userID, color))""")
+    curs.execute("""
+CREATE INDEX colorHistoryClosed ON colorHistory (startTime) WHERE NOT length=-1""")
+
+migrations = [
+    createColorHistory,
+    useEpochTimestamps,
+    addHistoryIndexes,
+    addUserColorStats,
+    addGuildStats,
+    addHistoryArchive,
+]
+
+# Brings the database up to date. Returns the number of migrations applied.
+def migrate(conn):
+    curs = conn.cursor()
+    version = curs.execute("PRAGMA user_version").fetchone()[0]
+    for newVersion in range(version + 1, len(migrations) + 1):
+        try:
+            curs.execute("BEGIN")
+            migrations[newVersion - 1](curs)
+            curs.execute(f"PRAGMA user_version = {newVersion}")
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+    return max(0, len(migrations) - version)
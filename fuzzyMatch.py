@@ -0,0 +1,95 @@
+# Typo-tolerant lookups for a list of strings, using a SymSpell-style deletion
+# index. Every string is stored under each variant of itself with up to
+# maxDistance characters deleted. Two strings within maxDistance edits of each
+# other share at least one of those variants, so looking up the variants of a
+# (possibly misspelled) term gives a short list of candidates, which are then
+# checked with a real edit distance. Only deletions are ever generated, which
+# keeps the index small compared to generating every insertion, substitution
+# and transposition too.
+
+# Returns every string that can be made by deleting up to maxDistance
+# characters from the given one, including the string itself
+def getDeletes(string, maxDistance):
+    deletes = {string}
+    edges = {string}
+    for distance in range(maxDistance):
+        nextEdges = set()
+        for edge in edges:
+            for i in range(len(edge)):
+                nextEdges.add(edge[:i] + edge[i + 1:])
+        deletes.update(nextEdges)
+        edges = nextEdges
+    return deletes
+
+# Builds a deletion index over a list of strings. Returns a dictionary mapping
+# each variant to the position of the string that produces it, or a list of
+# positions if more than one does. Most variants only come from one string, so
+# storing those as a plain int instead of a one-item list saves a good chunk of
+# memory.
+def buildDeleteIndex(strings, maxDistance):
+    index = {}
+    for position, string in enumerate(strings):
+        for delete in getDeletes(string, maxDistance):
+            postings = index.get(delete)
+            if postings == None:
+                index[delete] = position
+            elif type(postings) == int:
+                index[delete] = [postings, position]
+            else:
+                postings.append(position)
+    return index
+
+# Returns the optimal string alignment distance (Levenshtein distance, with
+# swapping two neighbouring characters counted as one edit) between two
+# strings, or maxDistance + 1 if it's more than maxDistance. Only the cells
+# within maxDistance of the diagonal can be under the limit, so only those are
+# computed, and it gives up as soon as a whole row is over the limit.
+def editDistance(string1, string2, maxDistance):
+    length1, length2 = len(string1), len(string2)
+    if abs(length1 - length2) > maxDistance:
+        return maxDistance + 1
+    tooFar = maxDistance + 1
+    previousRow = None
+    row = list(range(length2 + 1))
+    for i in range(1, length1 + 1):
+        rowBefore, previousRow = previousRow, row
+        row = [tooFar] * (length2 + 1)
+        row[0] = i
+        start = max(1, i - maxDistance)
+        end = min(length2, i + maxDistance)
+        rowMinimum = row[0] if start == 1 else tooFar
+        for j in range(start, end + 1):
+            cost = 0 if string1[i - 1] == string2[j - 1] else 1
+            value = min(previousRow[j] + 1, row[j - 1] + 1,
+                        previousRow[j - 1] + cost)
+            if (i > 1 and j > 1 and string1[i - 1] == string2[j - 2]
+                    and string1[i - 2] == string2[j - 1]):
+                value = min(value, rowBefore[j - 2] + 1)
+            row[j] = value
+            if value < rowMinimum:
+                rowMinimum = value
+        if rowMinimum > maxDistance:
+            return tooFar
+    return min(row[length2], tooFar)
+
+# Looks up a term in a deletion index built with buildDeleteIndex() (with the
+# same maxDistance). Returns a sorted list of (distance, position) tuples for
+# every string within maxDistance edits of the term, closest (and then first in
+# the list) first.
+def findClose(index, strings, term, maxDistance):
+    candidates = set()
+    for delete in getDeletes(term, maxDistance):
+        postings = index.get(delete)
+        if postings == None:
+            continue
+        if type(postings) == int:
+            candidates.add(postings)
+        else:
+            candidates.update(postings)
+    matches = []
+    for position in candidates:
+        distance = editDistance(term, strings[position], maxDistance)
+        if distance <= maxDistance:
+            matches.append((distance, position))
+    matches.sort()
+    return matches
@@ -0,0 +1,193 @@
+# Latency histograms and counters for the bot, served in Prometheus' text format
+# at http://<Host>:<Port>/metrics (see [Metrics] in config.ini). Recording a
+# value is a couple of list updates under an uncontended lock, so it's cheap
+# enough to do on every command, Discord request and database query; the
+# work of formatting everything only happens when Prometheus scrapes it.
+
+import asyncio
+import bisect
+import contextlib
+import threading
+import time
+
+# Upper bounds (in seconds) of the histogram buckets, from a millisecond up
+# to ten seconds
+defaultBuckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                  2.5, 5, 10]
+
+# Every metric, in the order they're shown
+registry = []
+
+# Formats label names and values the way Prometheus expects, e.g.,
+# {command="color set"}
+def formatLabels(labelNames, labelValues, extra = ""):
+    labels = [f'{name}="{escapeLabel(value)}"' for name, value in
+              zip(labelNames, labelValues)]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(labels) + "}"
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Counter:
+    def __init__(self, name, description, labelNames = ()):
+        self.name = name
+        self.description = description
+        self.labelNames = labelNames
+        # Tuple of label values -> count
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *labelValues, amount = 1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}",
+                 f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = list(self.values.items())
+        for labelValues, value in sorted(values):
+            lines.append(f"{self.name}{formatLabels(self.labelNames, labelValues)} {value}")
+        return lines
+
+class Gauge:
+    def __init__(self, name, description, labelNames = ()):
+        self.name = name
+        self.description = description
+        self.labelNames = labelNames
+        # Tuple of label values -> value
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def set(self, value, *labelValues):
+        with self.lock:
+            self.values[labelValues] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}",
+                 f"# TYPE {self.name} gauge"]
+        with self.lock:
+            values = list(self.values.items())
+        for labelValues, value in sorted(values):
+            lines.append(f"{self.name}{formatLabels(self.labelNames, labelValues)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, description, labelNames = (),
+                 buckets = defaultBuckets):
+        self.name = name
+        self.description = description
+        self.labelNames = labelNames
+        self.buckets = buckets
+        # Tuple of label values -> [count in each bucket (not cumulative, the
+        # last one is for anything over the top bucket), sum of observations]
+        self.series = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, seconds, *labelValues):
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series.get(labelValues)
+            if series == None:
+                series = [[0] * (len(self.buckets) + 1), 0.0]
+                self.series[labelValues] = series
+            series[0][bucket] += 1
+            series[1] += seconds
+
+    # Times everything in the with block
+    @contextlib.contextmanager
+    def time(self, *labelValues):
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - startTime, *labelValues)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}",
+                 f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(labelValues, list(counts), total) for labelValues,
+                      (counts, total) in self.series.items()]
+        for labelValues, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = formatLabels(self.labelNames, labelValues, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            cumulative += counts[-1]
+            labels = formatLabels(self.labelNames, labelValues, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = formatLabels(self.labelNames, labelValues)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+# ================================== Metrics ===================================
+
+commandSeconds = Histogram("coloriz_command_seconds",
+                           "How long each command took to run", ("command",))
+commandErrors = Counter("coloriz_command_errors_total",
+                        "Commands which raised an error", ("command", "error"))
+discordSeconds = Histogram("coloriz_discord_request_seconds",
+                           "How long each Discord REST request took, including retries",
+                           ("route",))
+discordErrors = Counter("coloriz_discord_request_errors_total",
+                        "Discord REST requests which failed", ("route", "status"))
+rateLimits = Counter("coloriz_discord_rate_limits_total",
+                     "Discord REST requests which were rate limited", ("route",))
+sqliteSeconds = Histogram("coloriz_sqlite_seconds",
+                          "How long each SQLite query or commit took", ("query",))
+sqliteErrors = Counter("coloriz_sqlite_errors_total",
+                       "SQLite queries and stats writes which raised an error", ("query",))
+databaseBytes = Gauge("coloriz_database_bytes",
+                      "Size of the stats database before and after the last compaction",
+                      ("stage",))
+databaseFreeBytes = Gauge("coloriz_database_free_bytes",
+                          "Unused space in the stats database before and after the last compaction",
+                          ("stage",))
+databaseRows = Gauge("coloriz_database_rows",
+                     "Rows in each history table before and after the last compaction",
+                     ("table", "stage"))
+compactedRows = Counter("coloriz_history_rows_compacted_total",
+                        "colorHistory rows rolled up into colorHistoryArchive and deleted")
+
+# Returns every metric in Prometheus' text format
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# ================================= HTTP Server ================================
+# Just enough HTTP to answer a scrape: every request gets the metrics, and the
+# connection is closed afterwards.
+
+async def handleRequest(reader, writer):
+    try:
+        # Read (and ignore) the request line and headers
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+        body = render().encode("utf-8")
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     + f"Content-Length: {len(body)}\r\n".encode("ascii") +
+                     b"Connection: close\r\n\r\n" + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+# Starts serving the metrics on the event loop. Returns the asyncio Server.
+async def startServer(host, port):
+    return await asyncio.start_server(handleRequest, host, port)
@@ -1,48 +1,223 @@
+import array
+import collections
+import colorSpace
+import config
 import csv
+import fuzzyMatch
+import hashlib
+import io
 import math
+import os
+import struct
+import sys
+import threading
 import unicodedata
-import requests
-
-# (Re)download the colorNames.csv from meodai's repo on GitHub
-# https://github.com/meodai/color-names
-colorNamesURL = "https://raw.githubusercontent.com/meodai/color-names/master/dist/colornames.csv"
-r = requests.get(colorNamesURL)
-
-# Write the data to a csv, overwriting any previous versions
-with open("colorNames.csv", "wb") as f:
-    f.write(r.content)
-f.close()
-
-# Load names and RGB values from colorNames.csv into a list of dictionaries to
-# be used by the colorByName() function. The columns, in order, are name, hex
-colorDictList = []
-with open("colorNames.csv", newline='') as csvColors:
-    colorReader = csv.DictReader(csvColors)
-    for row in colorReader:
-        colorDictList.append(row)
-csvColors.close()
-
-# Normalize every name in the list of color dictionaries (replace all 'special'
-# characters with their ASCII counterparts, e.g., á becomes a). While this may
-# not be the ideal solution, it will work fine enough for these purposes.
-for color in colorDictList:
-    # If the color name is already normalized, skip it
-    if unicodedata.is_normalized("NFD", color["name"]):
-        continue
+
+# The named colors come from meodai's repo on GitHub
+# (https://github.com/meodai/color-names). Rather than downloading and parsing
+# the CSV every time the bot starts, the parsed names are kept in a snapshot
+# file which is loaded at import. The snapshot is only rebuilt from upstream
+# when refreshNamedColors() is called.
+colorNamesURL = config.getColorSourceURL()
+snapshotPath = config.getColorSnapshotFile()
+typoDistance = config.getTypoDistance()
+
+# ============================== Snapshot Format ===============================
+# The snapshot is a small header followed by four blobs: the normalized names,
+# their lowercase keys, and their hex values (each joined with newlines, in the
+# same order, sorted by key), then the ETag upstream sent with the CSV. The
+# header holds a magic string, the format version, the number of colors, the
+# SHA-256 of the CSV the snapshot was built from, and the length of each blob.
+snapshotMagic = b"CLRZ"
+snapshotVersion = 1
+snapshotHeader = struct.Struct("<4sHI32sIIIH")
+
+# Normalize a color name (replace all 'special' characters with their ASCII
+# counterparts, e.g., á becomes a). While this may not be the ideal solution,
+# it will work fine enough for these purposes.
+def normalizeName(name):
+    # If the color name is already normalized, leave it be
+    if unicodedata.is_normalized("NFD", name):
+        return name
     # Normalize the color name and remove the decomposed non-ASCII strings
-    norm = unicodedata.normalize("NFD", color["name"])
-    encodedString =  norm.encode("ascii", "ignore")
-    color["name"] = encodedString.decode()
+    norm = unicodedata.normalize("NFD", name)
+    encodedString = norm.encode("ascii", "ignore")
+    return encodedString.decode()
+
+# Parses the raw bytes of the upstream CSV (columns, in order, are name, hex)
+# and returns three lists: the normalized names, their lowercase keys and their
+# hex values, sorted by key so findNamedColorHex() can binary search them.
+def parseColorCSV(data):
+    rows = []
+    colorReader = csv.DictReader(io.StringIO(data.decode("utf-8"), newline = ''))
+    for row in colorReader:
+        name = normalizeName(row["name"])
+        rows.append((name.lower(), name, row["hex"].lower()))
+    rows.sort()
+    keys = [row[0] for row in rows]
+    names = [row[1] for row in rows]
+    hexes = [row[2] for row in rows]
+    return names, keys, hexes
+
+# Writes the snapshot to the given path. It's written to a temporary file first
+# and moved into place so a crash never leaves a half-written snapshot behind.
+def writeSnapshot(path, names, keys, hexes, sourceHash, etag):
+    namesBlob = "\n".join(names).encode("utf-8")
+    keysBlob = "\n".join(keys).encode("utf-8")
+    hexesBlob = "\n".join(hexes).encode("ascii")
+    etagBlob = (etag or "").encode("utf-8")
+    header = snapshotHeader.pack(snapshotMagic, snapshotVersion, len(names),
+                                 sourceHash, len(namesBlob), len(keysBlob),
+                                 len(hexesBlob), len(etagBlob))
+    # Shard processes can all be writing one at once, so each has its own
+    tempPath = f"{path}.{os.getpid()}.tmp"
+    with open(tempPath, "wb") as snapshotFile:
+        snapshotFile.write(header + namesBlob + keysBlob + hexesBlob + etagBlob)
+    os.replace(tempPath, path)
+
+# Reads a snapshot, returning the names, keys, hexes, source hash and ETag. A
+# ValueError is raised if the file isn't a snapshot this version can read.
+def readSnapshot(path):
+    with open(path, "rb") as snapshotFile:
+        data = snapshotFile.read()
+    if len(data) < snapshotHeader.size:
+        raise ValueError(f"{path} is too short to be a color snapshot")
+    (magic, version, count, sourceHash, namesLength, keysLength, hexesLength,
+     etagLength) = snapshotHeader.unpack_from(data)
+    if magic != snapshotMagic or version != snapshotVersion:
+        raise ValueError(f"{path} is not a version {snapshotVersion} color snapshot")
+    offset = snapshotHeader.size
+    blobs = []
+    for length in [namesLength, keysLength, hexesLength, etagLength]:
+        blobs.append(data[offset:offset + length].decode("utf-8"))
+        offset += length
+    if count == 0:
+        names, keys, hexes = [], [], []
+    else:
+        names = blobs[0].split("\n")
+        keys = blobs[1].split("\n")
+        hexes = blobs[2].split("\n")
+    if not len(names) == len(keys) == len(hexes) == count:
+        raise ValueError(f"{path} is truncated or corrupt")
+    return names, keys, hexes, sourceHash, blobs[3] or None
+
+# ============================== Loading / Refreshing ==========================
+
+# A loaded set of named colors and everything built from them: parallel lists
+# of names, lowercase keys and hex values, the indexes over them, and where
+# they came from. None of it is changed once it's built.
+NamedColorSet = collections.namedtuple("NamedColorSet", ["names", "keys",
+                                                         "hexes",
+                                                         "trigramIndex",
+                                                         "labPoints", "labTree",
+                                                         "typoIndex",
+                                                         "sourceHash", "etag"])
+
+# The colors in use. Loading new ones builds a whole new NamedColorSet and then
+# swaps it in with one assignment, and every lookup takes currentColors once
+# and only uses that, so lookups running on another thread during a refresh
+# see either the old colors or the new ones, never a mix.
+currentColors = NamedColorSet([], [], [], {}, [], None, {}, bytes(32), None)
+
+# Swaps in a new set of named colors, with all of its indexes built
+def loadNamedColors(names, keys, hexes, sourceHash = bytes(32), etag = None):
+    global currentColors
+    labPoints, labTree = buildNearestIndex(hexes)
+    currentColors = NamedColorSet(names, keys, hexes, buildSearchIndex(keys),
+                                  labPoints, labTree,
+                                  fuzzyMatch.buildDeleteIndex(keys, typoDistance),
+                                  sourceHash, etag)
+
+# Returns how many named colors are loaded
+def countNamedColors():
+    return len(currentColors.names)
+
+# Builds a snapshot from CSV data and loads it. Returns True if the colors
+# changed, False if the data was the same as what's already loaded.
+def loadFromCSVData(data, etag = None, path = None):
+    global currentColors
+    path = path or snapshotPath
+    sourceHash = hashlib.sha256(data).digest()
+    current = currentColors
+    if sourceHash == current.sourceHash:
+        # Same list as before, just remember the new ETag
+        writeSnapshot(path, current.names, current.keys, current.hexes,
+                      sourceHash, etag)
+        currentColors = current._replace(etag = etag)
+        return False
+    names, keys, hexes = parseColorCSV(data)
+    writeSnapshot(path, names, keys, hexes, sourceHash, etag)
+    loadNamedColors(names, keys, hexes, sourceHash, etag)
+    return True
+
+# Loads the named colors from a local copy of the CSV, e.g., one downloaded by
+# hand, and rebuilds the snapshot from it.
+def loadFromCSV(csvPath, path = None):
+    with open(csvPath, "rb") as csvFile:
+        return loadFromCSVData(csvFile.read(), path = path)
+
+# Downloads the CSV from upstream (or the given URL) and rebuilds the snapshot
+# if it changed. The request is conditional: if upstream says the file hasn't
+# changed since the ETag saved in the snapshot, nothing is downloaded or
+# parsed. Returns True if the colors changed. This blocks, so the bot calls it
+# off the event loop.
+def refreshNamedColors(url = None, timeout = 30):
+    # requests takes a noticeable part of a second to import, and is only
+    # needed here, so it isn't imported until the first refresh
+    import requests
+    # The ETag of whatever is on disk is needed to skip an unchanged list
+    ensureLoaded()
+    headers = {}
+    if currentColors.etag != None:
+        headers["If-None-Match"] = currentColors.etag
+    r = requests.get(url or colorNamesURL, headers = headers, timeout = timeout)
+    if r.status_code == 304:
+        return False
+    r.raise_for_status()
+    return loadFromCSVData(r.content, r.headers.get("ETag"))
 
-# Searches through the list of colorDicts and returns the hex value for the
+# Nothing is loaded when this module is imported: the first lookup (or the bot's
+# setup, which does it on a worker thread while it connects) calls
+# ensureLoaded(), which loads the snapshot once. Any other lookups made
+# meanwhile wait for it to finish.
+loaded = False
+loadLock = threading.Lock()
+
+def ensureLoaded():
+    global loaded
+    if loaded:
+        return
+    with loadLock:
+        if not loaded:
+            loadSnapshot()
+            loaded = True
+
+# Loads whatever snapshot is on disk. If there isn't a usable one, fall back to
+# a colorNames.csv left over from older versions of the bot; failing that,
+# start with no named colors rather than blocking startup on the network (the
+# bot then downloads them in the background, see coloriz.py).
+def loadSnapshot(path = None):
+    path = path or snapshotPath
+    try:
+        loadNamedColors(*readSnapshot(path))
+        return
+    except (FileNotFoundError, ValueError) as snapshotError:
+        print(f"Could not load color snapshot: {snapshotError}")
+    if os.path.exists("colorNames.csv"):
+        loadFromCSV("colorNames.csv", path)
+    else:
+        print("No named colors loaded yet, they need downloading from upstream")
+
+# Searches through the list of color keys and returns the hex value for the
 # given color if the name is found. If not, a NameError is raised
 def findNamedColorHex(color):
+    ensureLoaded()
+    keys, hexes = currentColors.keys, currentColors.hexes
     # These bounds are changed as the binary search occurs
     lowerBound = 0
-    upperBound = len(colorDictList) - 1
+    upperBound = len(keys) - 1
     # Search until the bounds overlap
     while lowerBound <= upperBound:
-    #for foo in range(0,20):
         # Add the lower bound to the section length, divide by 2, and floor it,
         # getting a whole number instead of a decimal, in case of odd-numbered
         # lengths. Adding the lower bound is necessary because the length
@@ -53,23 +228,167 @@ def findNamedColorHex(color):
         # comes after the middle index (later in the alphabet) of that section,
         # disregard the upper half and repeat. If the color is equal to the one
         # at the middle index, then we've found our color
-        if color < colorDictList[middleIndex]["name"].lower():
+        if color < keys[middleIndex]:
             # Lower bound is unchanged
             upperBound = middleIndex - 1
-        elif color > colorDictList[middleIndex]["name"].lower():
+        elif color > keys[middleIndex]:
             lowerBound = middleIndex + 1
             # Upper bound is unchanged
-        elif color == colorDictList[middleIndex]["name"].lower():
-            return colorDictList[middleIndex]["hex"]
+        elif color == keys[middleIndex]:
+            return hexes[middleIndex]
     # If the while loop exits without returning anything, the color was not
     # found, raise an error
     raise NameError(f"\"{color}\" is not a named color")
 
-# Search through the list of named colors and return a list of color names that
-# match the given search term.
-def searchNamedColors(name):
+# ============================= Search Trigram Index ============================
+# Substring searches go through an inverted index of trigrams (every run of
+# three characters in a lowercased name) instead of scanning every named
+# color. Each trigram maps to a list of indices into the keys, in
+# ascending (alphabetical) order. Any name containing the search term must
+# contain all of the search term's trigrams, so intersecting their lists gives
+# a small set of candidates which are then checked for real.
+
+# Length of the n-grams stored in the index. Search terms shorter than this
+# can't be looked up in the index and fall back to a scan of the keys.
+gramLength = 3
+
+# Returns the set of trigrams found in the given (lowercase) string
+def getTrigrams(string):
+    trigrams = set()
+    for i in range(len(string) - gramLength + 1):
+        trigrams.add(string[i:i + gramLength])
+    return trigrams
+
+# Builds the trigram index for the given list of keys. This is done once when
+# the names are loaded so the searches never have to lowercase or walk the
+# whole list themselves.
+def buildSearchIndex(keys):
+    index = {}
+    for position, key in enumerate(keys):
+        for trigram in getTrigrams(key):
+            postings = index.get(trigram)
+            if postings == None:
+                index[trigram] = [position]
+            else:
+                postings.append(position)
+    return index
+
+# Returns the indices of the colors in the NamedColorSet which *might* contain
+# the search term. Starts from the shortest posting list and intersects it with
+# the others; if any trigram isn't in the index at all, nothing can match.
+def findCandidates(colors, term):
+    if len(term) < gramLength:
+        return range(len(colors.keys))
+    postingLists = []
+    for trigram in getTrigrams(term):
+        postings = colors.trigramIndex.get(trigram)
+        if postings == None:
+            return []
+        postingLists.append(postings)
+    postingLists.sort(key = len)
+    candidates = set(postingLists[0])
+    for postings in postingLists[1:]:
+        candidates.intersection_update(postings)
+        if len(candidates) == 0:
+            break
+    return candidates
+
+# Ranks how well a color name matches the search term, lower is better: 0 for
+# an exact match, 1 if the name starts with the term, 2 if the term starts one
+# of the name's other words, and 3 for any other substring match.
+def matchRank(term, key):
+    if key == term:
+        return 0
+    if key.startswith(term):
+        return 1
+    if f" {term}" in key or f"-{term}" in key:
+        return 2
+    return 3
+
+# ============================== Typo Tolerance ================================
+# Misspelled names are matched through a deletion index over the keys (see
+# fuzzyMatch.py), built once when the names load. TypoDistance in config.ini
+# sets how many typos are allowed.
+
+# Returns the hex value of the only named color within typoDistance edits of the
+# given (lowercase) name that's closer than all the others, along with its name.
+# If there isn't exactly one such color, a NameError suggesting the closest
+# few is raised instead.
+def findCorrectedNamedColorHex(color):
+    ensureLoaded()
+    current = currentColors
+    names, hexes = current.names, current.hexes
+    matches = fuzzyMatch.findClose(current.typoIndex, current.keys, color,
+                                   typoDistance)
+    if len(matches) == 1 or (len(matches) > 1 and
+                             matches[0][0] < matches[1][0]):
+        position = matches[0][1]
+        return hexes[position], names[position]
+    if len(matches) == 0:
+        raise NameError(f"\"{color}\" is not a named color")
+    suggestions = ", ".join(names[position] for distance, position in
+                            matches[:3])
+    raise NameError(f"\"{color}\" is not a named color, did you mean: {suggestions}?")
+
+# ============================ Nearest Named Color =============================
+# Every named color is converted to CIELAB once when the names load and put in
+# a k-d tree (see colorSpace.py), so finding the named color closest to any
+# RGB color only touches a few dozen of them.
+
+# Returns the Lab points for the given hex values and a k-d tree over them
+def buildNearestIndex(hexes):
+    points = []
+    for hexValue in hexes:
+        red = int(hexValue[1:3], 16)
+        green = int(hexValue[3:5], 16)
+        blue = int(hexValue[5:7], 16)
+        points.append(colorSpace.rgbToLab(red, green, blue))
+    return points, colorSpace.buildKDTree(points)
+
+# Finds the named color that looks closest to the given RGB color. Returns its
+# name, hex value, and ΔE from the given color. If no named colors are loaded,
+# a NameError is raised.
+def findNearestNamedColor(red, green, blue):
+    ensureLoaded()
+    current = currentColors
+    lab = colorSpace.rgbToLab(red, green, blue)
+    index, distance = colorSpace.findNearest(current.labTree, current.labPoints,
+                                             lab)
+    if index == None:
+        raise NameError("No named colors are loaded")
+    return current.names[index], current.hexes[index], distance
+
+# ==============================================================================
+
+# Searches the named colors for names containing the given search term.
+# Returns the lists of names and hex values the matches are in, and the
+# matches' positions in them, best first with ties broken alphabetically (as an
+# array, so a search matching most of the colors stays small). Reloading the
+# named colors swaps in a new NamedColorSet rather than changing this one, so
+# the positions keep pointing at the same colors.
+def searchNamedColorPositions(name):
+    ensureLoaded()
+    current = currentColors
+    term = name.lower()
     matches = []
-    for namedColor in colorDictList:
-        if name in namedColor["name"].lower():
-            matches.append(namedColor["name"])
-    return matches
+    for index in findCandidates(current, term):
+        key = current.keys[index]
+        if term in key:
+            matches.append((matchRank(term, key), index))
+    matches.sort()
+    return current.names, current.hexes, array.array("I", [index for rank, index
+                                                           in matches])
+
+# Running this module directly refreshes the snapshot: from upstream with
+# --refresh, or from a local copy of the CSV with --csv <path>
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--csv":
+        ensureLoaded()
+        changed = loadFromCSV(sys.argv[2])
+    elif len(sys.argv) > 1 and sys.argv[1] == "--refresh":
+        changed = refreshNamedColors()
+    else:
+        print("Usage: python namedColors.py --refresh | --csv <path>")
+        sys.exit(1)
+    print(f"{countNamedColors()} named colors, "
+          f"{'updated' if changed else 'already up to date'}")
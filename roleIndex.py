@@ -0,0 +1,226 @@
+# Keeps track of every guild's color roles (the roles named after a hex code,
+# e.g., "#ff0000") and which one each member has, so commands don't have to
+# walk every role in the guild to find them. The index for a guild is built
+# from the guild's cached roles and members the first time it's needed (or on
+# on_ready) and kept up to date from the gateway events coloriz.py passes
+# along. If an event might have been missed (e.g., after a reconnect), the
+# index is thrown out and rebuilt on next use; checkIndex() can also compare it
+# against the guild to catch anything that slipped through.
+
+import colorSpace
+
+# Maps guild IDs to their GuildColorRoles
+guildIndexes = {}
+
+# Returns True if the given role is a color role
+def isColorRole(role):
+    return role.name.startswith("#")
+
+# Returns the CIELAB color for a color role's name, or None if the name isn't a
+# proper hex code (it's still a color role, it just can't be snapped to)
+def hexToLab(hexName):
+    if len(hexName) != 7:
+        return None
+    try:
+        red = int(hexName[1:3], 16)
+        green = int(hexName[3:5], 16)
+        blue = int(hexName[5:7], 16)
+    except ValueError:
+        return None
+    return colorSpace.rgbToLab(red, green, blue)
+
+# The color roles for one guild. Roles are stored by ID and looked up through
+# the guild when needed, so the index never holds on to an out-of-date Role.
+class GuildColorRoles:
+    def __init__(self, guild):
+        self.guild = guild
+        # Lowercase role name (hex code) -> role ID
+        self.hexRoles = {}
+        # Lowercase role name -> the role's color in CIELAB, for snapping
+        self.hexLabs = {}
+        # Member ID -> role ID of the member's color role
+        self.memberRoles = {}
+        # Role ID -> how many members have it
+        self.roleMemberCounts = {}
+        for role in guild.roles:
+            self.addRole(role)
+        for member in guild.members:
+            self.updateMember(member)
+
+    # Returns a snapshot of the index's contents, used to compare it against a
+    # freshly built one
+    def contents(self):
+        roleMemberCounts = {roleID: count for roleID, count in
+                            self.roleMemberCounts.items() if count > 0}
+        return self.hexRoles, self.memberRoles, roleMemberCounts
+
+    def getRole(self, roleID):
+        if roleID == None:
+            return None
+        return self.guild.get_role(roleID)
+
+    def addRole(self, role):
+        if isColorRole(role):
+            hexName = role.name.lower()
+            self.hexRoles[hexName] = role.id
+            if hexName not in self.hexLabs:
+                self.hexLabs[hexName] = hexToLab(hexName)
+
+    def removeRole(self, role):
+        if self.hexRoles.get(role.name.lower()) == role.id:
+            del self.hexRoles[role.name.lower()]
+            self.hexLabs.pop(role.name.lower(), None)
+        if self.roleMemberCounts.pop(role.id, 0) > 0:
+            for memberID, roleID in list(self.memberRoles.items()):
+                if roleID == role.id:
+                    del self.memberRoles[memberID]
+
+    # Sets the member's color role (None for no color role), keeping the
+    # member counts in step
+    def setMemberRole(self, memberID, roleID):
+        oldRoleID = self.memberRoles.get(memberID)
+        if oldRoleID == roleID:
+            return
+        if oldRoleID != None:
+            self.roleMemberCounts[oldRoleID] -= 1
+            del self.memberRoles[memberID]
+        if roleID != None:
+            self.roleMemberCounts[roleID] = self.roleMemberCounts.get(roleID, 0) + 1
+            self.memberRoles[memberID] = roleID
+
+    # Sets the member's color role from their list of roles
+    def updateMember(self, member):
+        for role in member.roles:
+            if isColorRole(role):
+                self.setMemberRole(member.id, role.id)
+                return
+        self.setMemberRole(member.id, None)
+
+# ============================== Index Lookups =================================
+
+# Returns the index for the guild, building it if there isn't one yet
+def getIndex(guild):
+    index = guildIndexes.get(guild.id)
+    if index == None:
+        index = rebuildIndex(guild)
+    return index
+
+def rebuildIndex(guild):
+    index = GuildColorRoles(guild)
+    guildIndexes[guild.id] = index
+    return index
+
+# Drops the index for the given guild (or every guild if none is given); it's
+# rebuilt the next time it's used
+def invalidate(guildID = None):
+    if guildID == None:
+        guildIndexes.clear()
+    else:
+        guildIndexes.pop(guildID, None)
+
+# Compares the guild's index against a freshly built one, replacing it if they
+# differ. Returns True if the index was already correct (or there isn't one to
+# check).
+def checkIndex(guild):
+    index = guildIndexes.get(guild.id)
+    if index == None:
+        return True
+    freshIndex = rebuildIndex(guild)
+    return index.contents() == freshIndex.contents()
+
+# Returns the color role with the given name (a hex code like "#ff0000"), or
+# None if there isn't one
+def findColorRole(guild, hexName):
+    index = getIndex(guild)
+    return index.getRole(index.hexRoles.get(hexName.lower()))
+
+# Returns the member's color role, or None if they don't have one
+def getMemberColorRole(guild, member):
+    index = getIndex(guild)
+    return index.getRole(index.memberRoles.get(member.id))
+
+# Returns a list of all of the guild's color roles
+def getColorRoles(guild):
+    index = getIndex(guild)
+    roles = [index.getRole(roleID) for roleID in index.hexRoles.values()]
+    return [role for role in roles if role != None]
+
+# Returns the color role closest to the given color, as long as it's within
+# maxDistance (ΔE), or None if there isn't one that close. A guild can't have
+# more than 250 roles, so checking each of them is only a few hundred
+# subtractions; the Lab values are worked out when the roles are indexed.
+def findNearestColorRole(guild, red, green, blue, maxDistance):
+    index = getIndex(guild)
+    lab = colorSpace.rgbToLab(red, green, blue)
+    nearestHex = None
+    nearestDistance = maxDistance * maxDistance
+    for hexName, roleLab in index.hexLabs.items():
+        if roleLab == None:
+            continue
+        distance = colorSpace.deltaESquared(lab, roleLab)
+        if distance <= nearestDistance:
+            nearestHex = hexName
+            nearestDistance = distance
+    if nearestHex == None:
+        return None
+    return index.getRole(index.hexRoles[nearestHex])
+
+def countColorRoles(guild):
+    return len(getIndex(guild).hexRoles)
+
+# Returns a list of the guild's color roles which nobody has
+def getUnusedColorRoles(guild):
+    index = getIndex(guild)
+    roles = [index.getRole(roleID) for roleID in index.hexRoles.values() if
+             index.roleMemberCounts.get(roleID, 0) == 0]
+    return [role for role in roles if role != None]
+
+# Returns True if the role is a color role nobody has
+def isUnusedColorRole(guild, role):
+    index = getIndex(guild)
+    return (index.hexRoles.get(role.name.lower()) == role.id and
+            index.roleMemberCounts.get(role.id, 0) == 0)
+
+# Records a change the bot made itself, so the index is right straight away
+# rather than once the gateway event arrives
+def setMemberColorRole(guild, member, role):
+    index = getIndex(guild)
+    if role == None:
+        index.setMemberRole(member.id, None)
+    else:
+        index.addRole(role)
+        index.setMemberRole(member.id, role.id)
+
+# ============================== Gateway Events ================================
+# Called by the listeners in coloriz.py. Guilds which don't have an index yet
+# are skipped; theirs is built from scratch when it's first needed.
+
+def roleCreated(role):
+    index = guildIndexes.get(role.guild.id)
+    if index != None:
+        index.addRole(role)
+
+def roleUpdated(before, after):
+    index = guildIndexes.get(after.guild.id)
+    if index != None and before.name != after.name:
+        index.removeRole(before)
+        index.addRole(after)
+        # Members with the role keep it, but it might only now be (or no
+        # longer be) a color role
+        for member in after.members:
+            index.updateMember(member)
+
+def roleDeleted(role):
+    index = guildIndexes.get(role.guild.id)
+    if index != None:
+        index.removeRole(role)
+
+def memberUpdated(before, after):
+    index = guildIndexes.get(after.guild.id)
+    if index != None and before.roles != after.roles:
+        index.updateMember(after)
+
+def memberRemoved(member):
+    index = guildIndexes.get(member.guild.id)
+    if index != None:
+        index.setMemberRole(member.id, None)
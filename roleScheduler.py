@@ -0,0 +1,193 @@
+# Every change to someone's color role goes through here instead of straight
+# to Discord. Changes for the same member are applied one at a time, and if
+# someone asks for a new color while an earlier one is still waiting to be
+# applied, the earlier one is dropped: only the latest color is sent to
+# Discord, and everyone waiting on that member gets told about the final
+# result once it's in place. Newly created roles are moved into place together
+# in one edit_role_positions call instead of one call per role.
+
+import asyncio
+import colorCommands
+import discord
+import metrics
+import time
+
+# How long to wait for other new roles before moving them into place, and how
+# many times to retry a request Discord rate limited
+positionBatchDelay = 0.5
+maxRateLimitRetries = 3
+
+# Maps guild IDs to their GuildScheduler
+schedulers = {}
+
+# Counters shown by sudo scheduler
+appliedCount = 0
+coalescedCount = 0
+rateLimitCount = 0
+positionBatchCount = 0
+
+# A change waiting to be applied: the color to set the member to (None to
+# clear it), and the futures of every request waiting on it
+class PendingChange:
+    def __init__(self, color):
+        self.color = color
+        self.futures = []
+
+class GuildScheduler:
+    def __init__(self, guild):
+        self.guild = guild
+        # Member ID -> PendingChange that hasn't been started yet
+        self.pending = {}
+        # Member ID -> task applying that member's changes
+        self.workers = {}
+        # Roles waiting to be moved -> futures waiting on the move
+        self.positionBatch = {}
+        self.positionTask = None
+
+    # Queues a color change for the member and waits for the member's final
+    # color to be applied. Returns whatever colorCommands.applyColor() returns
+    # for that final change, which is (None, False) if it was a clear, even
+    # for a request to set a color.
+    async def setColor(self, member, color):
+        global coalescedCount
+        future = asyncio.get_running_loop().create_future()
+        change = self.pending.get(member.id)
+        if change == None:
+            change = PendingChange(color)
+            self.pending[member.id] = change
+        else:
+            # An earlier change hasn't been started yet, this one replaces it
+            change.color = color
+            coalescedCount += 1
+        change.futures.append(future)
+        if member.id not in self.workers:
+            self.workers[member.id] = asyncio.create_task(self.runMember(member))
+        return await future
+
+    # Applies the member's changes until there are none left waiting
+    async def runMember(self, member):
+        global appliedCount
+        try:
+            while member.id in self.pending:
+                change = self.pending.pop(member.id)
+                try:
+                    result = await colorCommands.applyColor(self.guild, member,
+                                                            change.color)
+                except Exception as applyError:
+                    resolveFutures(change.futures, error = applyError)
+                else:
+                    appliedCount += 1
+                    resolveFutures(change.futures, result)
+        finally:
+            del self.workers[member.id]
+
+    # Queues a newly created role to be moved into place and waits until it
+    # has been. Roles queued within positionBatchDelay of each other are all
+    # moved in one request.
+    async def moveRole(self, role):
+        future = asyncio.get_running_loop().create_future()
+        self.positionBatch[role] = future
+        if self.positionTask == None:
+            self.positionTask = asyncio.create_task(self.flushPositions())
+        await future
+
+    async def flushPositions(self):
+        global positionBatchCount
+        await asyncio.sleep(positionBatchDelay)
+        batch = self.positionBatch
+        self.positionBatch = {}
+        self.positionTask = None
+        # The top color role will be the one directly under the bot's own top
+        # role
+        topColorRoleNum = colorCommands.getBotTopRoleNum(self.guild) - 1
+        positions = {role: topColorRoleNum for role in batch}
+        try:
+            await callDiscord(lambda: self.guild.edit_role_positions(positions =
+                                                                     positions),
+                              "edit_role_positions")
+            positionBatchCount += 1
+        except (discord.HTTPException, discord.RateLimited):
+            roleNames = ", ".join(str(role) for role in batch)
+            print(f"Something went wrong moving {roleNames} to position {topColorRoleNum}")
+        resolveFutures(batch.values())
+
+# Tells every request still waiting on the futures about the result (or the
+# error, if there is one). A request which was cancelled (e.g., the command
+# timed out) has a future that's already done, so it's skipped; nothing that
+# goes wrong here is allowed to stop a member's later changes being applied.
+def resolveFutures(futures, result = None, error = None):
+    for future in futures:
+        if future.done():
+            continue
+        try:
+            if error != None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except Exception as resolveError:
+            print(f"Could not hand back a color change's result: {resolveError}")
+
+# Returns the scheduler for the guild, making one if there isn't one yet
+def getScheduler(guild):
+    scheduler = schedulers.get(guild.id)
+    if scheduler == None:
+        scheduler = GuildScheduler(guild)
+        schedulers[guild.id] = scheduler
+    return scheduler
+
+async def setColor(guild, member, color):
+    return await getScheduler(guild).setColor(member, color)
+
+async def moveRole(guild, role):
+    await getScheduler(guild).moveRole(role)
+
+# Makes a request to Discord (makeCall returns the coroutine to await), waiting
+# out and retrying rate limits. discord.py already waits out the rate limits it
+# sees coming from the response headers; this catches the ones it gives up on,
+# using the Retry-After Discord sent back. route names the request in the
+# metrics (e.g., "add_roles"); its time there includes any retries.
+async def callDiscord(makeCall, route = "other"):
+    startTime = time.perf_counter()
+    try:
+        return await callWithRetries(makeCall, route)
+    except discord.HTTPException as httpError:
+        metrics.discordErrors.inc(route, httpError.status)
+        raise
+    except discord.RateLimited:
+        metrics.discordErrors.inc(route, 429)
+        raise
+    finally:
+        metrics.discordSeconds.observe(time.perf_counter() - startTime, route)
+
+async def callWithRetries(makeCall, route):
+    global rateLimitCount
+    for attempt in range(maxRateLimitRetries + 1):
+        try:
+            return await makeCall()
+        except discord.RateLimited as rateLimit:
+            lastError = rateLimit
+            retryAfter = rateLimit.retry_after
+        except discord.HTTPException as httpError:
+            if httpError.status != 429:
+                raise
+            lastError = httpError
+            retryAfter = float(httpError.response.headers.get("Retry-After", 1))
+        rateLimitCount += 1
+        metrics.rateLimits.inc(route)
+        if attempt < maxRateLimitRetries:
+            await asyncio.sleep(retryAfter)
+    raise lastError
+
+# Returns the counters, plus how many members have a change waiting and how
+# many are having one applied right now, across every guild
+def getSchedulerStats():
+    return {
+        "queueDepth": sum(len(scheduler.pending) for scheduler in
+                          schedulers.values()),
+        "inFlight": sum(len(scheduler.workers) for scheduler in
+                        schedulers.values()),
+        "applied": appliedCount,
+        "coalesced": coalescedCount,
+        "positionBatches": positionBatchCount,
+        "rateLimits": rateLimitCount,
+    }
@@ -0,0 +1,167 @@
+# Paged color search results. The first time someone searches for a term, every
+# match is found and cached for them (see namedColors.searchNamedColorPositions()),
+# and the reply shows the first page with Previous / Next buttons under it.
+# Paging just takes another slice of the cached matches, so it never searches
+# again, and page n is always the same colors, even if the named colors are
+# reloaded in between. The cache is an LRU of the last CacheSize searches, each
+# dropped once nobody has paged through it for CacheSeconds; buttons on
+# results which have been dropped say to search again.
+
+import collections
+import config
+import discord
+import math
+import namedColors
+import swatch
+import time
+
+pageSize = config.getSearchPageSize()
+
+# A search's matches: the names and hex values they're in and their positions
+# in them, best first (see searchNamedColorPositions()), and how long the
+# search took
+SearchResult = collections.namedtuple("SearchResult", ["cacheKey", "names",
+                                                       "hexes", "positions",
+                                                       "seconds"])
+
+# (user ID, lowercase search term) -> (time last used, SearchResult). Only
+# ever touched from the event loop, so there's no lock.
+resultCache = collections.OrderedDict()
+resultCacheSize = config.getSearchCacheSize()
+resultCacheSeconds = config.getSearchCacheSeconds()
+cacheHits = 0
+cacheMisses = 0
+
+# Returns the cached result for the key, or raises a KeyError if there isn't
+# one (or it hasn't been used for too long). Using a result keeps it cached for
+# another resultCacheSeconds.
+def getCachedResult(cacheKey):
+    global cacheHits, cacheMisses
+    entry = resultCache.get(cacheKey)
+    now = time.monotonic()
+    if entry == None or now - entry[0] > resultCacheSeconds:
+        cacheMisses += 1
+        resultCache.pop(cacheKey, None)
+        raise KeyError(cacheKey)
+    resultCache[cacheKey] = (now, entry[1])
+    resultCache.move_to_end(cacheKey)
+    cacheHits += 1
+    return entry[1]
+
+def setCachedResult(cacheKey, result):
+    resultCache[cacheKey] = (time.monotonic(), result)
+    resultCache.move_to_end(cacheKey)
+    while len(resultCache) > resultCacheSize:
+        resultCache.popitem(last = False)
+
+# Returns the cache's size and hit / miss counters
+def getCacheStats():
+    return {
+        "entries": len(resultCache),
+        "hits": cacheHits,
+        "misses": cacheMisses,
+    }
+
+# Returns the SearchResult for the user's search term, only searching if it
+# isn't already cached
+def search(userID, term):
+    cacheKey = (userID, term.lower())
+    try:
+        return getCachedResult(cacheKey)
+    except KeyError:
+        pass
+    startTime = time.perf_counter()
+    names, hexes, positions = namedColors.searchNamedColorPositions(term)
+    result = SearchResult(cacheKey, names, hexes, positions,
+                          time.perf_counter() - startTime)
+    setCachedResult(cacheKey, result)
+    return result
+
+def getPageCount(result):
+    return max(1, math.ceil(len(result.positions) / pageSize))
+
+# Returns the reply for one page (counting from 0) of the result, and the hex
+# values for its palette strip (None if nothing matched)
+def formatPage(result, page):
+    first = page * pageSize
+    positions = result.positions[first:first + pageSize]
+    timeTaken = "{:.4}".format(result.seconds)
+    returnString = f"Found {len(result.positions)} Colors in {timeTaken}s:\n```"
+    for position in positions:
+        returnString += f"- {result.names[position]}\n"
+    returnString += "```"
+    pageCount = getPageCount(result)
+    if pageCount > 1:
+        returnString += (f"Page {page + 1} of {pageCount} (colors {first + 1}-"
+                         f"{first + len(positions)})")
+    if len(positions) == 0:
+        return returnString, None
+    paletteHexes = tuple(result.hexes[position] for position in
+                         positions[:swatch.paletteSize])
+    return returnString, paletteHexes
+
+# The Previous / Next buttons under a search reply. Only the user who searched
+# can use them. They stop working after resultCacheSeconds without being used,
+# which is also when the result drops out of the cache; message has to be set
+# to the reply once it's sent, so the buttons can be greyed out then.
+class SearchPages(discord.ui.View):
+    def __init__(self, userID, result):
+        super().__init__(timeout = resultCacheSeconds)
+        self.userID = userID
+        self.cacheKey = result.cacheKey
+        self.pageCount = getPageCount(result)
+        self.page = 0
+        self.message = None
+        self.updateButtons()
+
+    def updateButtons(self):
+        self.previousPage.disabled = self.page == 0
+        self.nextPage.disabled = self.page >= self.pageCount - 1
+
+    def disableButtons(self):
+        for item in self.children:
+            item.disabled = True
+
+    async def interaction_check(self, interaction):
+        if interaction.user.id == self.userID:
+            return True
+        await interaction.response.send_message("These aren't your search results, try searching yourself",
+                                                ephemeral = True)
+        return False
+
+    @discord.ui.button(label = "Previous", style = discord.ButtonStyle.secondary)
+    async def previousPage(self, interaction, button):
+        await self.showPage(interaction, self.page - 1)
+
+    @discord.ui.button(label = "Next", style = discord.ButtonStyle.secondary)
+    async def nextPage(self, interaction, button):
+        await self.showPage(interaction, self.page + 1)
+
+    async def showPage(self, interaction, page):
+        try:
+            result = getCachedResult(self.cacheKey)
+        except KeyError:
+            self.disableButtons()
+            self.stop()
+            await interaction.response.edit_message(content = "These search results have expired, search again to see more",
+                                                    attachments = [],
+                                                    view = self)
+            return
+        self.page = max(0, min(page, self.pageCount - 1))
+        self.updateButtons()
+        pageMessage, paletteHexes = formatPage(result, self.page)
+        attachments = []
+        if paletteHexes != None:
+            attachments.append(await swatch.getSwatchFile(paletteHexes))
+        await interaction.response.edit_message(content = pageMessage,
+                                                attachments = attachments,
+                                                view = self)
+
+    async def on_timeout(self):
+        if self.message == None:
+            return
+        self.disableButtons()
+        try:
+            await self.message.edit(view = self)
+        except discord.HTTPException:
+            pass
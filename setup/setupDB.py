@@ -1,21 +1,18 @@
-# Module meant to be run once to create and setup the database needed by the
-# bot.
+# Module meant to be run to create the database needed by the bot, or bring an
+# existing one up to date. The bot does this itself when it starts, but this
+# is handy for checking a database before deploying.
 
+import os
 import sqlite3
+import sys
+
+# dbMigrations lives one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import dbMigrations
 
 # The database is created relative to where the command is called.
 conn = sqlite3.connect("coloriz.db")
-curs = conn.cursor()
-
-# Shorthand string used in every table to create the sqlID column, which gives
-# each row a unique ID that autoincrements whenever a row is inserted into the
-# table. (To autoincrement it, NULL must be inserted into its column)
-sqlID = "sqlID INTEGER PRIMARY KEY AUTOINCREMENT"
-
-# Create the table for color history.
-curs.execute(f"""
-CREATE TABLE colorHistory ({sqlID}, userID INTEGER, serverID INTEGER, color
-TEXT, timestamp TEXT, length INTEGER)""")
-
-conn.commit()
+applied = dbMigrations.migrate(conn)
+version = conn.execute("PRAGMA user_version").fetchone()[0]
+print(f"Applied {applied} migrations, database is at version {version}")
 conn.close()
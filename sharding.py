@@ -0,0 +1,183 @@
+# Runs the bot as several processes, each with its own range of Discord shards,
+# so it can use more than one core and more than one gateway connection:
+#     python sharding.py [--shards N] [--processes P]
+# The defaults come from [Sharding] in config.ini. Discord decides which shard
+# a server is on ((server ID >> 22) % shard count), so each process only ever
+# sees its own servers; the shards are split into contiguous, even ranges, one
+# per process, and each process runs coloriz.py with an AutoShardedBot for its
+# range. Stats are written by a single extra process (statsWriter.py) which
+# every shard sends its writes to, while they all read the database directly.
+#
+# If any process stops (sudo shutdown, or a crash), the launcher stops the
+# rest too, so a service manager restarting it brings everything back up.
+
+import argparse
+import config
+import os
+import secrets
+import signal
+import statsWriter
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Client
+
+botDirectory = os.path.dirname(os.path.abspath(__file__))
+colorizPath = os.path.join(botDirectory, "coloriz.py")
+writerPath = os.path.join(botDirectory, "statsWriter.py")
+
+# Discord lets a bot identify (start a session on a shard) once every five
+# seconds, so each process starts this long after the last for every shard the
+# last one has
+identifySeconds = 5
+
+# Returns the shard Discord puts the server on
+def shardForGuild(guildID, shardCount):
+    return (guildID >> 22) % shardCount
+
+# Splits shards 0 to shardCount - 1 into processCount contiguous ranges, as
+# even as they can be. Returns a list of ranges.
+def assignShards(shardCount, processCount):
+    processCount = max(1, min(processCount, shardCount))
+    ranges = []
+    start = 0
+    for processIndex in range(processCount):
+        size = shardCount // processCount + (processIndex < shardCount % processCount)
+        ranges.append(range(start, start + size))
+        start += size
+    return ranges
+
+# Turns a range of shards into e.g., "4-7", and back
+def formatShards(shards):
+    return f"{shards[0]}-{shards[-1]}"
+
+def parseShards(shardText):
+    first, last = shardText.split("-")
+    return range(int(first), int(last) + 1)
+
+# Reads the shard arguments the launcher passes to coloriz.py. Returns the
+# process' shard IDs, the total shard count and the process' index, or
+# (None, None, 0) if the bot isn't sharded.
+def getShardArguments(argv):
+    parser = argparse.ArgumentParser(add_help = False)
+    parser.add_argument("--shards", type = parseShards)
+    parser.add_argument("--shard-count", type = int)
+    parser.add_argument("--process", type = int, default = 0)
+    args, unknown = parser.parse_known_args(argv[1:])
+    if args.shards == None or args.shard_count == None:
+        return None, None, 0
+    return list(args.shards), args.shard_count, args.process
+
+# Asks Discord how many shards it recommends for the bot
+def fetchRecommendedShards(token):
+    import requests
+    response = requests.get("https://discord.com/api/v10/gateway/bot",
+                            headers = {"Authorization": f"Bot {token}"},
+                            timeout = 30)
+    response.raise_for_status()
+    return response.json()["shards"]
+
+class Launcher:
+    # shardCommand is what runs a shard process (coloriz.py by default); the
+    # shard arguments are added to the end of it. The processes run in
+    # workDirectory, which is where config.ini and the database are.
+    def __init__(self, shardCount, processCount, shardCommand = None,
+                 workDirectory = None, identifySeconds = identifySeconds):
+        self.shardCount = shardCount
+        self.shardRanges = assignShards(shardCount, processCount)
+        self.shardCommand = shardCommand or [sys.executable, colorizPath]
+        self.workDirectory = workDirectory
+        self.identifySeconds = identifySeconds
+        self.writerKey = secrets.token_hex(32)
+        self.environment = dict(os.environ)
+        self.environment[statsWriter.writerKeyVariable] = self.writerKey
+        self.writer = None
+        self.shards = []
+        self.stopping = threading.Event()
+
+    # Starts the stats writer and waits until it's accepting connections. It
+    # serves its metrics on the port after the last shard process'.
+    def startWriter(self):
+        metricsPort = config.getMetricsPort()
+        if metricsPort != 0:
+            metricsPort += len(self.shardRanges)
+        self.writer = subprocess.Popen([sys.executable, writerPath,
+                                        "--metrics-port", str(metricsPort)],
+                                       cwd = self.workDirectory,
+                                       env = self.environment)
+        address = (config.getWriterHost(), config.getWriterPort())
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                Client(address, authkey = bytes.fromhex(self.writerKey)).close()
+                return
+            except OSError:
+                if self.writer.poll() != None or time.monotonic() > deadline:
+                    raise RuntimeError("The stats writer didn't start")
+                time.sleep(0.1)
+
+    def startShards(self):
+        for processIndex, shards in enumerate(self.shardRanges):
+            if processIndex > 0:
+                lastShards = self.shardRanges[processIndex - 1]
+                if self.stopping.wait(self.identifySeconds * len(lastShards)):
+                    return
+            print(f"Starting shards {formatShards(shards)} of {self.shardCount}")
+            command = self.shardCommand + ["--shards", formatShards(shards),
+                                           "--shard-count", str(self.shardCount),
+                                           "--process", str(processIndex)]
+            self.shards.append(subprocess.Popen(command, cwd = self.workDirectory,
+                                                env = self.environment))
+
+    # Stops the shards, then has the writer commit everything they sent
+    def stopAll(self):
+        for shard in self.shards:
+            if shard.poll() == None:
+                shard.terminate()
+        for shard in self.shards:
+            try:
+                shard.wait(30)
+            except subprocess.TimeoutExpired:
+                shard.kill()
+        if self.writer != None and self.writer.poll() == None:
+            address = (config.getWriterHost(), config.getWriterPort())
+            try:
+                with Client(address, authkey = bytes.fromhex(self.writerKey)) as conn:
+                    conn.send(("stop",))
+                self.writer.wait(60)
+            except (OSError, subprocess.TimeoutExpired):
+                self.writer.kill()
+
+    # Runs everything until a process stops or stop() is called
+    def run(self):
+        self.startWriter()
+        try:
+            self.startShards()
+            while not self.stopping.wait(1):
+                if (self.writer.poll() != None or
+                    any(shard.poll() != None for shard in self.shards)):
+                    break
+        finally:
+            self.stopAll()
+
+    def stop(self):
+        self.stopping.set()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type = int, default = config.getShardCount(),
+                        help = "how many shards to run (0 for Discord's recommendation)")
+    parser.add_argument("--processes", type = int,
+                        default = config.getShardProcesses())
+    args = parser.parse_args()
+    shardCount = args.shards
+    if shardCount == 0:
+        shardCount = fetchRecommendedShards(config.getToken())
+    launcher = Launcher(shardCount, args.processes)
+    signal.signal(signal.SIGTERM, lambda signalNumber, frame: launcher.stop())
+    try:
+        launcher.run()
+    except KeyboardInterrupt:
+        # The processes got the Ctrl+C too, and run() has already stopped them
+        pass
@@ -0,0 +1,86 @@
+# Keeps track of how long each part of starting the bot takes, for
+# `python coloriz.py --profile-startup`. coloriz.py imports this before anything
+# else so it can time the rest of its imports, then wraps each setup step in
+# phase(). When the bot is ready (or fails to start), report() prints every
+# phase, slowest first, along with the total time to ready. Without the flag
+# only the total time to ready is printed.
+
+import builtins
+import contextlib
+import sys
+import threading
+import time
+
+enabled = "--profile-startup" in sys.argv
+startTime = time.perf_counter()
+
+# (phase name, seconds) in the order they finished. Phases can run on several
+# threads at once, hence the lock.
+phases = []
+phasesLock = threading.Lock()
+
+def recordPhase(name, seconds):
+    with phasesLock:
+        phases.append((name, seconds))
+
+# Times everything in the with block as one phase
+@contextlib.contextmanager
+def phase(name):
+    phaseStart = time.perf_counter()
+    try:
+        yield
+    finally:
+        if enabled:
+            recordPhase(name, time.perf_counter() - phaseStart)
+
+# Returns how long it's been since the bot started, in seconds
+def sinceStart():
+    return time.perf_counter() - startTime
+
+# ================================ Import Timing ===============================
+# Wraps Python's import so the first import of each module coloriz.py imports
+# directly is timed, including everything that module imports in turn (like
+# the "cumulative" column of python -X importtime).
+importDepth = threading.local()
+originalImport = builtins.__import__
+
+def timedImport(name, *args, **kwargs):
+    depth = getattr(importDepth, "depth", 0)
+    if depth > 0 or name in sys.modules:
+        importDepth.depth = depth + 1
+        try:
+            return originalImport(name, *args, **kwargs)
+        finally:
+            importDepth.depth = depth
+    importDepth.depth = 1
+    importStart = time.perf_counter()
+    try:
+        return originalImport(name, *args, **kwargs)
+    finally:
+        importDepth.depth = 0
+        recordPhase(f"import {name}", time.perf_counter() - importStart)
+
+# Starts timing imports (if profiling), stopImportTiming() stops again
+def startImportTiming():
+    if enabled:
+        builtins.__import__ = timedImport
+
+def stopImportTiming():
+    builtins.__import__ = originalImport
+
+# ==============================================================================
+
+# Prints the time to ready, and every phase if profiling
+def report(ready = True):
+    totalTime = sinceStart()
+    if ready:
+        print(f"Ready in {totalTime:.2f}s")
+    else:
+        print(f"Stopped after {totalTime:.2f}s without becoming ready")
+    if not enabled:
+        return
+    with phasesLock:
+        sortedPhases = sorted(phases, key = lambda phase: phase[1], reverse = True)
+    print("Startup profile (phases can overlap):")
+    for name, seconds in sortedPhases:
+        print(f"  {seconds * 1000:9.1f} ms  {name}")
@@ -2,38 +2,279 @@
 # includes saving stats to the database, computing a user / server's stats, and
 # creating the embeds to present to the user.
 
+import collections
 import config
-from datetime import datetime
+import csv
+import dbMigrations
 import discord
+import gzip
+import json
 import math
+import metrics
+import os
+import queue
 import sqlite3
+import tempfile
+import threading
+import time
 
-conn = sqlite3.connect("coloriz.db")
-curs = conn.cursor()
+# Writes never happen on the bot's event loop. recordStats() just puts the
+# change on writeQueue, and a writer thread with its own connection applies
+# everything that arrives within groupCommitWindow seconds of each other in
+# one transaction, so a burst of color changes costs one commit (and one
+# fsync) instead of one each. The database is in WAL mode, so reads (on their
+# own connections, one per thread) never wait for the writer.
+dbPath = "coloriz.db"
+groupCommitWindow = 0.05
+writeQueue = queue.Queue()
+writerThread = None
+readConnections = threading.local()
 
-# Given a previous timestamp, this calculates how long ago (in seconds) the
-# previous timestamp was. Returns said length.
-def calcLengthSec(prevTimestamp):
-    curDatetime = datetime.utcnow()
-    prevDatetime = datetime.fromisoformat(prevTimestamp)
-    length = (curDatetime - prevDatetime).total_seconds()
+# When the bot runs as several shard processes (see sharding.py), none of them
+# has a writer thread. A single stats writer process (statsWriter.py) applies
+# every shard's writes instead, and remoteWriter is this process' connection
+# to it. Reads still happen here, on the shard's own read connections.
+remoteWriter = None
+
+# The first connection opened brings the schema up to date (see
+# dbMigrations.py) before anything else touches the database
+migrateLock = threading.Lock()
+migrated = False
+
+def openConnection():
+    global migrated
+    conn = sqlite3.connect(dbPath)
+    # Lets compaction hand freed pages back a few at a time (see
+    # compactHistory()). This only sticks on a brand new database; older ones
+    # are switched over by useIncrementalVacuum().
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    # In WAL mode, NORMAL only syncs at checkpoints; a crash can lose the last
+    # few commits but never corrupts the database
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with migrateLock:
+        if not migrated:
+            dbMigrations.migrate(conn)
+            migrated = True
+    return conn
+
+# Opens (and closes) a connection just to bring the schema up to date, so the
+# bot's setup can get any migrations out of the way before the first command
+def prepareDatabase():
+    openConnection().close()
+
+# Returns a cursor on this thread's read connection, opening it if needed
+def getReadCursor():
+    conn = getattr(readConnections, "conn", None)
+    if conn == None:
+        conn = openConnection()
+        readConnections.conn = conn
+    return conn.cursor()
+
+# ================================ Writer Thread ===============================
+# Each item on the queue is either a (write, cacheKeys) tuple, where the write
+# is a function taking a cursor and the cacheKeys are the (serverID, userID)s
+# whose cached stats it changes, a threading.Event (set once everything
+# before it is committed), or None (stop once everything before it is
+# committed).
+
+def runWriter():
+    conn = openConnection()
+    if config.getRetentionDays() > 0:
+        useIncrementalVacuum(conn)
+    curs = conn.cursor()
+    running = True
+    while running:
+        batch = [writeQueue.get()]
+        # Gather up anything else that comes in during the window
+        deadline = time.monotonic() + groupCommitWindow
+        while batch[-1] != None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(writeQueue.get(timeout = remaining))
+            except queue.Empty:
+                break
+        flushedEvents = []
+        changedKeys = []
+        # The whole batch is one transaction, committed below. It has to be
+        # opened here: a write's SAVEPOINT (see writeAll()) would otherwise
+        # start a transaction of its own, which its RELEASE commits.
+        if not conn.in_transaction:
+            curs.execute("BEGIN")
+        for item in batch:
+            if item == None:
+                running = False
+            elif isinstance(item, threading.Event):
+                flushedEvents.append(item)
+            else:
+                write, cacheKeys = item
+                writeStart = time.perf_counter()
+                # Whatever goes wrong with one write, the thread has to keep
+                # serving the queue, or every flush() after it blocks forever
+                try:
+                    write(curs)
+                except Exception as writeError:
+                    metrics.sqliteErrors.inc("write")
+                    print(f"Could not write stats: {writeError!r}")
+                metrics.sqliteSeconds.observe(time.perf_counter() - writeStart,
+                                              "write")
+                changedKeys.extend(cacheKeys)
+        with metrics.sqliteSeconds.time("commit"):
+            conn.commit()
+        # Anything read between recordStats() and this commit is stale
+        for cacheKey in changedKeys:
+            invalidateCachedStats(cacheKey)
+        for listener in commitListeners:
+            listener(changedKeys)
+        for event in flushedEvents:
+            event.set()
+    conn.close()
+
+def startWriter():
+    global writerThread
+    if writerThread == None:
+        writerThread = threading.Thread(target = runWriter, name = "statsWriter",
+                                        daemon = True)
+        writerThread.start()
+
+# Functions called (on the writer thread) with the cache keys of every write
+# in a batch once it's committed. The stats writer process uses this to tell
+# the shards which of their cached stats are stale.
+commitListeners = []
+
+# Sends every write from now on to a stats writer process (see statsWriter.py)
+# instead of this process' own writer thread
+def useRemoteWriter(client):
+    global remoteWriter
+    remoteWriter = client
+
+# Queues a write (a function which takes the writer's cursor). If it changes
+# users' stats, cacheKeys are their (serverID, userID)s.
+def queueWrite(write, cacheKeys = ()):
+    startWriter()
+    writeQueue.put((write, cacheKeys))
+
+# ================================= Stats Cache ================================
+# The stats for recently looked up users are kept in memory (as read from the
+# database), so looking someone up again doesn't have to go to the database at
+# all. Entries are dropped as soon as a write for that user is queued (and
+# again once it's committed, in case someone read the old stats in between),
+# when they get too old, or when the cache is full, least recently used
+# first. Only the current color's "live" length is worked out again on a hit,
+# since it's calculated from when the color started.
+statsCache = collections.OrderedDict()
+statsCacheLock = threading.Lock()
+statsCacheSize = config.getStatsCacheSize()
+statsCacheSeconds = config.getStatsCacheSeconds()
+cacheHits = 0
+cacheMisses = 0
+# Every time a key's stats are dropped, it gets a new generation. A read which
+# was still going when they were dropped may have read the row from before the
+# write, so its stats are only cached if the generation hasn't changed since
+# the read started. Only the last statsCacheSize keys dropped are remembered,
+# far more than could be dropped during one read.
+statsGenerations = collections.OrderedDict()
+generationCount = 0
+
+# Returns the cached stats for the key, or raises a KeyError if there aren't
+# any (or they're too old)
+def getCachedStats(cacheKey):
+    global cacheHits, cacheMisses
+    with statsCacheLock:
+        entry = statsCache.get(cacheKey)
+        if entry == None or time.monotonic() - entry[0] > statsCacheSeconds:
+            cacheMisses += 1
+            raise KeyError(cacheKey)
+        statsCache.move_to_end(cacheKey)
+        cacheHits += 1
+        return entry[1]
+
+# Returns the key's generation, to pass to setCachedStats() after reading
+def getCacheGeneration(cacheKey):
+    with statsCacheLock:
+        return statsGenerations.get(cacheKey, 0)
+
+# Caches the stats read for the key, unless they were dropped since the read
+# started (i.e., the generation has changed)
+def setCachedStats(cacheKey, userStats, generation):
+    with statsCacheLock:
+        if statsGenerations.get(cacheKey, 0) != generation:
+            return
+        statsCache[cacheKey] = (time.monotonic(), userStats)
+        statsCache.move_to_end(cacheKey)
+        while len(statsCache) > statsCacheSize:
+            statsCache.popitem(last = False)
+
+def invalidateCachedStats(cacheKey):
+    global generationCount
+    if cacheKey == None:
+        return
+    with statsCacheLock:
+        statsCache.pop(cacheKey, None)
+        generationCount += 1
+        statsGenerations[cacheKey] = generationCount
+        statsGenerations.move_to_end(cacheKey)
+        while len(statsGenerations) > statsCacheSize:
+            statsGenerations.popitem(last = False)
+
+# Returns the cache's size and hit / miss counters
+def getCacheStats():
+    return {
+        "entries": len(statsCache),
+        "hits": cacheHits,
+        "misses": cacheMisses,
+    }
+
+# Blocks until every write queued so far has been committed
+def flush():
+    if remoteWriter != None:
+        remoteWriter.flush()
+        return
+    if writerThread == None:
+        return
+    flushed = threading.Event()
+    writeQueue.put(flushed)
+    flushed.wait()
+
+# Commits everything still queued and stops the writer. Used on shutdown.
+def close():
+    global writerThread, remoteWriter
+    if remoteWriter != None:
+        remoteWriter.close()
+        remoteWriter = None
+        return
+    if writerThread == None:
+        return
+    writeQueue.put(None)
+    writerThread.join()
+    writerThread = None
+
+# ==============================================================================
+
+# Given a previous timestamp (in seconds since the epoch), this calculates how
+# long ago (in seconds) the previous timestamp was. Returns said length.
+def calcLengthSec(prevTimestamp, curTimestamp = None):
+    if curTimestamp == None:
+        curTimestamp = int(time.time())
+    length = curTimestamp - prevTimestamp
     return length
 
 # Given a user, server ID, and the user's current color, updateStats() updates
 # the entry in the table for the user's current color: editing the length from
-# -1 to however many seconds they had the color for.
-def updateStats(userID, serverID, curColor):
+# -1 to however many seconds they had the color for. Runs on the writer thread.
+def updateStats(curs, userID, serverID, curColor, timestamp):
     # If an entry has a length of -1, then that is the user's currently active
     # color, so we'll need update with how long they had that one.
     sqlCommand = f"""
-SELECT color, timestamp FROM colorHistory WHERE length=-1 AND userID=? AND serverID=?
+SELECT color, startTime FROM colorHistory WHERE serverID=? AND userID=? AND length=-1
 """
-    curs.execute(sqlCommand, (userID, serverID))
+    curs.execute(sqlCommand, (serverID, userID))
     result = curs.fetchone()
-    print(result)
     # If the result is None, then the user does not have an active color on this
     # server: we don't have to calculate how long they had their color. Just
-    # insert a new record into the database. (Which is done in recordStats().)
+    # insert a new record into the database. (Which is done in writeStats().)
     if result == None:
         return
     prevColor = result[0]
@@ -43,45 +284,314 @@ SELECT color, timestamp FROM colorHistory WHERE length=-1 AND userID=? AND serve
     # add a new record.
     if prevColor == curColor:
         return True
-    length = calcLengthSec(prevTimestamp)
+    length = calcLengthSec(prevTimestamp, timestamp)
     updateCommand = f"""
-UPDATE colorHistory SET length=? WHERE length=-1 AND userID=? AND serverID=?
+UPDATE colorHistory SET length=? WHERE serverID=? AND userID=? AND length=-1
 """
-    curs.execute(updateCommand, (length, userID, serverID))
-    conn.commit()
+    curs.execute(updateCommand, (length, serverID, userID))
+    closeUserStats(curs, userID, serverID, prevColor, length)
     return
 
-# Given the ctx, and the hex value of the user's NEW color, this records all the
-# stats necessary into the table. The function uses the ctx to grab data about
-# the user and server.
+# ============================== User Stats Rollup =============================
+# userColorStats keeps running totals for each user on each server (see
+# dbMigrations.py), updated in the same transaction as colorHistory so the two
+# never disagree.
+
+# Folds a color the user just stopped having into their totals: total time,
+# longest / shortest color, and most used color. The user has no current color
+# until openUserStats() is called for the next one.
+def closeUserStats(curs, userID, serverID, color, length):
+    curs.execute("""
+INSERT INTO userColorTotals VALUES (?, ?, ?, ?) ON CONFLICT (serverID, userID,
+color) DO UPDATE SET totalTime = totalTime + excluded.totalTime
+""", (serverID, userID, color, length))
+    curs.execute("""
+SELECT totalTime FROM userColorTotals WHERE serverID=? AND userID=? AND color=?
+""", (serverID, userID, color))
+    colorTotal = curs.fetchone()[0]
+    # Every expression on the right side sees the row as it was before the
+    # update, so the CASEs compare against the old longest / shortest / most
+    # used values
+    curs.execute("""
+UPDATE userColorStats SET totalTime = totalTime + :length,
+longestColor = CASE WHEN longestLength IS NULL OR :length > longestLength
+    THEN :color ELSE longestColor END,
+longestLength = CASE WHEN longestLength IS NULL OR :length > longestLength
+    THEN :length ELSE longestLength END,
+shortestColor = CASE WHEN shortestLength IS NULL OR :length < shortestLength
+    THEN :color ELSE shortestColor END,
+shortestLength = CASE WHEN shortestLength IS NULL OR :length < shortestLength
+    THEN :length ELSE shortestLength END,
+mostUsedColor = CASE WHEN mostUsedColor IS NULL OR mostUsedColor = :color OR
+    :colorTotal > mostUsedTime THEN :color ELSE mostUsedColor END,
+mostUsedTime = CASE WHEN mostUsedColor IS NULL OR mostUsedColor = :color OR
+    :colorTotal > mostUsedTime THEN :colorTotal ELSE mostUsedTime END,
+currentColor = NULL, currentStart = NULL
+WHERE serverID = :serverID AND userID = :userID
+""", {"length": length, "color": color, "colorTotal": colorTotal,
+      "serverID": serverID, "userID": userID})
+    closeGuildStats(curs, serverID, color, length)
+
+# Records the user's new current color, making their userColorStats row if
+# this is their first color on the server
+def openUserStats(curs, userID, serverID, color, timestamp):
+    curs.execute("""
+INSERT INTO userColorStats (serverID, userID, totalTime, changeCount,
+currentColor, currentStart) VALUES (?, ?, 0, 1, ?, ?) ON CONFLICT (serverID,
+userID) DO UPDATE SET changeCount = changeCount + 1, currentColor =
+excluded.currentColor, currentStart = excluded.currentStart
+""", (serverID, userID, color, timestamp))
+    openGuildStats(curs, serverID, color)
+
+# ============================= Server Stats Rollup ============================
+# The server-wide totals (see dbMigrations.py) are kept up to date the same
+# way, so stats server only ever reads a handful of rows.
+
+# Counts a new pick of the color, and one more member with it
+def openGuildStats(curs, serverID, color):
+    curs.execute("""
+INSERT INTO guildColorStats VALUES (?, ?, 1, 0, 1) ON CONFLICT (serverID, color)
+DO UPDATE SET picks = picks + 1, activeCount = activeCount + 1
+""", (serverID, color))
+    curs.execute("""
+SELECT activeCount FROM guildColorStats WHERE serverID=? AND color=?
+""", (serverID, color))
+    newColor = curs.fetchone()[0] == 1
+    curs.execute("""
+INSERT INTO guildSummary VALUES (?, ?, 1) ON CONFLICT (serverID) DO UPDATE SET
+activeColors = activeColors + excluded.activeColors, activeMembers =
+activeMembers + 1
+""", (serverID, int(newColor)))
+    curs.execute("""
+INSERT INTO guildHueStats VALUES (?, ?, 1) ON CONFLICT (serverID, hueBucket) DO
+UPDATE SET picks = picks + 1
+""", (serverID, dbMigrations.hueBucket(color)))
+
+# Adds how long the color was held to its total, and one less member has it
+def closeGuildStats(curs, serverID, color, length):
+    curs.execute("""
+UPDATE guildColorStats SET totalTime = totalTime + ?, activeCount = activeCount
+- 1 WHERE serverID=? AND color=?
+""", (length, serverID, color))
+    curs.execute("""
+SELECT activeCount FROM guildColorStats WHERE serverID=? AND color=?
+""", (serverID, color))
+    goneColor = curs.fetchone()[0] == 0
+    curs.execute("""
+UPDATE guildSummary SET activeColors = activeColors - ?, activeMembers =
+activeMembers - 1 WHERE serverID=?
+""", (int(goneColor), serverID))
+
+# ==============================================================================
+
+# Closes the user's previous color and records their new one (if they have
+# one). Runs on the writer thread.
+def writeStats(curs, userID, serverID, color, timestamp):
+    # If it returns true, we don't need to add a new record into the table.
+    if updateStats(curs, userID, serverID, color, timestamp):
+        return
+    # If the color is None, that means the user cleared their color: update
+    # their previous color length (done above), but don't add a new record.
+    if color == None:
+        return
+    # colorHistory columns go: sqlID, userID, serverID, color, startTime, length
+    sqlCommand = f"""
+INSERT INTO colorHistory VALUES (NULL, ?, ?, ?, ?, ?)
+"""
+    curs.execute(sqlCommand, (userID, serverID, color, timestamp, -1))
+    openUserStats(curs, userID, serverID, color, timestamp)
+
+# Given the ctx, and the hex value of the user's NEW color (None if they
+# cleared it), this queues up recording all the stats necessary into the
+# table. The function uses the ctx to grab data about the user and server.
 def recordStats(ctx, color):
     userID = ctx.message.author.id
     serverID = ctx.guild.id
     # We want all the colors to be uppercase (I like how that looks) so we can
-    # safely compare two colors later. It goes in a try block so that we can
-    # catch the AttributeError if color is None (like when the user clears their
-    # color)
-    try:
+    # safely compare two colors later.
+    if color != None:
         color = color.upper()
-    except AttributeError:
-        # If the color is None, that means the user cleared their color: update
-        # their previous color length (done above), but don't add a new
-        # record. (We should be able to trust that if an AttributeError is
-        # raised, the color is None, but just to be safe, we'll check here.
-        if color == None:
-            return
-    # Regardless if there's an error or not, we still want to update the stats.
-    finally:
-        # If it returns true, we don't need to add a new record into the table.
-        if updateStats(userID, serverID, color):
-            return
-    timestamp = datetime.utcnow()
-    # colorHistory columns go: sqlID, userID, serverID, color, timestamp, length
-    sqlCommand = f"""
-INSERT INTO colorHistory VALUES (NULL, ?, ?, ?, ?, ?)
-"""
-    curs.execute(sqlCommand, (userID, serverID, color, str(timestamp), -1))
-    conn.commit()
+    timestamp = int(time.time())
+    invalidateCachedStats((serverID, userID))
+    if remoteWriter != None:
+        remoteWriter.record(userID, serverID, color, timestamp)
+    else:
+        queueStats(userID, serverID, color, timestamp)
+
+# Queues writeStats() for the writer thread. The stats writer process calls
+# this for every change a shard sends it. The change touches the history and
+# every rollup table, so it's written inside a savepoint: if any of it fails,
+# none of it is committed, and the rollups can't drift from the history.
+def queueStats(userID, serverID, color, timestamp):
+    queueWrite(lambda curs: writeAll(curs, writeStats, userID, serverID, color,
+                                     timestamp), [(serverID, userID)])
+
+# Queues up recording a batch of color changes on one server all at once (e.g.,
+# from sudo palette). changes is a list of (userID, color) tuples, where color
+# is the user's NEW color's hex code. They're all written in one transaction,
+# so either every change is recorded or none are.
+def recordManyStats(serverID, changes):
+    changes = [(userID, color.upper() if color != None else None) for userID,
+               color in changes]
+    timestamp = int(time.time())
+    for userID, color in changes:
+        invalidateCachedStats((serverID, userID))
+    if remoteWriter != None:
+        remoteWriter.recordMany(serverID, changes, timestamp)
+    else:
+        queueManyStats(serverID, changes, timestamp)
+
+def queueManyStats(serverID, changes, timestamp):
+    def writeMany(curs):
+        for userID, color in changes:
+            writeStats(curs, userID, serverID, color, timestamp)
+    queueWrite(lambda curs: writeAll(curs, writeMany),
+               [(serverID, userID) for userID, color in changes])
+
+# Runs a write which makes several changes inside a savepoint, so a failure
+# partway through takes back the changes already made rather than committing
+# half of them. The write is called with the cursor and any other arguments
+# given. Returns what the write returned.
+def writeAll(curs, write, *args):
+    curs.execute("SAVEPOINT writeAll")
+    try:
+        result = write(curs, *args)
+    except Exception:
+        curs.execute("ROLLBACK TO writeAll")
+        curs.execute("RELEASE writeAll")
+        raise
+    curs.execute("RELEASE writeAll")
+    return result
+
+# ============================= History Compaction =============================
+# colorHistory gets a row for every color change, forever. With RetentionDays
+# set, closed rows (colors people have since changed from) which ended longer
+# ago than that are rolled up into colorHistoryArchive and deleted. Every other
+# stats table already counts them, so the stats commands show the same
+# numbers afterwards. Each batch of CompactBatchSize rows is its own queued
+# write, so color changes keep being committed in between rather than waiting
+# on one huge delete, and the pages the deletes free are then handed back to
+# the file system a step at a time the same way (incremental vacuum).
+vacuumPagesPerStep = 2000
+
+# Switches a database made before incremental vacuum was turned on over to it.
+# That takes a full VACUUM, which rewrites the whole file, so it only happens
+# once, when the writer starts (before it takes any writes).
+def useIncrementalVacuum(conn):
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    print("Switching the stats database to incremental vacuum...")
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+
+# Rolls up and deletes up to batchSize closed rows which ended before cutoff,
+# oldest first. Runs on the writer thread. Returns how many rows it deleted.
+def compactBatch(curs, cutoff, batchSize):
+    curs.execute("""
+SELECT sqlID, serverID, userID, color, startTime, length FROM colorHistory
+WHERE NOT length=-1 AND startTime < ? AND startTime + length < ?
+ORDER BY startTime LIMIT ?""", (cutoff, cutoff, batchSize))
+    rows = curs.fetchall()
+    # (serverID, userID, color) -> [picks, totalTime, firstStart, lastEnd]
+    rollups = {}
+    for sqlID, serverID, userID, color, startTime, length in rows:
+        rollup = rollups.get((serverID, userID, color))
+        if rollup == None:
+            rollups[(serverID, userID, color)] = [1, length, startTime,
+                                                  startTime + length]
+            continue
+        rollup[0] += 1
+        rollup[1] += length
+        rollup[2] = min(rollup[2], startTime)
+        rollup[3] = max(rollup[3], startTime + length)
+    curs.executemany("""
+INSERT INTO colorHistoryArchive VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT
+(serverID, userID, color) DO UPDATE SET picks = picks + excluded.picks,
+totalTime = totalTime + excluded.totalTime,
+firstStart = min(firstStart, excluded.firstStart),
+lastEnd = max(lastEnd, excluded.lastEnd)
+""", [key + tuple(rollup) for key, rollup in rollups.items()])
+    curs.executemany("DELETE FROM colorHistory WHERE sqlID=?",
+                     [(row[0],) for row in rows])
+    return len(rows)
+
+# Hands up to vacuumPagesPerStep free pages back to the file system. Runs on
+# the writer thread. Returns how many it freed.
+def vacuumStep(curs):
+    if curs.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    freePages = curs.execute("PRAGMA freelist_count").fetchone()[0]
+    pages = min(freePages, vacuumPagesPerStep)
+    # Through Python's sqlite3, each incremental_vacuum only ever frees a
+    # single page, whatever it's asked for, and is left unfinished until its
+    # cursor is closed (which the commit won't go through without), so they
+    # get a cursor of their own
+    vacuumCursor = curs.connection.cursor()
+    for page in range(pages):
+        vacuumCursor.execute("PRAGMA incremental_vacuum(1)")
+    vacuumCursor.close()
+    return pages
+
+# Returns the database's size, unused space and how many rows the history
+# tables have
+def measureDatabase():
+    curs = getReadCursor()
+    pageSize = curs.execute("PRAGMA page_size").fetchone()[0]
+    pageCount = curs.execute("PRAGMA page_count").fetchone()[0]
+    freePages = curs.execute("PRAGMA freelist_count").fetchone()[0]
+    measurements = {"bytes": pageSize * pageCount,
+                    "freeBytes": pageSize * freePages}
+    for table in ("colorHistory", "colorHistoryArchive"):
+        measurements[table] = curs.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+    return measurements
+
+def recordDatabaseMetrics(measurements, stage):
+    metrics.databaseBytes.set(measurements["bytes"], stage)
+    metrics.databaseFreeBytes.set(measurements["freeBytes"], stage)
+    for table in ("colorHistory", "colorHistoryArchive"):
+        metrics.databaseRows.set(measurements[table], table, stage)
+
+# Queues the write (a function taking the writer's cursor) and waits for it to
+# be committed. Returns what it returned, or None if it failed.
+def runQueuedWrite(write):
+    results = []
+    queueWrite(lambda curs: results.append(write(curs)))
+    flush()
+    return results[0] if results else None
+
+# Compacts everything older than RetentionDays. Blocks until it's done, so the
+# bot runs it in a thread. Returns the database's measurements from before and
+# after, and how many rows were compacted, or None if there's no retention
+# policy (or the writer is another process, which compacts for itself).
+def compactHistory():
+    retentionDays = config.getRetentionDays()
+    if retentionDays <= 0 or remoteWriter != None:
+        return None
+    cutoff = int(time.time() - retentionDays * 24 * 60 * 60)
+    batchSize = config.getCompactBatchSize()
+    before = measureDatabase()
+    recordDatabaseMetrics(before, "before")
+    compactedCount = 0
+    while True:
+        batchCount = runQueuedWrite(lambda curs: writeAll(curs, compactBatch,
+                                                          cutoff, batchSize))
+        if batchCount == None:
+            break
+        compactedCount += batchCount
+        metrics.compactedRows.inc(amount = batchCount)
+        if batchCount < batchSize:
+            break
+    while runQueuedWrite(vacuumStep):
+        pass
+    after = measureDatabase()
+    recordDatabaseMetrics(after, "after")
+    return before, after, compactedCount
+
+# Turns what compactHistory() returned into a line for the log
+def describeCompaction(before, after, compactedCount):
+    return (f"Compacted {compactedCount} history rows: the database went from "
+            f"{before['bytes'] / 1e6:.1f} MB ({before['colorHistory']} rows) "
+            f"to {after['bytes'] / 1e6:.1f} MB ({after['colorHistory']} rows)")
 
 # ============================ Calculating Functions ===========================
 # Functions for analyzing the database and returning datapoints to be used in
@@ -112,38 +622,39 @@ def prettyLength(length):
         prettyLengthString = prettyLengthString + "s"
     return prettyLengthString
 
-# Given a userID and serverID, calcColorExtremes() calculates the shortest and
-# longest color the user had on that server. It returns two strings for the
-# longest and shortest colors, respectively.
-def calcColorExtremes(userID, serverID):
-    returnStrings = []
-    for extreme in ["max", "min"]:
-        sqlCommand = f"""
-SELECT {extreme}(length), color FROM colorHistory WHERE userID=? AND serverID=?
-AND NOT length=-1
+# Given a userID and serverID, fetchUserStats() returns the user's row from
+# userColorStats as a dictionary (column name -> value), plus currentColorTime,
+# how long they had their current color before this time (None if never), or
+# None if they've never had a color on the server. It's a lookup by primary
+# key in each table, and only happens if the stats aren't already cached.
+def fetchUserStats(userID, serverID):
+    cacheKey = (serverID, userID)
+    try:
+        return getCachedStats(cacheKey)
+    except KeyError:
+        pass
+    generation = getCacheGeneration(cacheKey)
+    userStats = readUserStats(userID, serverID)
+    setCachedStats(cacheKey, userStats, generation)
+    return userStats
+
+def readUserStats(userID, serverID):
+    curs = getReadCursor()
+    sqlCommand = """
+SELECT userColorStats.*, userColorTotals.totalTime AS currentColorTime FROM
+userColorStats LEFT JOIN userColorTotals ON
+userColorTotals.serverID=userColorStats.serverID AND
+userColorTotals.userID=userColorStats.userID AND
+userColorTotals.color=userColorStats.currentColor
+WHERE userColorStats.serverID=? AND userColorStats.userID=?
 """
-        curs.execute(sqlCommand, (userID, serverID))
+    with metrics.sqliteSeconds.time("userStats"):
+        curs.execute(sqlCommand, (serverID, userID))
         result = curs.fetchone()
-        length = result[0]
-        color = result[1]
-        returnStrings.append((color, length))
-    return returnStrings[0], returnStrings[1]
-
-# Given a userID and serverID, calculate the length of the user's current color,
-# and return the length and color, respectively. This will be compared to the
-# longest/shortest length from the database, so the true longest/shortest can be
-# chosen, allowing for a "live" length.
-def calcCurrentLength(userID, serverID):
-    sqlCommand = f"""
-SELECT color, timestamp FROM colorHistory WHERE userID=? AND serverID=? AND
-LENGTH=-1
-"""
-    curs.execute(sqlCommand, (userID, serverID))
-    result = curs.fetchone()
-    color = result[0]
-    start = result[1]
-    length = calcLengthSec(start)
-    return (color, length)
+    if result == None:
+        return None
+    columns = [column[0] for column in curs.description]
+    return dict(zip(columns, result))
 
 # Given the current length of the user's color, the longest/shortest database
 # length, check which ones are the true extremes. e.g., if the current length is
@@ -163,36 +674,207 @@ def checkExtremes(currentColor, longestColor, shortestColor):
     elif current < shortest:
         shortestColorString = f"{currentName} - {prettyLength(current)}\nThat's your current color! :o"
     return longestColorString, shortestColorString
+
+# Like checkExtremes(), but for the most used color: the current color's live
+# length is added to however long the user had it before (currentTime, None if
+# never), and if that beats the most used color's time, the current color is
+# the true most used one. Returns the string for the most used color.
+def checkMostUsed(currentColor, currentTime, mostUsedColor, mostUsedTime):
+    currentName = currentColor[0]
+    currentTotal = currentColor[1] + (currentTime or 0)
+    if mostUsedColor == None or currentTotal > mostUsedTime:
+        return f"{currentName} - {prettyLength(currentTotal)}\nThat's your current color! :o"
+    return f"{mostUsedColor} - {prettyLength(mostUsedTime)}"
 # ==============================================================================
 
 # Given a serverID and user object, this creates an embed, fills it with some
 # info provided from the object (name, color, etc.), and returns an Embed
-# object.
+# object. This reads from the database, so the bot runs it in a thread.
 def createEmbed(serverID, user):
     userID = user.id
     userNick = user.display_name
     username = user.name
     userColor = user.color
-    userAvatar = str(user.avatar_url)
+    userAvatar = str(user.display_avatar.url)
     embed = discord.Embed(description = f"Stats for {userNick}", color =
                           userColor)
     embed.set_author(name = username, icon_url = userAvatar)
-    # If the user doesn't have a color, then the SQL commands in the calc...()
-    # functions will return a NoneType, which will raise a TypeError. For now,
-    # we'll just do this, and add a little nicer solution later.
-    try:
-        longestColor, shortestColor = calcColorExtremes(userID, serverID)
-        curColor = calcCurrentLength(userID, serverID)
+    userStats = fetchUserStats(userID, serverID)
+    if userStats == None:
+        embed.add_field(name = "You haven't had any colors on this server", value = "D:!!!")
+        return embed
+    totalTime = userStats["totalTime"]
+    longestColor = (userStats["longestColor"], userStats["longestLength"])
+    shortestColor = (userStats["shortestColor"], userStats["shortestLength"])
+    # The current color's length is worked out "live", so it can beat the
+    # longest / shortest colors while the user still has it
+    if userStats["currentColor"] != None:
+        curColor = (userStats["currentColor"],
+                    calcLengthSec(userStats["currentStart"]))
+        totalTime += curColor[1]
+        # If this is the user's first color, it's their longest and shortest
+        if longestColor[1] == None:
+            longestColor = shortestColor = curColor
         longestColorString, shortestColorString = checkExtremes(curColor,
                                                                 longestColor,
                                                                 shortestColor)
+        mostUsedColorString = checkMostUsed(curColor,
+                                            userStats["currentColorTime"],
+                                            userStats["mostUsedColor"],
+                                            userStats["mostUsedTime"])
         currentColorString = f"{curColor[0]} - {prettyLength(curColor[1])}"
-        embed.add_field(name = "Current Color", value = currentColorString,
-                        inline = False)
-        embed.add_field(name = "Longest Color", value = longestColorString,
-                        inline = True)
-        embed.add_field(name = "Shortest Color", value = shortestColorString,
-                        inline = True)
-    except TypeError:
-        embed.add_field(name = "You haven't had any colors on this server", value = "D:!!!")
+    else:
+        longestColorString = f"{longestColor[0]} - {prettyLength(longestColor[1])}"
+        shortestColorString = f"{shortestColor[0]} - {prettyLength(shortestColor[1])}"
+        mostUsedColorString = f"{userStats['mostUsedColor']} - {prettyLength(userStats['mostUsedTime'])}"
+        currentColorString = "None"
+    embed.add_field(name = "Current Color", value = currentColorString,
+                    inline = False)
+    embed.add_field(name = "Longest Color", value = longestColorString,
+                    inline = True)
+    embed.add_field(name = "Shortest Color", value = shortestColorString,
+                    inline = True)
+    embed.add_field(name = "Most Used Color", value = mostUsedColorString,
+                    inline = False)
+    embed.add_field(name = "Time With a Color", value = prettyLength(totalTime),
+                    inline = True)
+    embed.add_field(name = "Color Changes", value = userStats["changeCount"],
+                    inline = True)
     return embed
+
+# ================================ Server Stats ================================
+
+# Names for the hue buckets from dbMigrations.hueBucket(); -1 is grays
+hueNames = {-1: "Grays", 0: "Reds", 1: "Oranges", 2: "Yellows", 3: "Limes",
+            4: "Greens", 5: "Mints", 6: "Cyans", 7: "Azures", 8: "Blues",
+            9: "Violets", 10: "Purples", 11: "Pinks"}
+
+# How many entries each leaderboard shows
+leaderboardSize = 5
+
+# Given a serverID, fetchServerStats() reads the server's rollups and returns
+# a dictionary of the active color / member counts and each leaderboard, as a
+# list of rows. Every query reads at most a few rows off the front of an index,
+# so this takes the same time no matter how much history the server has.
+def fetchServerStats(serverID):
+    with metrics.sqliteSeconds.time("serverStats"):
+        return readServerStats(serverID)
+
+def readServerStats(serverID):
+    curs = getReadCursor()
+    serverStats = {}
+    curs.execute("""
+SELECT activeColors, activeMembers FROM guildSummary WHERE serverID=?
+""", (serverID,))
+    serverStats["summary"] = curs.fetchone()
+    queries = {
+        "popularColors": """
+SELECT color, picks FROM guildColorStats WHERE serverID=? ORDER BY picks DESC
+LIMIT ?""",
+        "heldColors": """
+SELECT color, totalTime FROM guildColorStats WHERE serverID=? ORDER BY
+totalTime DESC LIMIT ?""",
+        "longestHolders": """
+SELECT userID, longestColor, longestLength FROM userColorStats WHERE serverID=?
+AND longestLength IS NOT NULL ORDER BY longestLength DESC LIMIT ?""",
+        "changers": """
+SELECT userID, changeCount FROM userColorStats WHERE serverID=? ORDER BY
+changeCount DESC LIMIT ?""",
+    }
+    for name, query in queries.items():
+        curs.execute(query, (serverID, leaderboardSize))
+        serverStats[name] = curs.fetchall()
+    # There are only ever 13 hue buckets
+    curs.execute("""
+SELECT hueBucket, picks FROM guildHueStats WHERE serverID=? ORDER BY picks DESC
+""", (serverID,))
+    serverStats["hues"] = curs.fetchall()
+    return serverStats
+
+# Given a guild, this creates an embed with the server's color stats and
+# leaderboards. Like createEmbed(), the bot runs it in a thread.
+def createServerEmbed(guild):
+    serverStats = fetchServerStats(guild.id)
+    embed = discord.Embed(description = f"Color stats for {guild.name}")
+    if serverStats["summary"] == None:
+        embed.add_field(name = "Nobody has had a color on this server", value = "D:!!!")
+        return embed
+    activeColors, activeMembers = serverStats["summary"]
+    embed.add_field(name = "Active Colors", value = f"{activeColors} colors on {activeMembers} members",
+                    inline = False)
+    popularString = ""
+    for color, picks in serverStats["popularColors"]:
+        popularString += f"{color} - picked {picks} times\n"
+    embed.add_field(name = "Most Popular Colors", value = popularString,
+                    inline = True)
+    heldString = ""
+    for color, totalTime in serverStats["heldColors"]:
+        heldString += f"{color} - {prettyLength(totalTime)}\n"
+    embed.add_field(name = "Longest Held Colors", value = heldString or "None yet",
+                    inline = True)
+    longestString = ""
+    for userID, color, length in serverStats["longestHolders"]:
+        longestString += f"<@{userID}> - {color} for {prettyLength(length)}\n"
+    embed.add_field(name = "Longest Single Color", value = longestString or "None yet",
+                    inline = False)
+    changersString = ""
+    for userID, changeCount in serverStats["changers"]:
+        changersString += f"<@{userID}> - {changeCount} colors\n"
+    embed.add_field(name = "Most Frequent Changers", value = changersString,
+                    inline = True)
+    # Draw the hue distribution as a little bar chart
+    totalPicks = sum(picks for bucket, picks in serverStats["hues"])
+    hueString = ""
+    for bucket, picks in serverStats["hues"]:
+        bar = "█" * max(1, round(picks / totalPicks * 10))
+        hueString += f"`{hueNames[bucket]:<8}` {bar} {picks}\n"
+    embed.add_field(name = "Hues", value = hueString, inline = True)
+    return embed
+
+# =================================== Export ===================================
+# sudo export hands admins a server's whole color history as a gzipped CSV or
+# JSONL file. Rows are read exportChunkSize at a time and compressed straight
+# into a temporary file, so the export only ever holds one chunk in memory no
+# matter how long the history is. It all happens on a worker thread (see
+# exportHistory()), so it never blocks the bot.
+exportChunkSize = 1000
+exportFormats = ["csv", "jsonl"]
+exportColumns = ["sqlID", "userID", "serverID", "color", "startTime", "length"]
+
+# Writes every colorHistory row for the server to a new gzipped file in the
+# given format, and returns the file's path and how many rows were written.
+# The caller has to delete the file once it's done with it. Rows are grouped by
+# user, oldest first, which is the order colorHistoryUser already has them in;
+# ordering by sqlID alone would make SQLite sort the whole history first.
+def exportHistory(serverID, exportFormat):
+    if exportFormat not in exportFormats:
+        raise ValueError(f"Unknown export format: {exportFormat}")
+    # Include any changes still waiting to be written
+    flush()
+    fileHandle, exportPath = tempfile.mkstemp(suffix = f".{exportFormat}.gz")
+    os.close(fileHandle)
+    rowCount = 0
+    try:
+        curs = getReadCursor()
+        curs.execute(f"""
+SELECT {", ".join(exportColumns)} FROM colorHistory WHERE serverID=? ORDER BY
+userID, sqlID""", (serverID,))
+        with gzip.open(exportPath, "wt", newline = "") as exportFile:
+            if exportFormat == "csv":
+                writer = csv.writer(exportFile)
+                writer.writerow(exportColumns)
+            while True:
+                rows = curs.fetchmany(exportChunkSize)
+                if not rows:
+                    break
+                if exportFormat == "csv":
+                    writer.writerows(rows)
+                else:
+                    for row in rows:
+                        exportFile.write(json.dumps(dict(zip(exportColumns, row))))
+                        exportFile.write("\n")
+                rowCount += len(rows)
+    except:
+        os.remove(exportPath)
+        raise
+    return exportPath, rowCount
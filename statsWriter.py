@@ -0,0 +1,250 @@
+# The stats writer process for a sharded bot (see sharding.py). SQLite only
+# lets one connection write at a time, so rather than every shard process
+# fighting over the write lock, they all send their color changes here over a
+# local connection (multiprocessing.connection, authenticated with the key
+# sharding.py hands out in writerKeyVariable) and this process applies them
+# with stats.py's usual writer thread, group commits and all. The shards keep
+# reading the database themselves; WAL mode means those reads never wait for
+# the writer.
+#
+# Messages are tuples. From a shard:
+#     ("record", userID, serverID, color, timestamp)  a color change
+#     ("recordMany", serverID, [(userID, color), ...], timestamp)  a batch of
+#                       color changes, written in one transaction
+#     ("flush", token)  answered with ("flushed", token) once everything the
+#                       shard sent before it is committed
+#     ("stop",)  commit everything and exit (sent by sharding.py)
+# To a shard, after each commit:
+#     ("committed", [(serverID, userID), ...])  so it can drop those users'
+#                                               cached stats
+#
+# Since every write goes through here, this process also compacts old color
+# history (see compactHistory() in stats.py) and serves the metrics for it, on
+# the port given with --metrics-port.
+
+import argparse
+import asyncio
+import config
+import itertools
+import metrics
+import os
+import sqlite3
+import stats
+import sys
+import threading
+from multiprocessing.connection import Client, Listener
+
+writerKeyVariable = "COLORIZ_WRITER_KEY"
+
+# Returns the key shared by the launcher, the writer and the shards
+def getWriterKey():
+    writerKey = os.environ.get(writerKeyVariable)
+    if writerKey == None:
+        return None
+    return bytes.fromhex(writerKey)
+
+# ================================ Writer Process ==============================
+
+# A shard's connection. Replies can be sent from the connection's own thread
+# and from the writer thread, hence the lock.
+class ShardConnection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.sendLock = threading.Lock()
+
+    def send(self, message):
+        with self.sendLock:
+            try:
+                self.conn.send(message)
+            except (OSError, ValueError):
+                # The shard has gone; it doesn't need telling anything
+                pass
+
+class WriterService:
+    def __init__(self, host, port, writerKey):
+        self.address = (host, port)
+        self.writerKey = writerKey
+        self.listener = Listener(self.address, authkey = writerKey)
+        self.stopping = threading.Event()
+        # Server ID -> the ShardConnection which last sent a change for it,
+        # i.e., the shard with that server's cached stats
+        self.serverShards = {}
+        stats.commitListeners.append(self.sendCommitted)
+
+    def sendCommitted(self, changedKeys):
+        byShard = {}
+        for cacheKey in changedKeys:
+            shard = self.serverShards.get(cacheKey[0]) if cacheKey else None
+            if shard != None:
+                byShard.setdefault(shard, []).append(cacheKey)
+        for shard, cacheKeys in byShard.items():
+            shard.send(("committed", cacheKeys))
+
+    # Reads one shard's messages until it disconnects
+    def handleShard(self, conn):
+        shard = ShardConnection(conn)
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == "record":
+                    userID, serverID, color, timestamp = message[1:]
+                    self.serverShards[serverID] = shard
+                    stats.queueStats(userID, serverID, color, timestamp)
+                elif message[0] == "recordMany":
+                    serverID, changes, timestamp = message[1:]
+                    self.serverShards[serverID] = shard
+                    stats.queueManyStats(serverID, changes, timestamp)
+                elif message[0] == "flush":
+                    stats.flush()
+                    shard.send(("flushed", message[1]))
+                elif message[0] == "stop":
+                    self.stop()
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    # Compacts the history every CompactHours until stop() is called
+    def runCompaction(self):
+        while True:
+            try:
+                result = stats.compactHistory()
+            except sqlite3.Error as compactError:
+                print(f"Could not compact the color history: {compactError}")
+                result = None
+            if result != None:
+                print(stats.describeCompaction(*result))
+            if self.stopping.wait(config.getCompactHours() * 60 * 60):
+                return
+
+    # Accepts shards until stop() is called, then commits everything
+    def serve(self):
+        stats.prepareDatabase()
+        stats.startWriter()
+        if config.getRetentionDays() > 0:
+            threading.Thread(target = self.runCompaction, name = "compaction",
+                             daemon = True).start()
+        print(f"Stats writer listening on {self.address[0]}:{self.address[1]}")
+        while not self.stopping.is_set():
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError):
+                # Including someone connecting without the right key
+                continue
+            threading.Thread(target = self.handleShard, args = (conn,),
+                             daemon = True).start()
+        self.listener.close()
+        stats.close()
+
+    def stop(self):
+        self.stopping.set()
+        # accept() only notices once someone connects
+        try:
+            Client(self.address, authkey = self.writerKey).close()
+        except OSError:
+            pass
+
+# ================================ Shard Client ================================
+
+# A shard's connection to the writer process, which stats.py sends every write
+# to once it's handed this with stats.useRemoteWriter()
+class WriterClient:
+    def __init__(self, host, port, writerKey):
+        self.conn = Client((host, port), authkey = writerKey)
+        self.sendLock = threading.Lock()
+        self.tokens = itertools.count()
+        # Flush token -> threading.Event set when the writer answers it
+        self.flushWaiters = {}
+        self.receiver = threading.Thread(target = self.receive,
+                                         name = "statsWriterClient",
+                                         daemon = True)
+        self.receiver.start()
+
+    def send(self, message):
+        with self.sendLock:
+            self.conn.send(message)
+
+    def record(self, userID, serverID, color, timestamp):
+        try:
+            self.send(("record", userID, serverID, color, timestamp))
+        except (OSError, ValueError) as sendError:
+            print(f"Could not send stats to the writer: {sendError}")
+
+    def recordMany(self, serverID, changes, timestamp):
+        try:
+            self.send(("recordMany", serverID, changes, timestamp))
+        except (OSError, ValueError) as sendError:
+            print(f"Could not send stats to the writer: {sendError}")
+
+    # Blocks until the writer has committed everything sent so far (or the
+    # connection is lost)
+    def flush(self):
+        token = next(self.tokens)
+        flushed = threading.Event()
+        self.flushWaiters[token] = flushed
+        try:
+            self.send(("flush", token))
+        except (OSError, ValueError):
+            self.flushWaiters.pop(token, None)
+            return
+        flushed.wait()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def receive(self):
+        try:
+            while True:
+                message = self.conn.recv()
+                if message[0] == "committed":
+                    for cacheKey in message[1]:
+                        stats.invalidateCachedStats(tuple(cacheKey))
+                elif message[0] == "flushed":
+                    flushed = self.flushWaiters.pop(message[1], None)
+                    if flushed != None:
+                        flushed.set()
+        except (EOFError, OSError):
+            pass
+        # Nothing more is coming, so don't leave anyone waiting
+        for flushed in list(self.flushWaiters.values()):
+            flushed.set()
+
+# Connects to the writer process given in config.ini
+def connect():
+    return WriterClient(config.getWriterHost(), config.getWriterPort(),
+                        getWriterKey())
+
+# Serves the metrics on an event loop of its own, since nothing else in this
+# process uses one
+async def serveMetrics(port):
+    try:
+        server = await metrics.startServer(config.getMetricsHost(), port)
+    except OSError as serverError:
+        print(f"Could not serve metrics on port {port}: {serverError}")
+        return
+    await server.serve_forever()
+
+def startMetricsServer(port):
+    threading.Thread(target = asyncio.run, args = (serveMetrics(port),),
+                     name = "metrics", daemon = True).start()
+
+if __name__ == "__main__":
+    writerKey = getWriterKey()
+    if writerKey == None:
+        print(f"The stats writer is started by sharding.py, which sets {writerKeyVariable}")
+        sys.exit(1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metrics-port", type = int, default = 0,
+                        help = "where to serve metrics (0 to not serve them)")
+    args = parser.parse_args()
+    if args.metrics_port != 0:
+        startMetricsServer(args.metrics_port)
+    service = WriterService(config.getWriterHost(), config.getWriterPort(),
+                            writerKey)
+    try:
+        service.serve()
+    except KeyboardInterrupt:
+        # Still commit whatever made it onto the queue
+        stats.close()
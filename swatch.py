@@ -0,0 +1,100 @@
+# Makes the little swatch images attached to color replies: a block of one
+# color for color / color set, and a strip of side by side colors for color
+# search. The PNGs are simple enough (a handful of flat colored bands) to
+# encode by hand with zlib, so there's no need for an imaging library.
+# Encoded images are kept in an LRU cache keyed by their colors, since the same
+# few colors get shown over and over.
+
+import asyncio
+import collections
+import config
+import discord
+import io
+import struct
+import threading
+import zlib
+
+# Size of a single color swatch, and of each color in a palette strip
+swatchWidth = 64
+swatchHeight = 64
+paletteWidth = 32
+# How many search results are shown in a palette strip
+paletteSize = 10
+
+pngSignature = b"\x89PNG\r\n\x1a\n"
+
+# Hex code (e.g., "#ff0000") or tuple of hex codes -> PNG bytes
+swatchCache = collections.OrderedDict()
+swatchCacheLock = threading.Lock()
+swatchCacheSize = config.getSwatchCacheSize()
+cacheHits = 0
+cacheMisses = 0
+
+# Returns a PNG chunk: its length, type, data and CRC
+def pngChunk(chunkType, data):
+    crc = zlib.crc32(chunkType + data)
+    return struct.pack(">I", len(data)) + chunkType + data + struct.pack(">I", crc)
+
+# Returns a PNG, bandWidth pixels wide per color and height pixels tall, of the
+# given hex codes side by side
+def renderPNG(hexCodes, bandWidth, height):
+    row = bytearray(b"\x00")  # Filter type 0 (none) for every row
+    for hexCode in hexCodes:
+        row += bytes.fromhex(hexCode[1:7]) * bandWidth
+    # Every row is the same, which zlib squashes down to almost nothing
+    pixels = zlib.compress(bytes(row) * height, 9)
+    # Width, height, 8 bits per channel, truecolor, and the default
+    # compression, filter and interlace methods
+    header = struct.pack(">IIBBBBB", bandWidth * len(hexCodes), height, 8, 2,
+                         0, 0, 0)
+    return (pngSignature + pngChunk(b"IHDR", header) +
+            pngChunk(b"IDAT", pixels) + pngChunk(b"IEND", b""))
+
+# Returns the PNG for a hex code (a single swatch) or a tuple of hex codes (a
+# palette strip), encoding it only if it isn't already cached. Safe to call
+# from several threads at once.
+def getSwatch(colors):
+    global cacheHits, cacheMisses
+    if isinstance(colors, str):
+        colors = colors.lower()
+    else:
+        colors = tuple(hexCode.lower() for hexCode in colors)
+    with swatchCacheLock:
+        png = swatchCache.get(colors)
+        if png != None:
+            swatchCache.move_to_end(colors)
+            cacheHits += 1
+            return png
+        cacheMisses += 1
+    if isinstance(colors, str):
+        png = renderPNG([colors], swatchWidth, swatchHeight)
+    else:
+        png = renderPNG(colors, paletteWidth, swatchHeight)
+    with swatchCacheLock:
+        swatchCache[colors] = png
+        while len(swatchCache) > swatchCacheSize:
+            swatchCache.popitem(last = False)
+    return png
+
+# Returns a discord.File of the swatch, ready to attach to a message. Encoding
+# happens on a worker thread so it never holds up the event loop.
+async def getSwatchFile(colors):
+    png = await asyncio.to_thread(getSwatch, colors)
+    return discord.File(io.BytesIO(png), filename = "swatch.png")
+
+# Sends the message, with the swatch for colors attached (just the message if
+# colors is None) and the view's components under it, if there is one. Returns
+# the sent message.
+async def sendWithSwatch(ctx, message, colors, view = None):
+    if colors == None:
+        return await ctx.send(message, view = view)
+    return await ctx.send(message, file = await getSwatchFile(colors),
+                          view = view)
+
+# Returns the cache's size and hit / miss counters
+def getCacheStats():
+    return {
+        "entries": len(swatchCache),
+        "hits": cacheHits,
+        "misses": cacheMisses,
+    }